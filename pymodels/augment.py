@@ -0,0 +1,119 @@
+"""
+Batch augmentations in the feature domain.
+
+Features and labels share a log-frequency layout with `bins_per_note` bins
+per semitone (recorded with the data, see `model.data_bins_per_note`), so
+new training examples can be made from the decoded frames of a batch, without
+rendering or transforming audio again:
+
+- transposition: a shift of the bins of the features and of the labels by
+  a whole number of semitones; bins shifted in from outside the range are
+  zero
+- gain: a random gain in dB, i.e. a scale of the magnitudes
+- noise: additive Gaussian noise, relative to the mean magnitude of the
+  example, clipped to non-negative magnitudes. The noise of an example is
+  read at a random offset of a table of Gaussian values drawn once, which
+  is much cheaper than drawing every value of every batch
+- frame masking: context frames of windows (see `loader.frame_windows`)
+  are zeroed at random. The center frame, the one the labels belong to, is
+  never masked, so single frames are not masked at all
+
+Every example of a batch gets its own random parameters. They are drawn
+and applied with array operations on the whole batch.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+
+NOISE_TABLE_SIZE = 1 << 20
+
+
+def shift_bins(a, shift):
+    """
+    Shifts the bins of example `i` of `a` (batch, ..., bins) up by
+    `shift[i]` in place, shifting in zeros. The examples with the same
+    shift are shifted together.
+    """
+    shift = np.asarray(shift)
+    for s in np.unique(shift):
+        if s == 0:
+            continue
+        rows = np.flatnonzero(shift == s)
+        shifted = np.zeros_like(a[rows])
+        if s > 0:
+            shifted[..., s:] = a[rows, ..., :-s]
+        else:
+            shifted[..., :s] = a[rows, ..., -s:]
+        a[rows] = shifted
+
+
+class Augmentation(object):
+    """
+    In-place `transform(x, y)` of `loader.FrameLoader` batches: `x` of shape
+    (batch, bins) or (batch, frames, bins) for windows, `y` (batch, bins).
+
+    - `max_shift`: transpositions drawn from [-max_shift, max_shift]
+      semitones
+    - `gain_db`: gains drawn from [-gain_db, gain_db] dB
+    - `noise`: standard deviation of the noise, relative to the mean
+      magnitude of the example
+    - `mask_prob`: probability to zero each frame of a window but the
+      center frame
+
+    Transpositions need the `bins_per_note` of the data.
+    """
+    def __init__(self, bins_per_note=None, max_shift=0, gain_db=0.0, noise=0.0, mask_prob=0.0, seed=None):
+        if max_shift > 0 and bins_per_note is None:
+            raise ValueError("Transpositions need the number of bins per semitone of the data")
+        self.bins_per_note = bins_per_note
+        self.max_shift = max_shift
+        self.gain_db = gain_db
+        self.noise = noise
+        self.mask_prob = mask_prob
+        self.rng = np.random.default_rng(seed)
+        self._noise_table = None
+
+    @property
+    def enabled(self):
+        return self.max_shift > 0 or self.gain_db > 0 or self.noise > 0 or self.mask_prob > 0
+
+    def noise_values(self, shape):
+        """
+        Standard Gaussian noise of `shape` (batch, ...), a random slice of
+        the noise table per example.
+        """
+        size = int(np.prod(shape[1:]))
+        if self._noise_table is None or len(self._noise_table) < 2 * size:
+            self._noise_table = self.rng.standard_normal(max(NOISE_TABLE_SIZE, 4 * size), dtype=np.float32)
+        offsets = self.rng.integers(0, len(self._noise_table) - size + 1, shape[0])
+        return np.lib.stride_tricks.sliding_window_view(self._noise_table, size)[offsets].reshape(shape)
+
+    def __call__(self, x, y):
+        batch_size = len(x)
+        # frames are windows of one frame
+        windows = x.reshape(batch_size, -1, x.shape[-1])
+        rng = self.rng
+
+        if self.max_shift > 0:
+            shift = rng.integers(-self.max_shift, self.max_shift + 1, batch_size) * self.bins_per_note
+            shift_bins(windows, shift)
+            shift_bins(y, shift)
+
+        if self.gain_db > 0:
+            gain_db = rng.uniform(-self.gain_db, self.gain_db, (batch_size, 1, 1)).astype(np.float32)
+            windows *= 10 ** (gain_db / 20)
+
+        if self.noise > 0:
+            level = self.noise * windows.mean(axis=(1, 2), keepdims=True)
+            noise = self.noise_values(windows.shape)
+            noise *= level
+            windows += noise
+            np.maximum(windows, 0, out=windows)
+
+        num_frames = windows.shape[1]
+        if self.mask_prob > 0 and num_frames > 1:
+            mask = rng.random(windows.shape[:2]) < self.mask_prob
+            mask[:, num_frames // 2] = False
+            windows[mask] = 0
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the datagen and model stages.
+
+All inputs are synthetic and generated from fixed seeds (audio comes from
+the in-process synthesizer), so no fluidsynth is needed. Each stage runs in
+a fresh process, which makes the reported peak RSS specific to that stage.
+Results are written as JSON and can be compared against a saved baseline.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+SEED = 42
+
+# Parameters of generate_dataset
+SAMPLE_RATE = 44100
+HOP_LENGTH = 512
+BINS_PER_NOTE = 4
+N_OCTAVES = 9
+LOWEST_NOTE_MIDI = 24   # C1
+
+# Frames on each side of the windows of the windowed training stage
+WINDOW_CONTEXT = 4
+
+
+def cqt_params():
+    import librosa
+    return {
+        "sr": SAMPLE_RATE,
+        "fmin": librosa.note_to_hz("C1"),
+        "n_bins": N_OCTAVES * 12 * BINS_PER_NOTE,
+        "bins_per_octave": 12 * BINS_PER_NOTE,
+        "hop_length": HOP_LENGTH,
+        "filter_scale": 1.0,
+        "tuning": 0.0,
+    }
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def measure(func, amount, unit, repeat):
+    """
+    Runs `func` `repeat` times and reports the best time. `amount` is the
+    work done per call in `unit`.
+    """
+    rss_before = rss_mb()
+    times = []
+    for _ in range(repeat):
+        t1 = time.time()
+        func()
+        times.append(time.time() - t1)
+    best = min(times)
+    return {
+        "seconds": best,
+        "throughput": amount / best,
+        "unit": unit,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def synthetic_midi(duration):
+    import random
+    import datagen
+    random.seed(SEED)
+    np.random.seed(SEED)
+    mfw = datagen.generate_midi_random_single_notes()
+    # The generator produces one minute; repeat it for longer durations
+    notes = mfw.notes
+    for i in range(1, int(np.ceil(duration / 60.0))):
+        mfw.add_notes(notes.shifted(60 * i))
+    return mfw
+
+
+def synthetic_audio(duration):
+    import synth
+    mfw = synthetic_midi(duration)
+    wave_data = synth.render_notes(mfw.notes, mfw.tempo, SAMPLE_RATE)
+    return mfw, wave_data[:int(duration * SAMPLE_RATE)]
+
+
+def synthetic_frames(num_frames):
+    rng = np.random.RandomState(SEED)
+    num_bins = N_OCTAVES * 12 * BINS_PER_NOTE
+    X = rng.rand(num_bins, num_frames).astype(np.float32)
+    Y = (rng.rand(num_bins, num_frames) < 0.05).astype(np.float32)
+    return X, Y
+
+
+def bench_midi_generation(args, tmp_dir):
+    import random
+    import datagen
+
+    num_notes = []
+
+    def run():
+        random.seed(SEED)
+        np.random.seed(SEED)
+        num_notes.append(len(datagen.generate_midi_random_single_notes().notes))
+
+    run()
+    return measure(run, num_notes[0], "notes/s", args.repeat)
+
+
+def bench_groundtruth(args, tmp_dir):
+    mfw = synthetic_midi(args.duration)
+    raw_length = int(args.duration * SAMPLE_RATE)
+    num_frames = (raw_length + HOP_LENGTH - 1) // HOP_LENGTH
+
+    def run():
+        mfw.extract_groundtruth(
+            raw_length=raw_length,
+            sample_rate=SAMPLE_RATE,
+            hop_length=HOP_LENGTH,
+            lowest_note=LOWEST_NOTE_MIDI,
+            highest_note=LOWEST_NOTE_MIDI + N_OCTAVES * 12,
+            bins_per_note=BINS_PER_NOTE,
+        )
+
+    return measure(run, num_frames, "frames/s", args.repeat)
+
+
+def bench_cqt(args, tmp_dir):
+    import cqt
+    _, wave_data = synthetic_audio(args.duration)
+    # The filter basis is built once, as in a long-running generator
+    engine = cqt.get_engine(**cqt_params())
+    return measure(lambda: engine.transform(wave_data), args.duration, "audio s/s", args.repeat)
+
+
+def bench_filterbank(args, tmp_dir):
+    import filterbank
+    _, wave_data = synthetic_audio(args.duration)
+    # The resonators are designed once per process
+    filterbank.design_ensemble()
+    return measure(lambda: filterbank.process_ensemble(wave_data), args.duration, "audio s/s", args.repeat)
+
+
+def bench_npy_io(args, tmp_dir):
+    X, _ = synthetic_frames(int(args.duration * SAMPLE_RATE / HOP_LENGTH))
+    path = os.path.join(tmp_dir, "X.npy")
+
+    def run():
+        np.save(path, X)
+        np.load(path)
+
+    return measure(run, 2 * X.nbytes / 1e6, "MB/s", args.repeat)
+
+
+def bench_plot_dataset(args, tmp_dir):
+    import matplotlib
+    matplotlib.use("Agg")
+    import cqt
+    import plots
+
+    duration = min(args.duration, 30.0)
+    mfw, wave_data = synthetic_audio(duration)
+    params = cqt_params()
+    C = cqt.get_engine(**params).transform(wave_data)
+    groundtruth = mfw.extract_groundtruth(
+        raw_length=len(wave_data),
+        sample_rate=SAMPLE_RATE,
+        hop_length=HOP_LENGTH,
+        lowest_note=LOWEST_NOTE_MIDI,
+        highest_note=LOWEST_NOTE_MIDI + N_OCTAVES * 12,
+        bins_per_note=BINS_PER_NOTE,
+    )
+    base_path = os.path.join(tmp_dir, "dataset")
+
+    def run():
+        plots.plot_dataset(C, groundtruth, base_path, SAMPLE_RATE, params["fmin"], HOP_LENGTH,
+                           params["bins_per_octave"], False)
+
+    return measure(run, C.shape[1], "frames/s", args.repeat)
+
+
+def _write_training_data(tmp_dir, num_frames):
+    X, Y = synthetic_frames(num_frames)
+    base = os.path.join(tmp_dir, "train")
+    np.save("{}_X.npy".format(base), X)
+    np.save("{}_Y.npy".format(base), Y)
+    return base
+
+
+def bench_train(args, tmp_dir):
+    import torch
+    import model
+    torch.manual_seed(SEED)
+
+    base = _write_training_data(tmp_dir, 16384)
+    model_path = os.path.join(tmp_dir, "model.pt")
+    model.configure_threads(args.threads)
+
+    def run():
+        if os.path.exists(model_path):
+            os.remove(model_path)
+        # as many passes over the data as needed for the number of steps
+        model.train(model_path, datasets=[base], epochs=args.train_steps, num_steps=args.train_steps,
+                    batch_size=args.train_batch_size, bf16=args.bf16)
+
+    return measure(run, args.train_steps * args.train_batch_size, "frames/s", args.repeat)
+
+
+def bench_train_window(args, tmp_dir):
+    import torch
+    import model
+    torch.manual_seed(SEED)
+
+    base = _write_training_data(tmp_dir, 16384)
+    model_path = os.path.join(tmp_dir, "model.pt")
+    model.configure_threads(args.threads)
+
+    def run():
+        if os.path.exists(model_path):
+            os.remove(model_path)
+        model.train(model_path, datasets=[base], epochs=args.train_steps, num_steps=args.train_steps,
+                    batch_size=args.train_batch_size, bf16=args.bf16, arch="temporal_conv", context=WINDOW_CONTEXT)
+
+    return measure(run, args.train_steps * args.train_batch_size, "frames/s", args.repeat)
+
+
+def bench_augment(args, tmp_dir):
+    import loader
+    from augment import Augmentation
+
+    X, Y = synthetic_frames(args.train_batch_size + 2 * WINDOW_CONTEXT)
+    windows = loader.frame_windows(X.T, WINDOW_CONTEXT)
+    x = np.empty(windows.shape, dtype=np.float32)
+    y = np.empty((args.train_batch_size, Y.shape[0]), dtype=np.float32)
+    augmentation = Augmentation(bins_per_note=BINS_PER_NOTE, max_shift=6, gain_db=6.0, noise=0.05, mask_prob=0.1,
+                                seed=SEED)
+
+    def run():
+        for _ in range(10):
+            x[...] = windows
+            y[...] = Y.T[WINDOW_CONTEXT:-WINDOW_CONTEXT]
+            augmentation(x, y)
+
+    return measure(run, 10 * args.train_batch_size, "frames/s", args.repeat)
+
+
+def bench_predict(args, tmp_dir):
+    import torch
+    import model
+    torch.manual_seed(SEED)
+
+    num_frames = int(args.duration * SAMPLE_RATE / HOP_LENGTH)
+    base = _write_training_data(tmp_dir, num_frames)
+    model_path = os.path.join(tmp_dir, "model.pt")
+    model.store_model(model_path, model.init_model_two_layers(model_path, N_OCTAVES * 12 * BINS_PER_NOTE))
+    path_P = os.path.join(tmp_dir, "P.npy")
+
+    def run():
+        model.predict(model_path, path_X="{}_X.npy".format(base), path_P=path_P, num_threads=args.threads)
+
+    return measure(run, num_frames, "frames/s", args.repeat)
+
+
+def bench_predict_artifact(args, tmp_dir):
+    import torch
+    import model
+    torch.manual_seed(SEED)
+
+    num_frames = int(args.duration * SAMPLE_RATE / HOP_LENGTH)
+    base = _write_training_data(tmp_dir, num_frames)
+    model_path = os.path.join(tmp_dir, "model.pt")
+    model.store_model(model_path, model.init_model_two_layers(model_path, N_OCTAVES * 12 * BINS_PER_NOTE))
+    artifact_path = os.path.join(tmp_dir, "model.ts")
+    model.export_model(model_path, artifact_path, quantize=True)
+    path_P = os.path.join(tmp_dir, "P.npy")
+
+    def run():
+        # includes loading the artifact
+        model.predict(None, path_X="{}_X.npy".format(base), path_P=path_P, num_threads=args.threads,
+                      artifact_path=artifact_path)
+
+    return measure(run, num_frames, "frames/s", args.repeat)
+
+
+def bench_video(args, tmp_dir):
+    import video
+
+    num_frames = int(args.duration * SAMPLE_RATE / HOP_LENGTH)
+    base = _write_training_data(tmp_dir, num_frames)
+    path_X = "{}_X.npy".format(base)
+    num_video_frames = len(video.frame_starts(num_frames, SAMPLE_RATE / HOP_LENGTH, 30))
+
+    def run():
+        # the standin encoder discards the frames, ffmpeg's encoding is not included
+        video.render_video(None, path_X=path_X, path_P=path_X, encoder="standin", sample_rate=SAMPLE_RATE,
+                           hop_length=HOP_LENGTH, num_threads=args.threads or 1)
+
+    return measure(run, num_video_frames, "frames/s", args.repeat)
+
+
+STAGES = collections.OrderedDict([
+    ("midi_generation", bench_midi_generation),
+    ("groundtruth", bench_groundtruth),
+    ("cqt", bench_cqt),
+    ("filterbank", bench_filterbank),
+    ("npy_io", bench_npy_io),
+    ("plot_dataset", bench_plot_dataset),
+    ("video", bench_video),
+    ("train", bench_train),
+    ("train_window", bench_train_window),
+    ("augment", bench_augment),
+    ("predict", bench_predict),
+    ("predict_artifact", bench_predict_artifact),
+])
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def _run_stage(name, args):
+    tmp_dir = tempfile.mkdtemp(prefix="bench_{}_".format(name))
+    try:
+        with quiet_stdout():
+            return STAGES[name](args, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+
+def run_stage(name, args):
+    # A fresh interpreter per stage, so that peak RSS is not inherited
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(_run_stage, (name, args))
+
+
+def environment():
+    env = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "cpu_count": multiprocessing.cpu_count(),
+    }
+    for module in ["librosa", "torch"]:
+        try:
+            env[module] = __import__(module).__version__
+        except ImportError:
+            pass
+    return env
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the stages whose throughput dropped by more than `tolerance`
+    (relative) compared to the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["throughput"] / baseline[name]["throughput"]
+        result["baseline_ratio"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run (default: all)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=60.0,
+        help="Length of the synthetic recordings in seconds",
+    )
+    parser.add_argument(
+        "--train-steps",
+        type=int,
+        default=1000,
+        help="Number of training steps",
+    )
+    parser.add_argument(
+        "--train-batch-size",
+        type=int,
+        default=1024,
+        help="Number of frames per training batch",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Train under bfloat16 autocast",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of torch threads for intra-op parallelism",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of timed runs per stage, the best is reported",
+    )
+    parser.add_argument(
+        "--output",
+        default="bench_results.json",
+        help="Where to write the results",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Compare against this results file",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative throughput drop that counts as a regression",
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+    results = collections.OrderedDict()
+    for name in args.stages:
+        results[name] = run_stage(name, args)
+        print("{:<16s} {:12.1f} {:<10s} peak RSS {:8.1f} MB".format(
+            name, results[name]["throughput"], results[name]["unit"], results[name]["peak_rss_mb"]))
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name in results:
+            if "baseline_ratio" in results[name]:
+                print("{:<16s} {:6.2f}x baseline{}".format(
+                    name, results[name]["baseline_ratio"], "    REGRESSION" if name in regressions else ""))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "environment": environment(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "args": vars(args),
+            "results": results,
+            "regressions": regressions,
+        }, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
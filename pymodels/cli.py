@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+DeepAudio command line.
+
+Subcommands:
+  midi       generate MIDI files only
+  render     generate MIDI files and render them to WAVE
+  featurize  generate datasets (CQT or filter bank features and ground truth), see datagen.py
+  plot       plot existing datasets
+  train      train a model, see model.py
+  predict    run a model, see model.py
+  video      render a piano-roll video of features and predictions, see video.py
+  benchmark  run the benchmark suite, see bench.py
+
+Every subcommand only imports what it needs; in particular torch is only
+loaded by train and predict, and librosa's core and matplotlib only by the
+subcommands that transform or plot.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+
+
+GENERATORS = ["random_single_notes", "random_polyphonic", "random_chords", "chromatic_sweep", "instrument_check"]
+
+# Subcommands that hand their arguments over to the main of a module
+FORWARDED = {
+    "featurize": ("datagen", [], "Generate datasets"),
+    "train": ("model", ["--train-only"], "Train a model"),
+    "predict": ("model", ["--predict-only"], "Run a model"),
+    "video": ("video", [], "Render a piano-roll video"),
+    "benchmark": ("bench", [], "Run the benchmark suite"),
+}
+
+
+def generate_midi(generator, program=None):
+    import datagen
+    if generator in datagen.RANDOM_GENERATORS:
+        return datagen.RANDOM_GENERATORS[generator]()
+    elif generator == "chromatic_sweep":
+        return datagen.generate_midi_chromatic_sweep()
+    elif generator == "instrument_check":
+        return datagen.generate_midi_instrument_check(program)
+    raise ValueError("Unknown generator: {}".format(generator))
+
+
+def _midi_item(task):
+    import datagen
+    base_path, seed, generator, program, renderer = task
+    datagen.seed_rngs(seed)
+    mfw = generate_midi(generator, program)
+    # the renderers render from memory, except fluidsynth-cli, which writes the MIDI file itself
+    if renderer != "fluidsynth-cli":
+        datagen.store_midi(mfw.midi_file, "{}.mid".format(base_path))
+    if renderer == "synth":
+        datagen.SynthRenderer(write_wave=True).render(mfw, base_path)
+    elif renderer is not None:
+        datagen.make_renderer(renderer).render(mfw, base_path)
+    return base_path
+
+
+def run_midi(args, renderer=None):
+    import datagen
+    import utils
+    utils.mkdir(args.output_dir)
+    tasks = [
+        (os.path.join(args.output_dir, "dataset_{:03d}".format(i)), args.seed + i, args.generator, args.program,
+         renderer)
+        for i in range(args.first_index, args.first_index + args.count)
+    ]
+    datagen.run_tasks(_midi_item, tasks, args.workers)
+
+
+def run_plot(args):
+    import datagen
+    import librosa
+    from groundtruth import NoteEvents
+    from loader import ArraySource
+    from plots import plot_dataset
+
+    if not args.interactive:
+        from plots import use_agg_backend
+        use_agg_backend()
+
+    for base_path in args.datasets:
+        source = ArraySource.from_dataset(base_path)
+        mag = source.codec.decode(source.X)
+        groundtruth = source.Y.to_dense() if isinstance(source.Y, NoteEvents) else source.Y
+        # Only magnitudes are stored, so there is no rainbow plot
+        plot_dataset(mag, groundtruth, base_path, args.sr, librosa.note_to_hz(datagen.LOWEST_NOTE_NAME),
+                     datagen.HOP_LENGTH, 12 * datagen.BINS_PER_NOTE, args.interactive,
+                     max_preview_frames=args.max_preview_frames)
+
+
+def add_midi_arguments(parser):
+    parser.add_argument(
+        "--generator",
+        choices=GENERATORS,
+        default="random_single_notes",
+        help="Note generator",
+    )
+    parser.add_argument(
+        "--program",
+        type=int,
+        default=0,
+        help="MIDI program of the instrument_check generator",
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=1,
+        help="Number of files",
+    )
+    parser.add_argument(
+        "--first-index",
+        type=int,
+        default=1,
+        help="Index of the first file",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=".",
+        help="Output directory, files are named dataset_<index>",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Base seed, file <index> is seeded with seed + index",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes",
+    )
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    add_midi_arguments(subparsers.add_parser("midi", help="Generate MIDI files only"))
+
+    parser_render = subparsers.add_parser("render", help="Generate MIDI files and render them to WAVE")
+    add_midi_arguments(parser_render)
+    parser_render.add_argument(
+        "--renderer",
+        choices=["fluidsynth", "fluidsynth-cli", "standin", "synth"],
+        # datagen.DEFAULT_RENDERER, not imported to keep --help fast
+        default="fluidsynth-cli",
+        help="Audio render backend",
+    )
+
+    parser_plot = subparsers.add_parser("plot", help="Plot existing datasets")
+    parser_plot.add_argument(
+        "datasets",
+        nargs="+",
+        help="Dataset base paths (<base>_X.npy with <base>_labels.npz or <base>_Y.npy)",
+    )
+    parser_plot.add_argument(
+        "--sr",
+        type=int,
+        default=44100,
+        help="Sample rate of the datasets",
+    )
+    parser_plot.add_argument(
+        "--max-preview-frames",
+        type=int,
+        default=None,
+        help="Decimate the raw images of long datasets to this many frames",
+    )
+    parser_plot.add_argument(
+        "--interactive",
+        action="store_true",
+        help="Show interactive plots",
+    )
+
+    for name, (module, _, description) in sorted(FORWARDED.items()):
+        subparsers.add_parser(
+            name, add_help=False, help="{} (options: {} -h)".format(description, name))
+
+    return parser.parse_known_args(args)
+
+
+def main(args=sys.argv[1:]):
+    args, remaining = parse_args(args)
+
+    if args.command in FORWARDED:
+        module, extra_args, _ = FORWARDED[args.command]
+        __import__(module).main(extra_args + remaining)
+        return
+
+    if remaining:
+        sys.exit("Unrecognized arguments: {}".format(" ".join(remaining)))
+
+    if args.command == "midi":
+        run_midi(args)
+    elif args.command == "render":
+        run_midi(args, renderer=args.renderer)
+    elif args.command == "plot":
+        run_plot(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Sharded, memory-mapped training corpus.
+
+A corpus is a directory with an append-only list of shards and a small JSON
+index:
+
+    <root>/index.json
+    <root>/shards/<name>_X.npy    (frames, bins), frame-major
+    <root>/shards/<name>_Y.npy    (frames, bins), frame-major
+    <root>/shards/<name>_labels.npz    or sparse labels (groundtruth.NoteEvents)
+
+The index records for each shard its global frame offset, its number of
+frames, and the file dtypes, plus the feature parameters (e.g. the CQT
+parameters) shared by all shards. Readers open the shards with `mmap`, so a
+corpus can be larger than RAM and accessing a frame is an offset lookup.
+"""
+
+from __future__ import division, print_function
+
+import fcntl
+import json
+import os
+
+import numpy as np
+
+from features import FeatureCodec
+from groundtruth import NoteEvents
+import utils
+
+
+INDEX_FILENAME = "index.json"
+LOCK_FILENAME = "index.lock"
+SHARD_DIRNAME = "shards"
+# `y_dtype` of shards with sparse labels
+EVENTS_DTYPE = "events"
+FORMAT_VERSION = 1
+
+
+def _empty_index():
+    return {
+        "version": FORMAT_VERSION,
+        "params": None,
+        "num_bins": None,
+        "num_frames": 0,
+        "shards": [],
+    }
+
+
+def read_index(root):
+    path = os.path.join(root, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return _empty_index()
+    with open(path) as f:
+        index = json.load(f)
+    if index.get("version") != FORMAT_VERSION:
+        raise ValueError("Unsupported corpus version {} in {}".format(index.get("version"), path))
+    return index
+
+
+def _update_offsets(index):
+    offset = 0
+    for shard in index["shards"]:
+        shard["offset"] = offset
+        offset += shard["num_frames"]
+    index["num_frames"] = offset
+
+
+class CorpusWriter(object):
+    """
+    Appends shards to a corpus. Several processes may append to the same
+    corpus concurrently; index updates are serialized with a file lock.
+
+    Shards can also be replaced, e.g. when a dataset is rebuilt with other
+    parameters. Readers that are open during a replacement keep seeing the
+    previous shard files, but their offsets may be outdated.
+    """
+    def __init__(self, root):
+        self.root = root
+        utils.mkdir(os.path.join(root, SHARD_DIRNAME))
+
+    def append(self, X, Y, name, params=None, x_dtype=np.float32, y_dtype=np.float32, x_encoding=None,
+               replace=False):
+        """
+        Stores a dataset with features `X` and labels `Y` of shape
+        (bins, frames), i.e. in the layout produced by `generate_dataset`.
+        `Y` can also be sparse `NoteEvents`, which are stored as such.
+        If `X` is encoded, `x_encoding` holds the parameters of its
+        `features.FeatureCodec`. With `replace`, an existing shard `name`
+        is replaced, otherwise it is an error.
+        """
+        y_shape = self._labels_shape(Y)
+        if X.shape != y_shape:
+            raise ValueError("Shape mismatch between X {} and Y {}".format(X.shape, y_shape))
+        num_bins, num_frames = X.shape
+
+        path_X = os.path.join(SHARD_DIRNAME, "{}_X.npy".format(name))
+
+        # Shards are fully written before they are moved into place and
+        # referenced by the index, so an interrupted or rejected append never
+        # leaves a broken corpus.
+        X_frames = np.ascontiguousarray(X.T, dtype=x_dtype)
+        path_X_tmp = self._save_tmp(os.path.join(self.root, path_X), X_frames)
+        path_Y, path_Y_tmp, y_dtype_str = self._save_labels_tmp(Y, name, y_dtype)
+
+        try:
+            with open(os.path.join(self.root, LOCK_FILENAME), "a") as f_lock:
+                fcntl.flock(f_lock, fcntl.LOCK_EX)
+                try:
+                    index = read_index(self.root)
+
+                    previous = [i for i, shard in enumerate(index["shards"]) if shard["name"] == name]
+                    if previous and not replace:
+                        raise ValueError("Corpus {} already contains a shard {}".format(self.root, name))
+                    if index["num_bins"] is None:
+                        index["num_bins"] = num_bins
+                        index["params"] = params
+                    elif index["num_bins"] != num_bins:
+                        raise ValueError("Shard {} has {} bins, corpus has {}".format(
+                            name, num_bins, index["num_bins"]))
+                    elif params is not None and index["params"] != params:
+                        raise ValueError("Shard {} has parameters {}, corpus has {}".format(
+                            name, params, index["params"]))
+
+                    os.rename(path_X_tmp, os.path.join(self.root, path_X))
+                    os.rename(path_Y_tmp, os.path.join(self.root, path_Y))
+
+                    shard = {
+                        "name": name,
+                        "offset": index["num_frames"],
+                        "num_frames": num_frames,
+                        "x_path": path_X,
+                        "y_path": path_Y,
+                        "x_dtype": X_frames.dtype.str,
+                        "y_dtype": y_dtype_str,
+                    }
+                    if x_encoding is not None:
+                        shard["x_encoding"] = x_encoding
+                    if previous:
+                        self._remove_replaced(index["shards"][previous[0]], shard)
+                        index["shards"][previous[0]] = shard
+                    else:
+                        index["shards"].append(shard)
+                    _update_offsets(index)
+
+                    self._save_index(os.path.join(self.root, INDEX_FILENAME), index)
+                finally:
+                    fcntl.flock(f_lock, fcntl.LOCK_UN)
+        finally:
+            for path in [path_X_tmp, path_Y_tmp]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        print("{} shard {} with {} frames to corpus {}".format(
+            "Replaced" if previous else "Appended", name, num_frames, self.root))
+        return shard
+
+    def replace_labels(self, Y, name, y_dtype=np.float32):
+        """
+        Replaces the labels of the shard `name` and keeps its features.
+        """
+        num_frames = self._labels_shape(Y)[1]
+        path_Y, path_Y_tmp, y_dtype_str = self._save_labels_tmp(Y, name, y_dtype)
+
+        try:
+            with open(os.path.join(self.root, LOCK_FILENAME), "a") as f_lock:
+                fcntl.flock(f_lock, fcntl.LOCK_EX)
+                try:
+                    index = read_index(self.root)
+
+                    previous = [shard for shard in index["shards"] if shard["name"] == name]
+                    if not previous:
+                        raise ValueError("Corpus {} has no shard {}".format(self.root, name))
+                    if previous[0]["num_frames"] != num_frames:
+                        raise ValueError("Shard {} has {} frames, labels have {}".format(
+                            name, previous[0]["num_frames"], num_frames))
+
+                    os.rename(path_Y_tmp, os.path.join(self.root, path_Y))
+
+                    shard = dict(previous[0], y_path=path_Y, y_dtype=y_dtype_str)
+                    self._remove_replaced(previous[0], shard)
+                    previous[0].update(shard)
+
+                    self._save_index(os.path.join(self.root, INDEX_FILENAME), index)
+                finally:
+                    fcntl.flock(f_lock, fcntl.LOCK_UN)
+        finally:
+            if os.path.exists(path_Y_tmp):
+                os.remove(path_Y_tmp)
+
+        print("Replaced labels of shard {} in corpus {}".format(name, self.root))
+        return shard
+
+    @staticmethod
+    def _labels_shape(Y):
+        # (bins, frames)
+        return Y.shape[::-1] if isinstance(Y, NoteEvents) else Y.shape
+
+    def _save_labels_tmp(self, Y, name, y_dtype):
+        if isinstance(Y, NoteEvents):
+            path_Y = os.path.join(SHARD_DIRNAME, "{}_labels.npz".format(name))
+            path_Y_tmp = self._save_tmp(os.path.join(self.root, path_Y), Y, writer=lambda f, Y: Y.save(f))
+            return path_Y, path_Y_tmp, EVENTS_DTYPE
+        path_Y = os.path.join(SHARD_DIRNAME, "{}_Y.npy".format(name))
+        Y_frames = np.ascontiguousarray(Y.T, dtype=y_dtype)
+        return path_Y, self._save_tmp(os.path.join(self.root, path_Y), Y_frames), Y_frames.dtype.str
+
+    def _remove_replaced(self, previous, shard):
+        # Files of the previous shard that were not overwritten by the new one
+        for key in ["x_path", "y_path"]:
+            if previous[key] != shard[key] and os.path.exists(os.path.join(self.root, previous[key])):
+                os.remove(os.path.join(self.root, previous[key]))
+
+    @staticmethod
+    def _save_tmp(path, data, writer=np.save):
+        path_tmp = "{}.tmp{}".format(path, os.getpid())
+        # np.save would append `.npy` to the temporary name
+        with open(path_tmp, "wb") as f:
+            writer(f, data)
+        return path_tmp
+
+    @staticmethod
+    def _save_index(path, index):
+        path_tmp = "{}.tmp{}".format(path, os.getpid())
+        with open(path_tmp, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.rename(path_tmp, path)
+
+
+class Corpus(object):
+    """
+    Read access to a corpus. Shards are memory-mapped on first access.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.index = read_index(root)
+        if len(self.index["shards"]) == 0:
+            raise ValueError("Corpus {} is empty".format(root))
+
+        self.shards = self.index["shards"]
+        self.offsets = np.array(
+            [shard["offset"] for shard in self.shards] + [self.index["num_frames"]],
+            dtype=np.int64,
+        )
+        self._arrays = [None] * len(self.shards)
+        self._codecs = [FeatureCodec.from_dict(shard.get("x_encoding")) for shard in self.shards]
+
+    @property
+    def num_frames(self):
+        return self.index["num_frames"]
+
+    @property
+    def num_bins(self):
+        return self.index["num_bins"]
+
+    @property
+    def params(self):
+        return self.index["params"]
+
+    def __len__(self):
+        return self.num_frames
+
+    def shard_arrays(self, i):
+        """
+        Memory-mapped (X, Y) of shard `i`, each of shape (frames, bins).
+        Sparse labels are returned as `NoteEvents`, which can be indexed by
+        frames like the dense array.
+        """
+        if self._arrays[i] is None:
+            shard = self.shards[i]
+            X = np.load(os.path.join(self.root, shard["x_path"]), mmap_mode="r")
+            if shard["y_dtype"] == EVENTS_DTYPE:
+                Y = NoteEvents.load(os.path.join(self.root, shard["y_path"]))
+            else:
+                Y = np.load(os.path.join(self.root, shard["y_path"]), mmap_mode="r")
+            self._arrays[i] = (X, Y)
+        return self._arrays[i]
+
+    def find_shard(self, name):
+        """
+        Index of the shard `name`.
+        """
+        for i, shard in enumerate(self.shards):
+            if shard["name"] == name:
+                return i
+        raise KeyError("Corpus {} has no shard {}".format(self.root, name))
+
+    def shard_codec(self, i):
+        """
+        Codec of the (possibly encoded) features of shard `i`.
+        """
+        return self._codecs[i]
+
+    def locate(self, indices):
+        """
+        Maps global frame indices to (shard index, local frame index).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= self.num_frames):
+            raise IndexError("Frame index out of range [0, {})".format(self.num_frames))
+        shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        return shard_ids, indices - self.offsets[shard_ids]
+
+    def get_frames(self, indices, dtype=np.float32):
+        """
+        Gathers the frames at the given global indices into arrays of shape
+        (len(indices), bins).
+        """
+        shard_ids, local = self.locate(indices)
+        x = np.empty((len(local), self.num_bins), dtype=dtype)
+        y = np.empty((len(local), self.num_bins), dtype=dtype)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            X, Y = self.shard_arrays(shard_id)
+            x[mask] = self._codecs[shard_id].decode(X[local[mask]])
+            y[mask] = Y[local[mask]]
+        return x, y
+
+    def get_range(self, start, stop, dtype=np.float32):
+        return self.get_frames(np.arange(start, stop), dtype)
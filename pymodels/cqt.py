@@ -0,0 +1,260 @@
+"""
+Constant-Q transform helpers
+"""
+
+from __future__ import division, print_function
+
+import collections
+
+import numpy as np
+
+# librosa is imported where it is used, its core takes a while to load
+
+
+def relative_bandwidth(freqs):
+    """
+    Relative bandwidth of each filter, estimated from the local spacing of
+    the frequencies (same as librosa's wavelet basis construction).
+    """
+    bpo = np.empty_like(freqs)
+    logf = np.log2(freqs)
+    bpo[0] = 1 / (logf[1] - logf[0])
+    bpo[-1] = 1 / (logf[-1] - logf[-2])
+    bpo[1:-1] = 2 / (logf[2:] - logf[:-2])
+    return (2.0 ** (2 / bpo) - 1) / (2.0 ** (2 / bpo) + 1)
+
+
+def num_two_factors(x):
+    num_twos = 0
+    while x > 0 and x % 2 == 0:
+        num_twos += 1
+        x //= 2
+    return num_twos
+
+
+class CQTEngine(object):
+    """
+    Constant-Q transform with a precomputed filter basis.
+
+    This follows the multi-rate algorithm of `librosa.cqt`: the filters of
+    each octave are applied in the frequency domain to an STFT of the
+    signal, which is downsampled by 2 from one octave to the next. Building
+    the filter basis dominates the cost of short transforms, so it is done
+    once in the constructor and reused for every call with the same
+    parameters. `transform_batch` transforms several signals of the same
+    length with a single matrix product per octave.
+    """
+    def __init__(self, sr, hop_length=512, fmin=None, n_bins=84, bins_per_octave=12, filter_scale=1.0,
+                 tuning=0.0, norm=1, sparsity=0.01, window="hann", pad_mode="constant", res_type="soxr_hq",
+                 scale=True, dtype=np.complex64):
+        import librosa
+
+        if fmin is None:
+            fmin = librosa.note_to_hz("C1")
+        if tuning is None:
+            raise ValueError("CQTEngine requires a fixed tuning")
+
+        self.sr = sr
+        self.hop_length = hop_length
+        self.n_bins = n_bins
+        self.pad_mode = pad_mode
+        self.res_type = res_type
+        self.scale = scale
+        self.dtype = dtype
+
+        n_octaves = int(np.ceil(float(n_bins) / bins_per_octave))
+        n_filters = min(bins_per_octave, n_bins)
+
+        fmin = fmin * 2.0 ** (tuning / bins_per_octave)
+        freqs = librosa.cqt_frequencies(n_bins=n_bins, fmin=fmin, bins_per_octave=bins_per_octave)
+        alpha = relative_bandwidth(freqs)
+
+        lengths, filter_cutoff = librosa.filters.wavelet_lengths(
+            freqs=freqs, sr=sr, window=window, filter_scale=filter_scale, gamma=0, alpha=alpha)
+
+        nyquist = sr / 2.0
+        if filter_cutoff > nyquist:
+            raise ValueError("Filter basis with cutoff {} Hz exceeds the Nyquist frequency {} Hz".format(
+                filter_cutoff, nyquist))
+
+        # Downsample up front if even the top octave is far below Nyquist
+        downsample_count = min(
+            max(0, int(np.ceil(np.log2(nyquist / filter_cutoff)) - 1) - 1),
+            max(0, num_two_factors(hop_length) - n_octaves + 1),
+        )
+        self.early_downsample_factor = 2 ** downsample_count
+        my_sr = sr / self.early_downsample_factor
+        my_hop = hop_length // self.early_downsample_factor
+        base_sr = my_sr
+
+        # Per octave, from the top: (n_fft, hop, fft_basis, downsample afterwards)
+        self.octaves = []
+        for i in range(n_octaves):
+            if i == 0:
+                sl = slice(-n_filters, None)
+            else:
+                sl = slice(-n_filters * (i + 1), -n_filters * i)
+
+            basis, basis_lengths = librosa.filters.wavelet(
+                freqs=freqs[sl], sr=my_sr, filter_scale=filter_scale, norm=norm, pad_fft=True,
+                window=window, gamma=0, alpha=alpha[sl])
+            n_fft = basis.shape[1]
+            basis *= basis_lengths[:, np.newaxis] / float(n_fft)
+            fft_basis = np.fft.fft(basis, n=n_fft, axis=1)[:, :(n_fft // 2) + 1]
+            fft_basis = librosa.util.sparsify_rows(fft_basis, quantile=sparsity, dtype=dtype)
+            # compensate for downsampling
+            fft_basis *= np.sqrt(base_sr / my_sr)
+
+            downsample = my_hop % 2 == 0
+            self.octaves.append((n_fft, my_hop, fft_basis, downsample))
+            if downsample:
+                my_hop //= 2
+                my_sr /= 2.0
+
+        lengths, _ = librosa.filters.wavelet_lengths(
+            freqs=freqs, sr=base_sr, window=window, filter_scale=filter_scale, gamma=0, alpha=alpha)
+        self.inv_sqrt_lengths = (1 / np.sqrt(lengths)).astype(np.float32)
+
+    def _resample(self, y, factor):
+        import librosa
+        return librosa.resample(y, orig_sr=factor, target_sr=1, res_type=self.res_type, scale=True)
+
+    def transform(self, y):
+        """
+        CQT of a single signal, shape (n_bins, frames).
+        """
+        return self.transform_batch(np.asarray(y)[np.newaxis, :])[0]
+
+    def transform_batch(self, ys):
+        """
+        CQT of a batch of signals of equal length given as an array of shape
+        (batch, samples), or a list. Returns shape (batch, n_bins, frames).
+        """
+        import librosa
+
+        ys = [np.asarray(y, dtype=np.float32) for y in ys]
+        if len(set(len(y) for y in ys)) > 1:
+            raise ValueError("All signals in a batch must have the same length")
+        y = np.stack(ys)
+
+        if self.early_downsample_factor > 1:
+            y = self._resample(y, self.early_downsample_factor)
+            if not self.scale:
+                y *= np.sqrt(self.early_downsample_factor)
+
+        responses = []
+        for n_fft, hop, fft_basis, downsample in self.octaves:
+            D = librosa.stft(y, n_fft=n_fft, hop_length=hop, window="ones", pad_mode=self.pad_mode, dtype=self.dtype)
+            batch, num_freqs, num_frames = D.shape
+            # Single product for the whole batch: (filters, freqs) x (freqs, batch * frames)
+            D = D.transpose(1, 0, 2).reshape(num_freqs, batch * num_frames)
+            response = fft_basis.dot(D).reshape(-1, batch, num_frames).transpose(1, 0, 2)
+            responses.append(response)
+            if downsample:
+                y = self._resample(y, 2)
+
+        num_frames = min(response.shape[-1] for response in responses)
+        C = np.empty((len(ys), self.n_bins, num_frames), dtype=self.dtype)
+        end = self.n_bins
+        for response in responses:
+            n_oct = response.shape[1]
+            if end < n_oct:
+                C[:, :end, :] = response[:, -end:, :num_frames]
+            else:
+                C[:, end - n_oct:end, :] = response[:, :, :num_frames]
+            end -= n_oct
+
+        if self.scale:
+            C *= self.inv_sqrt_lengths[:, np.newaxis]
+        return C
+
+
+MAX_ENGINES = 8
+
+_engines = collections.OrderedDict()
+
+
+def get_engine(**params):
+    """
+    Shared `CQTEngine` per parameter set, so that the filter basis is only
+    built once per process. Only the most recently used engines are kept.
+    """
+    key = tuple(sorted(params.items()))
+    if key in _engines:
+        engine = _engines.pop(key)
+    else:
+        engine = CQTEngine(**params)
+        while len(_engines) >= MAX_ENGINES:
+            _engines.popitem(last=False)
+    _engines[key] = engine
+    return engine
+
+
+def max_filter_length(sr, fmin, bins_per_octave, filter_scale=1.0, tuning=0.0):
+    """
+    Length in samples of the longest (lowest) constant-Q filter.
+    """
+    fmin = fmin * 2.0 ** (tuning / bins_per_octave)
+    Q = filter_scale / (2.0 ** (1.0 / bins_per_octave) - 1)
+    return int(np.ceil(Q * sr / fmin))
+
+
+def frame_count(num_samples, hop_length):
+    """
+    Number of frames of the CQT of `num_samples` samples: frames are
+    centered on the multiples of `hop_length`, including the last sample.
+    """
+    return 1 + num_samples // hop_length
+
+
+def stream_cqt(y, sr, hop_length, fmin, n_bins, bins_per_octave, filter_scale=1.0, tuning=0.0,
+               block_frames=2048):
+    """
+    Block-wise CQT of a long signal, yielding `(frame_offset, C_block)`.
+
+    Each block of `block_frames` frames is transformed together with enough
+    context on both sides to cover the longest filter (and the resampling
+    filters of the lower octaves), and only the frames of the block itself
+    are kept. Blocks at the ends of the signal are not extended beyond it,
+    so that the edge handling is the same as in the one-shot call. The
+    concatenated blocks therefore match `librosa.cqt(y, ...)` within float
+    tolerance, while memory only depends on `block_frames`.
+
+    `y` can be any sliceable array, e.g. a memory-mapped file.
+    """
+    num_samples = len(y)
+    num_frames = frame_count(num_samples, hop_length)
+
+    # Context in whole hops, so that block boundaries stay aligned with the
+    # downsampled octaves.
+    pad_frames = int(np.ceil(max_filter_length(sr, fmin, bins_per_octave, filter_scale, tuning) / hop_length))
+    pad = pad_frames * hop_length
+
+    engine = get_engine(sr=sr, hop_length=hop_length, fmin=fmin, n_bins=n_bins, bins_per_octave=bins_per_octave,
+                        filter_scale=filter_scale, tuning=tuning)
+
+    for frame_from in range(0, num_frames, block_frames):
+        frame_upto = min(frame_from + block_frames, num_frames)
+
+        sample_from = max(frame_from * hop_length - pad, 0)
+        sample_upto = min(frame_upto * hop_length + pad, num_samples)
+        block = np.asarray(y[sample_from:sample_upto], dtype=np.float32)
+
+        C = engine.transform(block)
+        offset = frame_from - sample_from // hop_length
+        yield frame_from, C[:, offset:offset + frame_upto - frame_from]
+
+
+def stream_cqt_magnitudes_to_npy(y, path, sr, hop_length, fmin, n_bins, bins_per_octave, filter_scale=1.0,
+                                 tuning=0.0, block_frames=2048):
+    """
+    Writes the CQT magnitudes of `y` block by block into a memory-mapped
+    float32 `.npy` of shape (n_bins, frames) and returns it.
+    """
+    num_frames = 1 + len(y) // hop_length
+    mag = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n_bins, num_frames))
+    blocks = stream_cqt(y, sr, hop_length, fmin, n_bins, bins_per_octave, filter_scale, tuning, block_frames)
+    for frame_from, C in blocks:
+        mag[:, frame_from:frame_from + C.shape[1]] = np.abs(C)
+    mag.flush()
+    return mag
@@ -6,29 +6,62 @@ Datagen
 from __future__ import division, print_function
 
 import argparse
+import functools
+import io
+import multiprocessing.util
 import os
 import random
+import shutil
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 from midiutil.MidiFile import MIDIFile
 import midi_constants
+import groundtruth as groundtruth_utils
 
-from scipy.io.wavfile import read
-
-import librosa
-import librosa.display
-from librosa.core.constantq import cqt
-import rainbow
+import cqt as cqt_utils
+import filterbank
+from feature_cache import FeatureCache, cached_cqt
+from features import ENCODINGS, FeatureCodec, codec_path, load_features, save_features
+from notes import NoteTable
+from render_worker import RenderWorker
+import synth
 
 import utils
-
-import matplotlib.pyplot as plt
+from corpus import SHARD_DIRNAME, Corpus, CorpusWriter
+from manifest import Manifest, hash_array, hash_bytes, stage_key
+from plots import PlotPool, SyncPlotter, plot_files, use_agg_backend
+import instrumentation
 
 
 PERCUSSION_CHANNEL = 9
 
+DEFAULT_SOUNDFONT = "/usr/share/sounds/sf2/FluidR3_GM.sf2"
+
+# CQT layout of the datasets
+BINS_PER_NOTE = 4
+N_OCTAVES = 9
+HOP_LENGTH = 512
+LOWEST_NOTE_NAME = "C1"  # cqt default
+
+FEATURES = ["cqt", "filterbank"]
+
+# Per-process temp directory, set up by init_worker in pool workers.
+_worker_tmp_dir = None
+
+# Per-process asynchronous plot pool, see get_plotter
+_plot_pool = None
+
+# Default of the plotter of generate_dataset, None disables plots
+_DEFAULT = object()
+
+# Per-process render workers, see get_render_worker
+_render_workers = {}
+
 
 class Percussion(object):
     AcousticBassDrum = 35
@@ -44,11 +77,15 @@ class Instrument(object):
 
 
 class Note(object):
-    def __init__(self, instrument, pitch, t, duration):
+    """
+    A single note, see `MidiFileWrapper.add_note`.
+    """
+    def __init__(self, instrument, pitch, t, duration, volume=100):
         self.instrument = instrument
         self.pitch = pitch
         self.t = t
         self.duration = duration
+        self.volume = volume
 
 
 class MidiFileWrapper(object):
@@ -64,46 +101,77 @@ class MidiFileWrapper(object):
             tempo=tempo,
         )
 
-        self.notes = []
+        # tables added since `notes` was last read, concatenated once on read
+        self._tables = []
+        self._notes = NoteTable()
+
+    @property
+    def notes(self):
+        """
+        `NoteTable` of all notes added so far.
+        """
+        if self._tables:
+            self._notes = NoteTable.concatenate([self._notes] + self._tables)
+            self._tables = []
+        return self._notes
+
+    def add_notes(self, notes):
+        """
+        Adds the notes of the `NoteTable` `notes`.
+        """
+        notes.add_to_midi(self.midi_file)
+        self._tables.append(notes)
 
     def add_note(self, instrument, pitch, t, duration, volume=100):
-        self.midi_file.addNote(instrument.track, instrument.channel, pitch, t, duration, volume)
-        self.notes.append(Note(
-            instrument=instrument,
-            pitch=pitch,
-            t=t,
-            duration=duration,
-        ))
-
-    def extract_groundtruth(self, raw_length, sample_rate, hop_length, lowest_note, highest_note, bins_per_note):
+        """
+        Adds a single note (`instrument` is an `Instrument`).
+        """
+        self.add_notes(NoteTable.for_instruments([instrument], 0, t, duration, pitch, volume))
+
+    def _note_intervals(self, sample_rate, lowest_note, highest_note, bins_per_note):
+        pitch = self.notes.pitch
+        assert np.all(pitch >= lowest_note)
+        assert np.all(pitch <= highest_note)
+        rows = (pitch - lowest_note) * bins_per_note
+        index_start, index_end = self.notes.intervals(self.tempo, sample_rate)
+        return rows, index_start, index_end
+
+    def extract_groundtruth(self, raw_length, sample_rate, hop_length, lowest_note, highest_note, bins_per_note,
+                            num_frames=None):
+        """
+        Coverage of the hops by the notes, one row per note at `bins_per_note`
+        rows per semitone, for `num_frames` frames (by default those covering
+        `raw_length` samples, see `groundtruth.frame_boundaries`).
+        """
         print("Extracting ground truth for {} notes".format(len(self.notes)))
-        raw_data = np.zeros(((highest_note - lowest_note) * bins_per_note, raw_length), dtype=np.int8)
-
-        def compute_index(beat):
-            t = beat * 60 / self.tempo
-            return int(t * sample_rate)
-
-        for note in self.notes:
-            index_start = compute_index(note.t)
-            index_end = compute_index(note.t + note.duration)
-            # row = np.zeros(raw_length)
-            # row[index_start:index_end] = 1
-
-            assert note.pitch >= lowest_note
-            assert note.pitch <= highest_note
-            row_index = (note.pitch - lowest_note) * bins_per_note
-            # raw_data[row_index, :] = np.max([raw_data[row_index, :], row], axis=0)
-            raw_data[row_index, index_start:index_end] = 1
-
-        # could be optimized, but probably not crucial:
-        # https://stackoverflow.com/questions/15956309/averaging-over-every-n-elements-of-a-numpy-array#comment77786037_15956341
-        group_means = [
-            raw_data[:, i:i+hop_length].mean(axis=1)
-            for i in range(raw_length)[::hop_length]
-        ]
-        groundtruth = np.stack(group_means, axis=1)
+        rows, index_start, index_end = self._note_intervals(sample_rate, lowest_note, highest_note, bins_per_note)
+
+        # Coverage is computed per hop directly from the note intervals,
+        # avoiding a (bins x samples) raster at audio rate.
+        groundtruth = groundtruth_utils.interval_coverage(
+            rows, index_start, index_end,
+            num_rows=(highest_note - lowest_note) * bins_per_note,
+            raw_length=raw_length,
+            hop_length=hop_length,
+            num_frames=num_frames,
+        )
         return groundtruth
 
+    def extract_note_events(self, raw_length, sample_rate, hop_length, lowest_note, highest_note, bins_per_note,
+                            num_frames=None):
+        """
+        Same ground truth as `extract_groundtruth`, as sparse `NoteEvents`.
+        """
+        print("Extracting note events for {} notes".format(len(self.notes)))
+        rows, index_start, index_end = self._note_intervals(sample_rate, lowest_note, highest_note, bins_per_note)
+        return groundtruth_utils.interval_events(
+            rows, index_start, index_end,
+            num_rows=(highest_note - lowest_note) * bins_per_note,
+            raw_length=raw_length,
+            hop_length=hop_length,
+            num_frames=num_frames,
+        )
+
 
 def setup_instruments(midi_file, instrument_codes):
     instruments = []
@@ -139,13 +207,16 @@ def generate_midi_chromatic_sweep():
     instruments = setup_default_instruments(mfw.midi_file)
 
     base_pitch = 60
-    i = 1
-    for instrument in instruments:
-        for j in range(12):
-            volume = 100
-            duration = 1
-            mfw.add_note(instrument, base_pitch+j, i, duration, volume)
-            i += duration
+    duration = 1
+    # 12 notes per instrument, one after the other
+    instrument_ids = np.repeat(np.arange(len(instruments)), 12)
+    mfw.add_notes(NoteTable.for_instruments(
+        instruments, instrument_ids,
+        t=1 + duration * np.arange(len(instrument_ids)),
+        duration=duration,
+        pitch=base_pitch + np.tile(np.arange(12), len(instruments)),
+        volume=100,
+    ))
 
     #midi_file.addNote(track, PERCUSSION_CHANNEL, Percussion.ClosedHiHat, time + i, duration, volume)
     return mfw
@@ -159,226 +230,723 @@ def generate_midi_instrument_check(program_code):
     c1 = c4 - 12 * 3    # 24
     c8 = c4 + 12 * 4    # 108
 
-    t = 1.0
-    for pitch in range(c1, c8+1):
-        volume = 100
-        duration = 1.0
-        mfw.add_note(instrument, pitch, t, duration, volume)
-        t += duration
+    pitches = np.arange(c1, c8+1)
+    duration = 1.0
+    mfw.add_notes(NoteTable.for_instruments(
+        [instrument], 0,
+        t=1.0 + duration * np.arange(len(pitches)),
+        duration=duration,
+        pitch=pitches,
+        volume=100,
+    ))
+
+    return mfw
+
+
+def random_note_sequence(duration=60.0, min_note_duration=0.075, max_note_duration=0.5, max_gap=0.1):
+    """
+    Onsets and durations of a monophonic sequence of random notes with
+    random gaps, starting at 0 and covering `duration` beats.
+    """
+    # enough draws for a sequence of shortest notes
+    n = int(np.ceil(duration / min_note_duration)) + 1
+    durations = np.random.uniform(min_note_duration, max_note_duration, n)
+    gaps = np.random.uniform(0.0, max_gap, n)
+    onsets = np.concatenate([[0.0], np.cumsum(durations + gaps)[:-1]])
+    keep = onsets < duration
+    return onsets[keep], durations[keep]
+
+
+def generate_midi_random_single_notes(duration=60.0):
+    mfw = MidiFileWrapper(60)
+    instruments = setup_default_instruments(mfw.midi_file)
+
+    t, durations = random_note_sequence(duration)
+    mfw.add_notes(NoteTable.for_instruments(
+        instruments, np.random.randint(0, len(instruments), len(t)),
+        t=t,
+        duration=durations,
+        pitch=np.random.randint(60 - 24, 60 + 24, len(t)),
+        volume=100,
+    ))
 
     return mfw
 
 
-def generate_midi_random_single_notes():
+def generate_midi_random_polyphonic(num_voices=3, duration=60.0):
+    """
+    `num_voices` independent random single note sequences played at the
+    same time, each by a different instrument. A MIDI channel cannot play
+    overlapping notes of the same pitch, so voices do not share channels.
+    """
     mfw = MidiFileWrapper(60)
     instruments = setup_default_instruments(mfw.midi_file)
+    if num_voices > len(instruments):
+        raise ValueError("At most {} voices are supported".format(len(instruments)))
+
+    voices = [random_note_sequence(duration) for _ in range(num_voices)]
+    voice_instruments = np.random.permutation(len(instruments))[:num_voices]
+    t = np.concatenate([onsets for onsets, _ in voices])
+    notes = NoteTable.for_instruments(
+        instruments, np.repeat(voice_instruments, [len(onsets) for onsets, _ in voices]),
+        t=t,
+        duration=np.concatenate([durations for _, durations in voices]),
+        pitch=np.random.randint(60 - 24, 60 + 24, len(t)),
+        volume=100,
+    )
+    mfw.add_notes(notes.sorted())
+
+    return mfw
+
 
-    t = 0.0
-    while t < 60:
-        instrument = random.choice(instruments)
-        volume = 100
-        duration = np.random.uniform(0.075, 0.5)
-        pitch = np.random.randint(60 - 24, 60 + 24)
-        mfw.add_note(instrument, pitch, t, duration, volume)
-        t += duration + np.random.uniform(0.0, 0.1)
+# Intervals of the chords of generate_midi_random_chords, in semitones
+# above the root
+CHORD_SHAPES = [
+    [0, 4, 7],          # major
+    [0, 3, 7],          # minor
+    [0, 5, 7],          # sus4
+    [0, 4, 7, 11],      # major 7th
+    [0, 3, 7, 10],      # minor 7th
+    [0, 4, 7, 10],      # dominant 7th
+]
+
+
+def generate_midi_random_chords(duration=60.0, min_chord_duration=0.25, max_chord_duration=1.0):
+    """
+    Sequence of random chords (see `CHORD_SHAPES`), each played by one
+    instrument.
+    """
+    mfw = MidiFileWrapper(60)
+    instruments = setup_default_instruments(mfw.midi_file)
+
+    t, durations = random_note_sequence(duration, min_chord_duration, max_chord_duration)
+    num_chords = len(t)
+    shapes = np.random.randint(0, len(CHORD_SHAPES), num_chords)
+    chord_instruments = np.random.randint(0, len(instruments), num_chords)
+    # same range as the single notes for the highest note of a chord
+    roots = np.random.randint(60 - 24, 60 + 24 - 11, num_chords)
+
+    shape_table = np.zeros((len(CHORD_SHAPES), max(len(shape) for shape in CHORD_SHAPES)), dtype=np.int64)
+    for i, shape in enumerate(CHORD_SHAPES):
+        shape_table[i, :len(shape)] = shape
+    sizes = np.array([len(shape) for shape in CHORD_SHAPES])[shapes]
+    chord_ids = np.repeat(np.arange(num_chords), sizes)
+    # offset of every note within its chord
+    note_index = np.arange(len(chord_ids)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    intervals = shape_table[shapes[chord_ids], note_index]
+    mfw.add_notes(NoteTable.for_instruments(
+        instruments, chord_instruments[chord_ids],
+        t=t[chord_ids],
+        duration=durations[chord_ids],
+        pitch=roots[chord_ids] + intervals,
+        volume=100,
+    ))
 
     return mfw
 
 
-def store_midi_and_wave(midi_file, path_midi, path_wave):
+RANDOM_GENERATORS = {
+    "random_single_notes": generate_midi_random_single_notes,
+    "random_polyphonic": generate_midi_random_polyphonic,
+    "random_chords": generate_midi_random_chords,
+}
+
+
+def midi_bytes(midi_file):
+    f = io.BytesIO()
+    midi_file.writeFile(f)
+    return f.getvalue()
+
+
+def store_midi(midi_file, path_midi):
     print("Writing MIDI: {}".format(path_midi))
     with open(path_midi, 'wb') as f_binary:
         midi_file.writeFile(f_binary)
 
-    print("Writing WAVE: {}".format(path_wave))
-    subprocess.check_output(
-        "fluidsynth -F /tmp/output_stereo.wav /usr/share/sounds/sf2/FluidR3_GM.sf2 '{}'".format(path_midi),
-        shell=True,
-    )
-    subprocess.check_output(
-        "sox /tmp/output_stereo.wav '{}' channels 1".format(path_wave),
-        shell=True,
-    )
 
+def store_midi_and_wave(midi_file, path_midi, path_wave, tmp_dir=None, soundfont=DEFAULT_SOUNDFONT):
+    store_midi(midi_file, path_midi)
 
-def read_wave(filename):
-    sample_rate, wave_data = read(filename)
+    # The stereo intermediate gets a unique name so that concurrent
+    # generators never render into the same file.
+    if tmp_dir is None:
+        tmp_dir = _worker_tmp_dir
+    fd, path_stereo = tempfile.mkstemp(suffix="_stereo.wav", dir=tmp_dir)
+    os.close(fd)
 
-    wave_data = wave_data.astype(np.float32)
+    print("Writing WAVE: {}".format(path_wave))
+    try:
+        subprocess.check_output(
+            "fluidsynth -F '{}' '{}' '{}'".format(path_stereo, soundfont, path_midi),
+            shell=True,
+        )
+        subprocess.check_output(
+            "sox '{}' '{}' channels 1".format(path_stereo, path_wave),
+            shell=True,
+        )
+    finally:
+        os.remove(path_stereo)
+
+
+def pcm16_to_wave(pcm):
+    wave_data = pcm.astype(np.float32)
     wave_data = (wave_data + 0.5) / 32767.5
+    return wave_data
 
-    return sample_rate, wave_data
 
+def wave_to_pcm16(wave_data):
+    # inverse of pcm16_to_wave
+    return np.clip(np.round(wave_data * 32767.5 - 0.5), -32768, 32767).astype(np.int16)
 
-def generate_dataset(mfw, base_path, audio_preview=False, use_cqt=True, interactive_plots=False):
+
+def read_wave(filename):
+    from scipy.io.wavfile import read
+    sample_rate, wave_data = read(filename)
+    return sample_rate, pcm16_to_wave(wave_data)
+
+
+def write_pcm16(filename, sample_rate, pcm):
+    from scipy.io.wavfile import write
+    write(filename, sample_rate, pcm)
+
+
+def write_wave(filename, sample_rate, wave_data):
+    # inverse of read_wave
+    write_pcm16(filename, sample_rate, wave_to_pcm16(wave_data))
+
+
+class FluidsynthRenderer(object):
+    """
+    Renders through the fluidsynth and sox binaries, reading the resulting
+    WAVE back. Starts both processes (and loads the soundfont) per dataset,
+    see WorkerRenderer for a persistent alternative.
+    """
+    writes_wave = True
+
+    def __init__(self, soundfont=DEFAULT_SOUNDFONT):
+        self.soundfont = soundfont
+
+    def params(self):
+        return {"renderer": "fluidsynth-cli", "soundfont": self.soundfont}
+
+    def render(self, mfw, base_path):
+        path_midi = "{}.mid".format(base_path)
+        path_wave = "{}.wav".format(base_path)
+        with instrumentation.span("render", renderer="fluidsynth-cli"):
+            store_midi_and_wave(mfw.midi_file, path_midi, path_wave, soundfont=self.soundfont)
+        with instrumentation.span("read"):
+            return read_wave(path_wave)
+
+
+def get_render_worker(backend, soundfont=None, sample_rate=44100):
+    """
+    Render worker of this process for a backend and soundfont, started on
+    first use and kept until the process exits.
+    """
+    key = (backend, soundfont, sample_rate)
+    if key not in _render_workers:
+        worker = RenderWorker(backend, soundfont, sample_rate)
+        multiprocessing.util.Finalize(worker, worker.close, exitpriority=10)
+        _render_workers[key] = worker
+    return _render_workers[key]
+
+
+def close_render_workers():
+    for worker in _render_workers.values():
+        worker.close()
+    _render_workers.clear()
+
+
+class WorkerRenderer(object):
+    """
+    Renders on a persistent render worker (see render_worker.py), which keeps
+    the soundfont loaded across datasets and returns mono samples. The
+    samples are quantized to 16 bit as stored in the WAVE file, so that they
+    do not depend on whether the audio is rendered or read back.
+    """
+    writes_wave = True
+
+    def __init__(self, backend="fluidsynth", soundfont=DEFAULT_SOUNDFONT, sample_rate=44100):
+        self.backend = backend
+        self.soundfont = soundfont if backend == "fluidsynth" else None
+        self.sample_rate = sample_rate
+
+    def params(self):
+        return {"renderer": self.backend, "soundfont": self.soundfont, "sample_rate": self.sample_rate}
+
+    def render(self, mfw, base_path):
+        path_wave = "{}.wav".format(base_path)
+        with instrumentation.span("render", renderer=self.backend):
+            worker = get_render_worker(self.backend, self.soundfont, self.sample_rate)
+            pcm = wave_to_pcm16(worker.render(midi_bytes(mfw.midi_file)))
+            print("Writing WAVE: {}".format(path_wave))
+            write_pcm16(path_wave, self.sample_rate, pcm)
+        return self.sample_rate, pcm16_to_wave(pcm)
+
+
+class SynthRenderer(object):
+    """
+    Renders the notes in-process with the wavetable synthesizer. The WAVE
+    file is only written if `write_wave` is set.
+    """
+    def __init__(self, sample_rate=44100, write_wave=False):
+        self.sample_rate = sample_rate
+        self.write_wave = write_wave
+
+    @property
+    def writes_wave(self):
+        return self.write_wave
+
+    def params(self):
+        return {"renderer": "synth", "sample_rate": self.sample_rate}
+
+    def render(self, mfw, base_path):
+        with instrumentation.span("render", renderer="synth"):
+            wave_data = synth.render_notes(mfw.notes, mfw.tempo, self.sample_rate)
+            if self.write_wave:
+                path_wave = "{}.wav".format(base_path)
+                print("Writing WAVE: {}".format(path_wave))
+                write_wave(path_wave, self.sample_rate, wave_data)
+        return self.sample_rate, wave_data
+
+
+RENDERERS = {
+    "fluidsynth": WorkerRenderer,
+    "fluidsynth-cli": FluidsynthRenderer,
+    # the render worker without fluidsynth, e.g. for tests
+    "standin": functools.partial(WorkerRenderer, backend="standin"),
+    "synth": SynthRenderer,
+}
+
+# the fluidsynth binary, until the ctypes render worker has been verified against it
+DEFAULT_RENDERER = "fluidsynth-cli"
+
+
+def make_renderer(name):
+    if name not in RENDERERS:
+        raise ValueError("Unknown renderer: {} (available: {})".format(name, ", ".join(sorted(RENDERERS))))
+    return RENDERERS[name]()
+
+
+def generate_dataset(mfw, base_path, audio_preview=False, features="cqt", interactive_plots=False, renderer=None,
+                     corpus=None, block_frames=None, feature_cache=None, plotter=_DEFAULT, labels="events",
+                     x_encoding="float32", force=False, dataset_info=None, feature_threads=1):
+    """
+    Renders `mfw` and stores its features and the ground truth. The features
+    are CQT magnitudes with `features="cqt"`, or the outputs of a resonator
+    per piano key with `features="filterbank"` (see filterbank.py, computed
+    on `feature_threads` threads); the ground truth has the same layout. With
+    `labels="events"` the ground truth is stored as sparse note events
+    (`<base>_labels.npz`), with `labels="dense"` as a dense coverage matrix
+    (`<base>_Y.npy`). The magnitudes are stored in the encoding `x_encoding`
+    (see `features.ENCODINGS`).
+
+    Builds are incremental: the completed stages are recorded in the
+    manifest `<base>_manifest.json` (see `manifest.py`), and only the stages
+    whose parameters or inputs changed are redone, unless `force` is set.
+    `dataset_info` (e.g. the seed and generator) is recorded in the manifest.
+
+    Plots are made by `plotter` (see `get_plotter`), in the calling process
+    by default, and skipped if it is None.
+    """
+    if plotter is _DEFAULT:
+        plotter = SyncPlotter()
+    with instrumentation.span("dataset", dataset=os.path.basename(base_path)) as s:
+        redone = _generate_dataset(mfw, base_path, audio_preview, features, interactive_plots, renderer, corpus,
+                                   block_frames, feature_cache, plotter, labels, x_encoding, force, dataset_info,
+                                   feature_threads)
+        s.set(redone=redone)
+    return redone
+
+
+def _owns_shard(manifest, corpus):
+    """
+    Whether the features of a previous build of the dataset were stored as a
+    shard of `corpus`, i.e. whether its shard may be replaced. A shard of
+    the same name from another dataset (e.g. another output directory) is
+    never replaced.
+    """
+    stage = manifest.stage("features")
+    if stage is None:
+        return False
+    shard_dir = os.path.join(os.path.abspath(corpus.root), SHARD_DIRNAME)
+    return any(os.path.dirname(os.path.normpath(os.path.join(manifest.root, path))) == shard_dir
+               for path in stage["files"])
+
+
+def _load_stored_features(base_path, corpus):
+    if corpus is None:
+        X, codec = load_features("{}_X.npy".format(base_path))
+        return codec.decode(X)
+    reader = Corpus(corpus.root)
+    i = reader.find_shard(os.path.basename(base_path))
+    return reader.shard_codec(i).decode(reader.shard_arrays(i)[0]).T
+
+
+def _load_stored_labels(base_path, corpus, labels):
+    if corpus is None:
+        if labels == "events":
+            return groundtruth_utils.NoteEvents.load("{}_labels.npz".format(base_path))
+        return np.load("{}_Y.npy".format(base_path))
+    reader = Corpus(corpus.root)
+    Y = reader.shard_arrays(reader.find_shard(os.path.basename(base_path)))[1]
+    return Y if isinstance(Y, groundtruth_utils.NoteEvents) else Y.T
+
+
+def _generate_dataset(mfw, base_path, audio_preview, features, interactive_plots, renderer, corpus, block_frames,
+                      feature_cache, plotter, labels, x_encoding, force, dataset_info, feature_threads):
     utils.ensure_parent_exists(base_path)
 
+    if renderer is None:
+        renderer = make_renderer(DEFAULT_RENDERER)
+
+    manifest = Manifest(base_path, reset=force)
+    # before anything is recorded, a forced build replaces the shard of its previous build too
+    replace_shard = corpus is not None and _owns_shard(Manifest(base_path) if force else manifest, corpus)
+    if dataset_info is not None:
+        manifest.set_dataset_info(**dataset_info)
+    redone = []
+
     path_midi = "{}.mid".format(base_path)
     path_wave = "{}.wav".format(base_path)
-    store_midi_and_wave(mfw.midi_file, path_midi, path_wave)
+
+    midi_hash = hash_bytes(midi_bytes(mfw.midi_file))
+    if not manifest.is_current("midi", midi_hash):
+        store_midi(mfw.midi_file, path_midi)
+        manifest.complete("midi", midi_hash, files=[path_midi])
+        redone.append("midi")
+
+    render_key = stage_key(renderer.params(), midi=midi_hash)
+    wave_data = None
+    if not manifest.is_current("render", render_key):
+        sr, wave_data = renderer.render(mfw, base_path)
+        manifest.complete("render", render_key, files=[path_wave] if renderer.writes_wave else [],
+                          sample_rate=sr, raw_length=len(wave_data), wave_sha1=hash_array(wave_data))
+        redone.append("render")
+    render_info = manifest.stage("render")
+    sr = render_info["sample_rate"]
+
+    def get_wave_data():
+        # The render stage is current, i.e. a recorded WAVE file is unchanged
+        if wave_data is not None:
+            return wave_data
+        if render_info["files"]:
+            with instrumentation.span("read"):
+                return read_wave(path_wave)[1]
+        return renderer.render(mfw, base_path)[1]
 
     if audio_preview:
+        if not os.path.exists(path_wave):
+            write_wave(path_wave, sr, get_wave_data())
         os.system("audacious '{}' &".format(path_wave))
 
-    sr, wave_data = read_wave(path_wave)
+    if features == "cqt":
+        import librosa
 
-    if use_cqt:
-        print("Transforming data")
-        bins_per_note = 4
+        bins_per_note = BINS_PER_NOTE
         bins_per_octave = 12 * bins_per_note
-        n_octaves = 9
+        n_octaves = N_OCTAVES
         n_bins = n_octaves * bins_per_octave
-        hop_length = 512
-        lowest_note_name = "C1"  # cqt default
+        hop_length = HOP_LENGTH
+        lowest_note_name = LOWEST_NOTE_NAME
         lowest_note_hz = librosa.note_to_hz(lowest_note_name)
         lowest_note_midi = librosa.note_to_midi(lowest_note_name)
+        highest_note_midi = lowest_note_midi + n_octaves * 12
+        num_frames = cqt_utils.frame_count(render_info["raw_length"], hop_length)
         # https://librosa.github.io/librosa/generated/librosa.core.cqt.html
-        C = cqt(
-            wave_data,
-            sr=sr,
-            fmin=lowest_note_hz,
-            n_bins=n_bins,
-            bins_per_octave=bins_per_octave,
-            hop_length=hop_length,
-            filter_scale=1.0,
-            #sparsity=0.0,
-            tuning=0.0,     # we don't want automatic tuning estimation
-        )
-
-        mag = np.abs(C).astype(np.float32)
+        feature_params = {
+            "sr": sr,
+            "fmin": lowest_note_hz,
+            "n_bins": n_bins,
+            "bins_per_octave": bins_per_octave,
+            "hop_length": hop_length,
+            "filter_scale": 1.0,
+            #"sparsity": 0.0,
+            "tuning": 0.0,     # we don't want automatic tuning estimation
+        }
+    elif features == "filterbank":
+        if block_frames is not None:
+            raise ValueError("Streaming in blocks is only supported for CQT features")
+        # one resonator per piano key, one frame per chunk, see filterbank.py
+        bins_per_note = 1
+        bins_per_octave = 12
+        hop_length = filterbank.CHUNK_SIZE
+        lowest_note_midi = filterbank.MIN_MIDI_KEY
+        highest_note_midi = filterbank.MAX_MIDI_KEY + 1
+        lowest_note_hz = float(filterbank.midi_key_to_freq(lowest_note_midi))
+        # one frame per (possibly partial) chunk
+        num_frames = groundtruth_utils.covering_frames(render_info["raw_length"], hop_length)
+        feature_params = {
+            "sr": sr,
+            "min_key": filterbank.MIN_MIDI_KEY,
+            "max_key": filterbank.MAX_MIDI_KEY,
+            "r": filterbank.R,
+            "chunk_size": hop_length,
+        }
+    else:
+        raise ValueError("Unknown features: {} (available: {})".format(features, ", ".join(FEATURES)))
+    label_params = {
+        "labels": labels,
+        "raw_length": render_info["raw_length"],
+        "sample_rate": sr,
+        "lowest_note": lowest_note_midi,
+        "highest_note": highest_note_midi,
+        "hop_length": hop_length,
+        "bins_per_note": bins_per_note,
+        # as many frames as the features
+        "num_frames": num_frames,
+    }
+    path_X = "{}_X.npy".format(base_path)
+    path_Y = "{}_Y.npy".format(base_path)
+    path_labels = "{}_labels.npz".format(base_path)
+
+    # Datasets in a corpus are tied to it
+    destination = corpus.root if corpus is not None else None
+    features_key = stage_key({features: feature_params, "x_encoding": x_encoding, "corpus": destination},
+                             wave=render_info["wave_sha1"])
+    labels_key = stage_key(dict(label_params, corpus=destination), midi=midi_hash)
+    features_current = manifest.is_current("features", features_key)
+    # A corpus shard is written as a whole, with its labels
+    labels_current = manifest.is_current("labels", labels_key) and (features_current or corpus is None)
+
+    C = None
+    if not features_current:
+        print("Transforming data")
+        wave = get_wave_data()
+        if features == "cqt":
+            with instrumentation.span("cqt", streaming=block_frames is not None,
+                                      cached=feature_cache is not None) as s:
+                if block_frames is None:
+                    C = cached_cqt(wave, feature_cache, with_phase=True, **feature_params)
+                    mag = np.abs(C).astype(np.float32)
+                else:
+                    # Stream the magnitudes straight into the output file, so that
+                    # memory does not depend on the recording length. The complex
+                    # spectrogram is not kept in this mode.
+                    mag = cqt_utils.stream_cqt_magnitudes_to_npy(
+                        wave, path_X, block_frames=block_frames, **feature_params)
+                s.set(audio_s=len(wave) / sr, shape=mag.shape, mb=mag.nbytes / 1e6)
+        else:
+            with instrumentation.span("filterbank", threads=feature_threads) as s:
+                mag = filterbank.process_ensemble(
+                    wave, chunk_size=hop_length, min_key=feature_params["min_key"],
+                    max_key=feature_params["max_key"], r=feature_params["r"], sample_rate=sr,
+                    num_threads=feature_threads)
+                s.set(audio_s=len(wave) / sr, shape=mag.shape, mb=mag.nbytes / 1e6)
 
         # 16th notes at 200 bpm are 800 notes/min = 13.3 notes/sec => note duration = 75 ms
         print("Sample rate: {}".format(sr))
         print("Hop duration: {:.1f} ms".format(hop_length / sr * 1000))
-        print("Length audio: {:.1f} sec".format(len(wave_data) / sr))
+        print("Length audio: {:.1f} sec".format(len(wave) / sr))
         print("Shape audio:       {} [{}, {:.1f} MB]".format(
-            wave_data.shape, wave_data.dtype, wave_data.nbytes / 1e6))
+            wave.shape, wave.dtype, wave.nbytes / 1e6))
         print("Shape transformed: {} [{}, {:.1f} MB]".format(
             mag.shape, mag.dtype, mag.nbytes / 1e6))
+        del wave
 
+    if not labels_current:
         # Groundtruth extraction with same shape
-        groundtruth = mfw.extract_groundtruth(
-            raw_length=len(wave_data),
-            sample_rate=sr,
-            lowest_note=lowest_note_midi,
-            highest_note=lowest_note_midi + n_octaves * 12,
-            hop_length=hop_length,
-            bins_per_note=4,
-        )
-
+        with instrumentation.span("groundtruth", num_notes=len(mfw.notes), labels=labels):
+            extract = mfw.extract_note_events if labels == "events" else mfw.extract_groundtruth
+            groundtruth = extract(
+                raw_length=label_params["raw_length"],
+                sample_rate=sr,
+                lowest_note=label_params["lowest_note"],
+                highest_note=label_params["highest_note"],
+                hop_length=hop_length,
+                bins_per_note=bins_per_note,
+                num_frames=num_frames,
+            )
+
+    if not (features_current and labels_current):
         print("Storing dataset")
-        path_X = "{}_X.npy".format(base_path)
-        path_Y = "{}_Y.npy".format(base_path)
-        np.save(path_X, mag)
-        np.save(path_Y, groundtruth)
-
-        print("Generating plots")
-        plot_dataset(C, groundtruth, base_path, sr, lowest_note_hz, hop_length, bins_per_octave, interactive_plots)
-
+    if not features_current:
+        with instrumentation.span("save", corpus=corpus is not None, x_encoding=x_encoding) as s:
+            codec = FeatureCodec.fit(mag, x_encoding)
+            if x_encoding != "float32":
+                report = codec.error_report(mag)
+                print("Feature encoding {encoding}: max abs error = {max_abs_error:.3g}, "
+                      "max rel error = {max_rel_error:.3g} (bound {rel_error_bound:.3g})".format(**report))
+                s.set(**report)
+            if corpus is not None:
+                shard = corpus.append(codec.encode(mag), groundtruth, name=os.path.basename(base_path),
+                                      params=feature_params, x_dtype=codec.dtype, x_encoding=codec.to_dict(),
+                                      replace=replace_shard)
+                features_files = [os.path.join(corpus.root, shard["x_path"])]
+                labels_files = [os.path.join(corpus.root, shard["y_path"])]
+            else:
+                save_features(path_X, mag, codec)
+                features_files = [path_X] + ([codec_path(path_X)] if x_encoding != "float32" else [])
+        manifest.complete("features", features_key, files=features_files, bins_per_note=bins_per_note)
+        redone.append("features")
+
+    if not labels_current:
+        if corpus is None:
+            with instrumentation.span("save", labels=labels):
+                # the loader prefers sparse labels, so labels of the other kind must go
+                path_labels, path_stale = (path_labels, path_Y) if labels == "events" else (path_Y, path_labels)
+                if labels == "events":
+                    groundtruth.save(path_labels)
+                else:
+                    np.save(path_labels, groundtruth)
+                if os.path.exists(path_stale):
+                    os.remove(path_stale)
+            labels_files = [path_labels]
+        elif features_current:
+            with instrumentation.span("save", corpus=True, labels=labels):
+                shard = corpus.replace_labels(groundtruth, name=os.path.basename(base_path))
+            labels_files = [os.path.join(corpus.root, shard["y_path"])]
+        manifest.complete("labels", labels_key, files=labels_files)
+        redone.append("labels")
+
+    if plotter is not None:
+        plots_key = stage_key(
+            {"max_preview_frames": plotter.max_preview_frames, "hist_samples": plotter.hist_samples},
+            features=features_key, labels=labels_key)
+        if not manifest.is_current("plots", plots_key):
+            print("Generating plots")
+            if features_current:
+                # Only magnitudes are stored, so there is no rainbow plot
+                mag = _load_stored_features(base_path, corpus)
+            if labels_current:
+                groundtruth = _load_stored_labels(base_path, corpus, labels)
+            if isinstance(groundtruth, groundtruth_utils.NoteEvents):
+                groundtruth = groundtruth.to_dense(np.float32)
+            files = plot_files(base_path, with_phase=C is not None)
+            # with an asynchronous plotter this only covers the submission
+            with instrumentation.span("plot", plotter=type(plotter).__name__):
+                plotter.plot(C if C is not None else mag, groundtruth, base_path, sr, lowest_note_hz, hop_length,
+                             bins_per_octave, interactive_plots,
+                             on_done=lambda: manifest.complete("plots", plots_key, files=files))
+            redone.append("plots")
+
+    if corpus is not None and not features_current and block_frames is not None:
+        # the streamed magnitudes only served as staging for the corpus
+        # (an asynchronous plotter has its own copy)
+        del mag
+        os.remove(path_X)
+
+    if not redone:
+        print("Dataset {} is up to date".format(base_path))
+
+    return redone
+
+
+def init_worker():
+    global _worker_tmp_dir
+    _worker_tmp_dir = tempfile.mkdtemp(prefix="datagen_{}_".format(os.getpid()))
+    multiprocessing.util.Finalize(None, shutil.rmtree, args=(_worker_tmp_dir, True), exitpriority=10)
+    # Workers only write plot files, never open windows.
+    use_agg_backend()
+
+
+def seed_rngs(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def run_tasks(func, tasks, num_workers=None):
+    """
+    Runs `func` for each task on a process pool. `num_workers=1` runs
+    the tasks serially in the current process (useful for debugging).
+    """
+    tasks = list(tasks)
+    if num_workers == 1:
+        return [func(task) for task in tasks]
+
+    # Unlike multiprocessing.Pool, the workers of a ProcessPoolExecutor are
+    # not daemonic, so they can run their own plot pools.
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker) as executor:
+        return list(executor.map(func, tasks))
+
+
+def get_plotter(plots="sync", plot_workers=1):
+    """
+    Plotter for a plot mode: "sync" plots in the generating process,
+    "async" on a background pool shared by all datasets of this process,
+    and "none" disables plotting.
+    """
+    global _plot_pool
+    if plots == "none":
+        return None
+    elif plots == "sync":
+        return SyncPlotter()
+    elif plots == "async":
+        if _plot_pool is None:
+            _plot_pool = PlotPool(plot_workers)
+        return _plot_pool
     else:
-        np.save("wavedata.npy", data)
-        os.system("nim -r c ./src/process_wave_data wavedata.npy")
-        data = np.load("wavedata_preprocessed.npy")
-        data = data[::-1, :]
-
-        fig, ax = plt.subplots(1, 1, figsize=(16, 10))
-        plt.subplots_adjust(left=0.05, bottom=0.05, top=0.95, right=0.95)
-        plt.imshow(data, aspect='auto')
-        plt.show()
-
-
-def plot_dataset(C, groundtruth, base_path, sr, lowest_note_hz, hop_length, bins_per_octave, interactive_plots):
-    mag = np.abs(C)
-    db = librosa.amplitude_to_db(mag, ref=np.max)
-
-    def raw_plot(data, filename, cmap=None):
-        dpi = 72
-        height, width = np.array(data.shape, dtype=float) / dpi
-
-        fig = plt.figure(figsize=(width, height), dpi=dpi)
-        ax = fig.add_axes([0, 0, 1, 1])
-        ax.axis('off')
+        raise ValueError("Unknown plot mode: {}".format(plots))
+
+
+def close_plotter():
+    global _plot_pool
+    if _plot_pool is not None:
+        _plot_pool.close()
+        _plot_pool = None
+
+
+def dataset_kwargs(renderer=DEFAULT_RENDERER, corpus=None, block_frames=None, feature_cache=None, plots="sync",
+                   plot_workers=1, labels="events", x_encoding="float32", force=False, features="cqt",
+                   feature_threads=1):
+    """
+    Builds the `generate_dataset` arguments from plain (picklable) options,
+    so that renderers and corpus writers are created inside the workers.
+    """
+    return {
+        "renderer": make_renderer(renderer),
+        "corpus": CorpusWriter(corpus) if corpus is not None else None,
+        "block_frames": block_frames,
+        "feature_cache": FeatureCache(feature_cache) if feature_cache is not None else None,
+        "plotter": get_plotter(plots, plot_workers),
+        "labels": labels,
+        "x_encoding": x_encoding,
+        "force": force,
+        "features": features,
+        "feature_threads": feature_threads,
+    }
+
+
+def _generate_corpus_item(task):
+    index, seed, output_path, generator, options = task
+    seed_rngs(seed)
+    mfw = RANDOM_GENERATORS[generator]()
+    generate_dataset(mfw, output_path, audio_preview=False,
+                     dataset_info={"seed": seed, "generator": generator}, **dataset_kwargs(**options))
+    return output_path
+
+
+def generate_corpus(num_datasets, output_dir, num_workers=None, base_seed=0, first_index=1,
+                    generator="random_single_notes", **options):
+    """
+    Generates `num_datasets` datasets in parallel, with the note generator
+    `RANDOM_GENERATORS[generator]`. Dataset `i` is seeded with
+    `base_seed + i` and written to `<output_dir>/dataset_<i>`, so the output
+    is independent of the number of workers. `options` are passed to
+    `dataset_kwargs`; with `corpus=<root>`, features and labels are appended
+    as shards to that corpus instead of being stored as loose
+    `_X.npy`/`_Y.npy` pairs.
+    """
+    tasks = [
+        (i, base_seed + i, os.path.join(output_dir, "dataset_{:03d}".format(i)), generator, options)
+        for i in range(first_index, first_index + num_datasets)
+    ]
+    return run_tasks(_generate_corpus_item, tasks, num_workers)
 
-        if cmap is None:
-            cmap = librosa.display.cmap(data)
 
-        ax.imshow(data[::-1, :], interpolation='none', cmap=cmap)
-        fig.savefig(filename, dpi=dpi)
-        plt.close(fig)
+def _instrument_check_item(task):
+    program_code, program_name, options = task
+    output_path = utils.path_rel_to_base(
+        "data", "instrument_checks", "{}_{}".format(program_code, program_name)
+    )
+    mfw = generate_midi_instrument_check(program_code)
+    generate_dataset(mfw, output_path, audio_preview=False,
+                     dataset_info={"generator": "instrument_check", "program": program_code},
+                     **dataset_kwargs(**options))
+    return output_path
 
-    def plot_with_axis_annotations(data, ax=None, with_color_bar=True):
-        librosa.display.specshow(
-            data,
-            sr=sr,
-            fmin=lowest_note_hz,
-            hop_length=hop_length,
-            bins_per_octave=bins_per_octave,
-            x_axis='time',
-            y_axis='cqt_note',
-            ax=ax,
-        )
 
-    raw_plot(
-        groundtruth,
-        "{}_0_gt.png".format(base_path))
-
-    raw_plot(
-        db,
-        "{}_1_db.png".format(base_path))
-
-    raw_plot(
-        db[:, 1:] - db[:, :-1],
-        "{}_delta_t.png".format(base_path), cmap="magma")
-
-    raw_plot(
-        db[1:, :] - db[:-1, :],
-        "{}_delta_b.png".format(base_path), cmap="magma")
-
-    # Value distribution
-    fig, axes = plt.subplots(2, 2, figsize=(16, 10))
-
-    data = mag.flatten()
-    axes[0, 0].hist(data, bins=200)
-    values, base = np.histogram(data, bins=200)
-    cumulative = np.cumsum(values)
-    axes[1, 0].plot(base[:-1], cumulative / len(data), c='blue')
-
-    data = db.flatten()
-    axes[0, 1].hist(data, bins=200)
-    values, base = np.histogram(data, bins=200)
-    cumulative = np.cumsum(values)
-    axes[1, 1].plot(base[:-1], cumulative / len(data), c='blue')
-
-    fig.suptitle(
-        "min(mag) = {}    "
-        "max(mag) = {}    "
-        "min(db) = {}    "
-        "max(db) = {}    ".format(mag.min(), mag.max(), db.min(), db.max()))
-    fig.tight_layout()
-    plt.savefig("{}_value_distribution.png".format(base_path))
-    plt.close(fig)
-
-    # Rainbow
-    fig, ax = plt.subplots(1, 1, figsize=(16, 10))
-    rainbow.plot_rainbow(ax, C)
-    fig.tight_layout()
-    plt.savefig("{}_rainbow.png".format(base_path))
-
-    if interactive_plots:
-        fig, axes = plt.subplots(2, 1, figsize=(16, 10), sharex=True, sharey=True)
-        plot_with_axis_annotations(librosa.amplitude_to_db(mag, ref=np.max), axes[0])
-        plot_with_axis_annotations(groundtruth, axes[1])
-
-        # We need to fetch the QuadMesh instance to pass to colorbar
-        plt.colorbar(axes[0].get_children()[0], ax=axes[0], format='%+2.0f dB')
-        plt.colorbar(axes[1].get_children()[0], ax=axes[1])
-        fig.tight_layout()
-
-    if interactive_plots:
-        plt.show()
-
-
-def instrument_checks():
+def instrument_checks(num_workers=None, **options):
     programs = [
         (midi_constants.PIANO, "piano"),
         (midi_constants.EPIANO1, "epiano1"),
@@ -387,20 +955,160 @@ def instrument_checks():
         (midi_constants.OVERDRIVEN_GUITAR, "guitar_overdriven"),
         (midi_constants.DISTORTION_GUITAR, "guitar_distortion"),
     ]
-    for program_code, program_name in programs:
-        output_path = utils.path_rel_to_base(
-            "data", "instrument_checks", "{}_{}".format(program_code, program_name)
-        )
-        mfw = generate_midi_instrument_check(program_code)
-        generate_dataset(mfw, output_path, audio_preview=False)
+    tasks = [(program_code, program_name, options) for program_code, program_name in programs]
+    return run_tasks(_instrument_check_item, tasks, num_workers)
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mode",
+        choices=["gen_data", "gen_corpus", "instrument_check"],
+        default="gen_data",
+        help="What to generate",
+    )
+    parser.add_argument(
+        "--num-datasets",
+        type=int,
+        default=1,
+        help="Number of datasets in gen_corpus mode",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=utils.path_rel_to_base("data", "train"),
+        help="Output directory in gen_corpus mode",
+    )
+    parser.add_argument(
+        "--corpus",
+        default=None,
+        help="Append features to this sharded corpus in gen_corpus mode",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of cores)",
+    )
+    parser.add_argument(
+        "--renderer",
+        choices=sorted(RENDERERS),
+        default=DEFAULT_RENDERER,
+        help="Audio render backend",
+    )
+    parser.add_argument(
+        "--features",
+        choices=FEATURES,
+        default="cqt",
+        help="Features of the datasets: CQT magnitudes, or a two-pole resonator filter bank (see filterbank.py)",
+    )
+    parser.add_argument(
+        "--feature-threads",
+        type=int,
+        default=1,
+        help="Number of threads of the filter bank",
+    )
+    parser.add_argument(
+        "--block-frames",
+        type=int,
+        default=None,
+        help="Compute the CQT in streaming blocks of this many frames",
+    )
+    parser.add_argument(
+        "--feature-cache",
+        default=None,
+        help="Directory of the CQT feature cache",
+    )
+    parser.add_argument(
+        "--plots",
+        choices=["sync", "async", "none"],
+        default="sync",
+        help="Generate diagnostic plots synchronously, on a background pool, or not at all",
+    )
+    parser.add_argument(
+        "--plot-workers",
+        type=int,
+        default=1,
+        help="Number of plot processes per generator process in async mode",
+    )
+    parser.add_argument(
+        "--labels",
+        choices=["events", "dense"],
+        default="events",
+        help="Store the ground truth as sparse note events or as a dense matrix",
+    )
+    parser.add_argument(
+        "--x-encoding",
+        choices=ENCODINGS,
+        default="float32",
+        help="Storage encoding of the CQT magnitudes",
+    )
+    parser.add_argument(
+        "--generator",
+        choices=sorted(RANDOM_GENERATORS),
+        default="random_single_notes",
+        help="Note generator in gen_corpus mode",
+    )
+    parser.add_argument(
+        "--first-index",
+        type=int,
+        default=1,
+        help="Index of the first dataset in gen_corpus mode, e.g. to add datasets to an existing corpus",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Base seed in gen_corpus mode",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Redo all stages, by default only the stages whose inputs changed since the last build are redone",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Append per-stage timing and memory records to this JSON lines file",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Write cProfile stats of this run to this file (profiles the main process only, use --workers 1)",
+    )
+    args = parser.parse_args(args)
+    return args
 
 
-def main():
-    #mode = "instrument_check"
-    mode = "gen_data"
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
 
-    if mode == "instrument_check":
-        instrument_checks()
+    if args.trace is not None:
+        instrumentation.configure(args.trace)
+
+    with instrumentation.profile(args.profile):
+        run(args)
+
+
+def run(args):
+    options = {
+        "renderer": args.renderer,
+        "block_frames": args.block_frames,
+        "feature_cache": args.feature_cache,
+        "plots": args.plots,
+        "plot_workers": args.plot_workers,
+        "labels": args.labels,
+        "x_encoding": args.x_encoding,
+        "force": args.force,
+        "features": args.features,
+        "feature_threads": args.feature_threads,
+    }
+
+    if args.mode == "instrument_check":
+        instrument_checks(args.workers, **options)
+
+    elif args.mode == "gen_corpus":
+        generate_corpus(args.num_datasets, args.output_dir, args.workers, args.seed, first_index=args.first_index,
+                        generator=args.generator, corpus=args.corpus, **options)
 
     else:
         output_path = utils.path_rel_to_base("data", "train", "dataset_001")
@@ -408,7 +1116,10 @@ def main():
         #midi_file = generate_midi_chromatic_sweep()
         midi_file = generate_midi_random_single_notes()
 
-        generate_dataset(midi_file, output_path, audio_preview=False)
+        generate_dataset(midi_file, output_path, audio_preview=False, **dataset_kwargs(**options))
+
+    close_plotter()
+    close_render_workers()
 
 
 if __name__ == "__main__":
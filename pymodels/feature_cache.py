@@ -0,0 +1,144 @@
+"""
+Content-addressed on-disk cache for CQT features.
+
+Entries are keyed by a hash of the waveform bytes and the transform
+parameters, so re-running a transform on unchanged audio is a file read.
+The cache directory is bounded in size; the least recently used entries are
+evicted first.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+
+import cqt as cqt_utils
+import utils
+
+
+CACHE_VERSION = 1
+
+
+class FeatureCache(object):
+    def __init__(self, root, max_bytes=10 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        utils.mkdir(root)
+
+    @staticmethod
+    def key(y, params):
+        import librosa
+
+        y = np.ascontiguousarray(y)
+        h = hashlib.sha1()
+        h.update(json.dumps({
+            "version": CACHE_VERSION,
+            "librosa": librosa.__version__,
+            "dtype": y.dtype.str,
+            "shape": y.shape,
+            "params": params,
+        }, sort_keys=True).encode("utf-8"))
+        h.update(memoryview(y.reshape(-1).view(np.uint8)))
+        return h.hexdigest()
+
+    def _path(self, key, kind):
+        return os.path.join(self.root, "{}_{}.npy".format(key, kind))
+
+    def get(self, key, kind):
+        path = self._path(key, kind)
+        try:
+            data = np.load(path)
+        except (IOError, OSError, ValueError):
+            return None
+        # Mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, kind, data):
+        path = self._path(key, kind)
+        path_tmp = "{}.tmp{}".format(path, os.getpid())
+        with open(path_tmp, "wb") as f:
+            np.save(f, data)
+        os.rename(path_tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed concurrently
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def default_tuning():
+    # Depends on the librosa version (0.0 in recent versions, None before).
+    # Looked up on use, as it loads librosa's core.
+    import librosa
+    return inspect.signature(librosa.cqt).parameters["tuning"].default
+
+
+def _engine(y, params):
+    import librosa
+
+    if "tuning" not in params:
+        params = dict(params, tuning=default_tuning())
+    if params["tuning"] is None:
+        # like librosa.cqt, estimate the tuning
+        params = dict(params, tuning=float(librosa.estimate_tuning(
+            y=y, sr=params.get("sr", 22050), bins_per_octave=params.get("bins_per_octave", 12))))
+    return cqt_utils.get_engine(**params)
+
+
+def cached_cqt(y, cache=None, with_phase=False, **params):
+    """
+    CQT of `y` through the cache, computed with the shared `CQTEngine` for
+    `params` (same arguments as `librosa.cqt`). Returns the complex
+    spectrogram if `with_phase` is set, otherwise only the float32
+    magnitudes. Without a cache the transform is computed directly.
+    """
+    if cache is None:
+        C = _engine(y, params).transform(y)
+        return C if with_phase else np.abs(C).astype(np.float32)
+
+    key = FeatureCache.key(y, params)
+    mag = cache.get(key, "mag")
+    phase = cache.get(key, "phase") if with_phase and mag is not None else None
+
+    if mag is None or (with_phase and phase is None):
+        C = _engine(y, params).transform(y)
+        mag = np.abs(C).astype(np.float32)
+        cache.put(key, "mag", mag)
+        if with_phase:
+            cache.put(key, "phase", np.angle(C).astype(np.float32))
+            return C
+        return mag
+
+    if with_phase:
+        # the dtype of the engine's transform
+        return (mag * np.exp(1j * phase)).astype(np.complex64, copy=False)
+    return mag
@@ -0,0 +1,180 @@
+"""
+Storage encodings of CQT magnitudes.
+
+- "float32": raw magnitudes
+- "float16": half precision, relative error below 2**-11
+- "db8", "db16": log magnitudes quantized to uint8/uint16 codes over a
+  fixed dynamic range below the maximum of the data, `dB = code * scale +
+  offset`. Magnitudes below the range map to code 0.
+
+The parameters of an encoding are stored next to the features (in
+`<base>_X.json`, or in the shard entry of a corpus), and decoding happens
+when frames are read, through a lookup table for the integer codes.
+"""
+
+from __future__ import division, print_function
+
+import json
+import os
+
+import numpy as np
+
+
+ENCODINGS = ["float32", "float16", "db8", "db16"]
+
+STORAGE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "db8": np.uint8,
+    "db16": np.uint16,
+}
+
+DEFAULT_DYNAMIC_RANGE_DB = {
+    "db8": 80.0,
+    "db16": 120.0,
+}
+
+
+class FeatureCodec(object):
+    def __init__(self, encoding="float32", scale=None, offset=None):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown feature encoding: {} (available: {})".format(encoding, ", ".join(ENCODINGS)))
+        self.encoding = encoding
+        self.scale = scale
+        self.offset = offset
+        self.dtype = np.dtype(STORAGE_DTYPES[encoding])
+        self._table = None
+
+    @property
+    def quantized(self):
+        return self.encoding in DEFAULT_DYNAMIC_RANGE_DB
+
+    @classmethod
+    def fit(cls, mag, encoding, dynamic_range_db=None, block_frames=4096):
+        """
+        Codec for the magnitudes `mag` of shape (bins, frames). For the
+        quantized encodings the range spans `dynamic_range_db` below the
+        maximum of `mag`.
+        """
+        if encoding not in DEFAULT_DYNAMIC_RANGE_DB:
+            return cls(encoding)
+        if dynamic_range_db is None:
+            dynamic_range_db = DEFAULT_DYNAMIC_RANGE_DB[encoding]
+        # block-wise, `mag` may be memory-mapped
+        peak = max([float(np.max(mag[:, i:i+block_frames])) for i in range(0, mag.shape[1], block_frames)] + [0.0])
+        top_db = 20 * np.log10(max(peak, 1e-10))
+        num_codes = np.iinfo(STORAGE_DTYPES[encoding]).max
+        return cls(encoding, scale=dynamic_range_db / num_codes, offset=top_db - dynamic_range_db)
+
+    def to_dict(self):
+        return {"encoding": self.encoding, "scale": self.scale, "offset": self.offset}
+
+    @classmethod
+    def from_dict(cls, d):
+        if d is None:
+            return cls()
+        return cls(d["encoding"], d.get("scale"), d.get("offset"))
+
+    def encode(self, mag):
+        if not self.quantized:
+            return np.asarray(mag).astype(self.dtype)
+        db = 20 * np.log10(np.maximum(np.asarray(mag, dtype=np.float64), 1e-10))
+        codes = np.rint((db - self.offset) / self.scale)
+        return np.clip(codes, 0, np.iinfo(self.dtype).max).astype(self.dtype)
+
+    def table(self):
+        """
+        Magnitude of every code. Code 0 stands for everything below the
+        range and decodes to 0.
+        """
+        if self._table is None:
+            codes = np.arange(np.iinfo(self.dtype).max + 1, dtype=np.float64)
+            table = 10 ** ((codes * self.scale + self.offset) / 20)
+            table[0] = 0
+            self._table = table.astype(np.float32)
+        return self._table
+
+    def decode(self, data, dtype=np.float32):
+        if not self.quantized:
+            return np.asarray(data).astype(dtype)
+        return self.table()[data].astype(dtype, copy=False)
+
+    def error_report(self, mag, max_values=10**7):
+        """
+        Round-trip error of the encoding on `mag`, estimated on a fixed
+        subsample of at most `max_values` values: maximum absolute error,
+        and maximum relative error of the values within the range along with
+        its theoretical bound.
+        """
+        mag = np.asarray(mag).ravel()
+        if len(mag) > max_values:
+            mag = mag[np.random.RandomState(0).randint(0, len(mag), max_values)]
+        mag = mag.astype(np.float32)
+        decoded = self.decode(self.encode(mag))
+        error = np.abs(decoded - mag)
+
+        if self.quantized:
+            in_range = mag >= 10 ** ((self.offset + self.scale / 2) / 20)
+            # half a step, plus the rounding of the float32 table
+            bound = 10 ** (self.scale / 40) - 1 + np.finfo(np.float32).eps
+        elif self.encoding == "float16":
+            in_range = mag >= np.finfo(np.float16).tiny
+            bound = 2.0 ** -11
+        else:
+            in_range = np.ones(len(mag), dtype=bool)
+            bound = 0.0
+
+        rel_error = error[in_range] / mag[in_range]
+        return {
+            "encoding": self.encoding,
+            "bytes_per_value": self.dtype.itemsize,
+            "max_abs_error": float(error.max()) if len(error) > 0 else 0.0,
+            "max_rel_error": float(rel_error.max()) if len(rel_error) > 0 else 0.0,
+            "rel_error_bound": float(bound),
+            "fraction_in_range": float(in_range.mean()) if len(in_range) > 0 else 1.0,
+        }
+
+
+def codec_path(path_X):
+    return "{}.json".format(os.path.splitext(path_X)[0])
+
+
+def save_features(path_X, mag, codec, block_frames=4096):
+    """
+    Encodes the magnitudes `mag` (bins, frames) into `path_X` block by block
+    and writes the parameters of the codec next to it. `path_X` may be the
+    file `mag` is memory-mapped from.
+    """
+    if codec.encoding == "float32" and isinstance(mag, np.memmap) and os.path.abspath(mag.filename) == \
+            os.path.abspath(path_X):
+        encoded = mag
+    else:
+        path_tmp = "{}.tmp{}".format(path_X, os.getpid())
+        encoded = np.lib.format.open_memmap(path_tmp, mode="w+", dtype=codec.dtype, shape=mag.shape)
+        for i in range(0, mag.shape[1], block_frames):
+            encoded[:, i:i+block_frames] = codec.encode(mag[:, i:i+block_frames])
+        encoded.flush()
+        del encoded
+        os.rename(path_tmp, path_X)
+
+    if codec.encoding == "float32":
+        if os.path.exists(codec_path(path_X)):
+            os.remove(codec_path(path_X))
+    else:
+        with open(codec_path(path_X), "w") as f:
+            json.dump(codec.to_dict(), f)
+
+
+def load_codec(path_X):
+    path = codec_path(path_X)
+    if not os.path.exists(path):
+        return FeatureCodec()
+    with open(path) as f:
+        return FeatureCodec.from_dict(json.load(f))
+
+
+def load_features(path_X):
+    """
+    Memory-mapped encoded features and their codec.
+    """
+    return np.load(path_X, mmap_mode="r"), load_codec(path_X)
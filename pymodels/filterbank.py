@@ -0,0 +1,185 @@
+"""
+Two-pole resonator filter bank features.
+
+Python port of `processEnsemble` (src/train_cnn.nim): every piano key
+(MIDI 21 to 108) has a two-pole resonator tuned with `twoPoleSearchPeak`
+(src/filters.nim), i.e. with a peak gain of 1 at the key frequency. The
+filtered signals are pooled into RMS values over chunks of `chunk_size`
+samples (`rmsChunks`, the last chunk may be shorter), and each key is
+normalized to a maximum of 1.
+
+Like the Nim code, the filters are designed and run in float32, and the
+RMS sums are accumulated in float64. The designed coefficients are
+identical to the Nim ones. lfilter sums the terms of the recursion in a
+different order than `TwoPole.process`, so the features agree up to float32
+rounding, which the narrow resonators of the lowest keys amplify (relative
+differences of about 1e-3 there, 1e-5 for the upper keys; both are that
+far from a float64 reference). The filters of all keys run over the
+audio held in memory, one `scipy.signal.lfilter` call per key, optionally
+on a thread pool (lfilter releases the GIL). The result has one row per key
+and one column per chunk, i.e. with `chunk_size=512` it aligns with the
+ground truth at hop length 512.
+"""
+
+from __future__ import division, print_function
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# scipy.signal is only imported to run the filters, it takes a second to load
+
+
+SAMPLE_RATE = 44100
+
+MIN_MIDI_KEY = 21
+MAX_MIDI_KEY = 108
+R = 0.999
+CHUNK_SIZE = 512
+
+GOLDEN_RATIO = (np.sqrt(5.0) + 1) / 2
+
+# Designed ensembles, see design_ensemble
+_ensembles = {}
+
+
+def midi_key_to_freq(key):
+    return 440.0 * 2.0 ** ((np.asarray(key, dtype=np.float64) - 69) / 12)
+
+
+def golden_section_search(f, a, b, tol=1e-5):
+    """
+    Minima of `f` on the intervals [a, b], elementwise for arrays `a` and
+    `b`. `f` is called with an array of shape (2,) + a.shape, holding both
+    probe points of every interval. Each element takes the same steps as
+    the scalar `goldenSectionSearch` of src/filters.nim.
+    """
+    a = np.array(a, dtype=np.float64, ndmin=1)
+    b = np.array(b, dtype=np.float64, ndmin=1)
+    c = b - (b - a) / GOLDEN_RATIO
+    d = a + (b - a) / GOLDEN_RATIO
+    active = np.abs(c - d) > tol
+    while active.any():
+        fc, fd = f(np.stack([c, d]))
+        left = fc < fd
+        b = np.where(active & left, d, b)
+        a = np.where(active & ~left, c, a)
+        c = b - (b - a) / GOLDEN_RATIO
+        d = a + (b - a) / GOLDEN_RATIO
+        active &= np.abs(c - d) > tol
+    return (b + a) / 2
+
+
+def two_pole(freq, r, b0=1.0, sample_rate=SAMPLE_RATE):
+    """
+    Coefficients (b0, a1, a2) of two-pole resonators at `freq`, as float32.
+    """
+    theta_c = 2 * np.pi * np.asarray(freq, dtype=np.float64) * (1.0 / sample_rate)
+    a1 = (-2 * r * np.cos(theta_c)).astype(np.float32)
+    a2 = np.full_like(a1, r ** 2)
+    b0 = np.broadcast_to(np.asarray(b0, dtype=np.float64).astype(np.float32), a1.shape)
+    return b0, a1, a2
+
+
+def response_magnitude(b0, a1, a2, freq, sample_rate=SAMPLE_RATE):
+    """
+    |H(freq)| of two-pole resonators, with the float32 complex arithmetic
+    of `response` in src/filters.nim (Smith's division, as Nim's complex
+    module).
+    """
+    omega_t = (2 * np.pi * np.asarray(freq, dtype=np.float64)).astype(np.float32) * np.float32(1.0 / sample_rate)
+    theta1 = -omega_t
+    theta2 = -(np.float32(2) * (2 * np.pi * np.asarray(freq, dtype=np.float64)).astype(np.float32)) * \
+        np.float32(1.0 / sample_rate)
+    re = np.float32(1) + a1 * np.cos(theta1) + a2 * np.cos(theta2)
+    im = a1 * np.sin(theta1) + a2 * np.sin(theta2)
+
+    # b0 / (re + i im)
+    small_re = np.abs(re) < np.abs(im)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = np.where(small_re, re / im, im / re)
+        den = np.where(small_re, im + r * re, re + r * im)
+        h_re = np.where(small_re, b0 * r, b0) / den
+        h_im = np.where(small_re, -b0, -r * b0) / den
+    return np.hypot(h_re, h_im)
+
+
+def search_peak_freq(b0, a1, a2, sample_rate=SAMPLE_RATE):
+    """
+    Frequencies of maximum gain of two-pole resonators (`searchPeakFreq`).
+    """
+    def f(freq):
+        return -response_magnitude(b0, a1, a2, freq, sample_rate).astype(np.float64)
+    shape = np.shape(a1)
+    return golden_section_search(f, np.zeros(shape), np.full(shape, sample_rate / 2))
+
+
+def two_pole_search_peak(peak_freq, r, sample_rate=SAMPLE_RATE):
+    """
+    Two-pole resonators with a gain of 1 at their peak `peak_freq`
+    (`twoPoleSearchPeak`), for an array of peak frequencies.
+    """
+    peak_freq = np.array(peak_freq, dtype=np.float64, ndmin=1)
+
+    def f(freq):
+        return np.abs(search_peak_freq(*two_pole(freq, r, sample_rate=sample_rate), sample_rate=sample_rate) -
+                      peak_freq)
+
+    resonant_freq = golden_section_search(
+        f, np.zeros(peak_freq.shape), np.full(peak_freq.shape, sample_rate / 2))
+    max_amplitude = response_magnitude(*two_pole(resonant_freq, r, sample_rate=sample_rate), freq=peak_freq,
+                                       sample_rate=sample_rate)
+    return two_pole(resonant_freq, r, np.float32(1) / max_amplitude, sample_rate=sample_rate)
+
+
+def design_ensemble(min_key=MIN_MIDI_KEY, max_key=MAX_MIDI_KEY, r=R, sample_rate=SAMPLE_RATE):
+    """
+    Coefficients (b0, a1, a2) of the resonators of the keys `min_key` to
+    `max_key`, each of shape (num_keys,). Designs are cached per process.
+    """
+    params = (min_key, max_key, r, sample_rate)
+    if params not in _ensembles:
+        keys = np.arange(min_key, max_key + 1)
+        _ensembles[params] = two_pole_search_peak(midi_key_to_freq(keys), r, sample_rate)
+    return _ensembles[params]
+
+
+def rms_chunks(y, chunk_size=CHUNK_SIZE):
+    """
+    RMS of the chunks of `y` (`rmsChunks`): squares in the dtype of `y`,
+    sums in float64, result in float32.
+    """
+    starts = np.arange(0, len(y), chunk_size)
+    lengths = np.minimum(starts + chunk_size, len(y)) - starts
+    sums = np.add.reduceat(y * y, starts, dtype=np.float64)
+    return np.sqrt(sums / lengths).astype(np.float32)
+
+
+def process_ensemble(audio, chunk_size=CHUNK_SIZE, min_key=MIN_MIDI_KEY, max_key=MAX_MIDI_KEY, r=R,
+                     sample_rate=SAMPLE_RATE, num_threads=1):
+    """
+    Filter bank features of `audio`, float32 of shape
+    (max_key - min_key + 1, ceil(len(audio) / chunk_size)).
+    """
+    import scipy.signal
+
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    b0, a1, a2 = design_ensemble(min_key, max_key, r, sample_rate)
+    num_chunks = -(-len(audio) // chunk_size)
+    result = np.zeros((len(b0), num_chunks), dtype=np.float32)
+    if num_chunks == 0:
+        return result
+
+    def process_key(i):
+        y = scipy.signal.lfilter(b0[i:i+1], np.array([1, a1[i], a2[i]], dtype=np.float32), audio)
+        row = rms_chunks(y, chunk_size)
+        peak = row.max()
+        result[i] = row / peak if peak > 0 else row
+
+    if num_threads == 1:
+        for i in range(len(b0)):
+            process_key(i)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(process_key, range(len(b0))))
+    return result
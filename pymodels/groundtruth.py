@@ -0,0 +1,247 @@
+"""
+Frame-rate ground truth from note intervals
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+
+def covering_frames(raw_length, hop_length):
+    """
+    Number of hops needed to cover `raw_length` samples.
+    """
+    return (raw_length + hop_length - 1) // hop_length
+
+
+def frame_boundaries(raw_length, hop_length, num_frames=None):
+    """
+    Sample indices delimiting the hops, i.e. frame `i` covers the samples
+    `bounds[i]:bounds[i+1]`. The last frame may be shorter than a hop.
+    `num_frames` defaults to the frames that cover the samples; frames past
+    the end (e.g. the last frame of a centered transform, see
+    `cqt.frame_count`) cover no samples.
+    """
+    if num_frames is None:
+        num_frames = covering_frames(raw_length, hop_length)
+    bounds = np.arange(num_frames + 1, dtype=np.int64) * hop_length
+    return np.minimum(bounds, raw_length)
+
+
+def _frame_fractions(covered, frame_lengths):
+    # frames past the end of the samples have no length and no coverage
+    return covered / np.maximum(frame_lengths, 1)
+
+
+def merge_intervals(starts, ends):
+    """
+    Merges overlapping `[start, end)` intervals into a sorted list of
+    disjoint intervals.
+    """
+    order = np.argsort(starts, kind="mergesort")
+    starts = starts[order]
+    ends = ends[order]
+
+    reach = np.maximum.accumulate(ends)
+    is_new = np.ones(len(starts), dtype=bool)
+    is_new[1:] = starts[1:] > reach[:-1]
+
+    first = np.flatnonzero(is_new)
+    last = np.append(first[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+
+def covered_before(bounds, starts, ends):
+    """
+    For each boundary `b`, the number of samples `< b` covered by the
+    disjoint, sorted intervals.
+    """
+    lengths = ends - starts
+    cum_lengths = np.concatenate([[0], np.cumsum(lengths)])
+
+    k = np.searchsorted(starts, bounds, side="right") - 1
+    k_valid = np.maximum(k, 0)
+    partial = np.minimum(bounds - starts[k_valid], lengths[k_valid])
+    return np.where(k >= 0, cum_lengths[k_valid] + partial, 0)
+
+
+def interval_coverage(rows, starts, ends, num_rows, raw_length, hop_length, num_frames=None):
+    """
+    Computes the fraction of each hop that is covered by the union of the
+    `[start, end)` sample intervals of each row, for `num_frames` frames
+    (see `frame_boundaries`).
+
+    This is equivalent to rasterizing the intervals at sample rate and
+    averaging every `hop_length` samples, and gives the same float64 values,
+    but memory is only O(num_rows * num_frames).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, raw_length)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, raw_length)
+
+    bounds = frame_boundaries(raw_length, hop_length, num_frames)
+    frame_lengths = np.diff(bounds)
+
+    coverage = np.zeros((num_rows, len(frame_lengths)))
+
+    non_empty = ends > starts
+    rows = rows[non_empty]
+    starts = starts[non_empty]
+    ends = ends[non_empty]
+
+    order = np.argsort(rows, kind="mergesort")
+    rows = rows[order]
+    starts = starts[order]
+    ends = ends[order]
+
+    unique_rows, row_from = np.unique(rows, return_index=True)
+    row_upto = np.append(row_from[1:], len(rows))
+
+    for row, i, j in zip(unique_rows, row_from, row_upto):
+        merged_starts, merged_ends = merge_intervals(starts[i:j], ends[i:j])
+        covered = np.diff(covered_before(bounds, merged_starts, merged_ends))
+        coverage[row, :] = _frame_fractions(covered.astype(np.float64), frame_lengths)
+
+    return coverage
+
+
+EVENT_DTYPE = np.dtype([
+    ("row", np.int32),
+    ("onset", np.int64),            # first frame
+    ("offset", np.int64),           # last frame (inclusive)
+    ("onset_samples", np.int32),    # samples covered in the first frame
+    ("offset_samples", np.int32),   # samples covered in the last frame, if it is not the first
+])
+
+
+class NoteEvents(object):
+    """
+    Sparse ground truth: one event per merged note interval and row, with
+    its first and last frame and the number of samples it covers in these
+    two edge frames. All frames in between are fully covered.
+
+    Indexing with frames (a slice or an index array) densifies only these
+    frames, like indexing a frame-major `(frames, rows)` coverage matrix,
+    i.e. `events[a:b]` equals `interval_coverage(...)[:, a:b].T`.
+    """
+    def __init__(self, events, num_rows, raw_length, hop_length, num_frames=None):
+        self.events = np.asarray(events, dtype=EVENT_DTYPE)
+        self.num_rows = num_rows
+        self.raw_length = raw_length
+        self.hop_length = hop_length
+        self.frame_lengths = np.diff(frame_boundaries(raw_length, hop_length, num_frames))
+
+    @property
+    def num_frames(self):
+        return len(self.frame_lengths)
+
+    @property
+    def shape(self):
+        return (self.num_frames, self.num_rows)
+
+    def __len__(self):
+        return self.num_frames
+
+    def save(self, path):
+        np.savez(
+            path,
+            events=self.events,
+            header=np.array([self.num_rows, self.raw_length, self.hop_length, self.num_frames], dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            # files without the number of frames have the default
+            header = data["header"].tolist()
+            return cls(data["events"], *header)
+
+    def densify(self, start, stop, dtype=np.float32):
+        """
+        Coverage of the frames `[start, stop)`, shape `(frames, rows)`.
+        """
+        start = max(start, 0)
+        stop = min(stop, self.num_frames)
+        num = max(stop - start, 0)
+        events = self.events[(self.events["onset"] < stop) & (self.events["offset"] >= start)]
+
+        # Fully covered frames via a difference array over the inner frames
+        full = np.zeros((num + 1, self.num_rows), dtype=np.int32)
+        inner_from = np.clip(events["onset"] + 1, start, stop) - start
+        inner_upto = np.clip(events["offset"], start, stop) - start
+        valid = inner_upto > inner_from
+        np.add.at(full, (inner_from[valid], events["row"][valid]), 1)
+        np.add.at(full, (inner_upto[valid], events["row"][valid]), -1)
+        full = np.cumsum(full[:num], axis=0)
+
+        frame_lengths = self.frame_lengths[start:stop, np.newaxis]
+        covered = full.astype(np.int64) * frame_lengths
+
+        # Partially covered edge frames
+        edge = (events["onset"] >= start) & (events["onset"] < stop)
+        np.add.at(covered, (events["onset"][edge] - start, events["row"][edge]), events["onset_samples"][edge])
+        edge = (events["offset"] > events["onset"]) & (events["offset"] >= start) & (events["offset"] < stop)
+        np.add.at(covered, (events["offset"][edge] - start, events["row"][edge]), events["offset_samples"][edge])
+
+        return _frame_fractions(covered, frame_lengths).astype(dtype, copy=False)
+
+    def take(self, frames, dtype=np.float32):
+        """
+        Coverage of arbitrary frames, shape `(len(frames), rows)`.
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        if len(frames) == 0:
+            return np.zeros((0, self.num_rows), dtype=dtype)
+        lo = frames.min()
+        return self.densify(lo, frames.max() + 1, dtype)[frames - lo]
+
+    def __getitem__(self, frames):
+        if isinstance(frames, slice):
+            start, stop, step = frames.indices(self.num_frames)
+            return self.densify(start, stop, np.float64)[::step]
+        return self.take(frames, np.float64)
+
+    def to_dense(self, dtype=np.float64):
+        """
+        Coverage of all frames, shape `(rows, frames)`.
+        """
+        return self.densify(0, self.num_frames, dtype).T
+
+
+def interval_events(rows, starts, ends, num_rows, raw_length, hop_length, num_frames=None):
+    """
+    Sparse equivalent of `interval_coverage` as `NoteEvents`.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, raw_length)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, raw_length)
+
+    non_empty = ends > starts
+    rows = rows[non_empty]
+    starts = starts[non_empty]
+    ends = ends[non_empty]
+
+    order = np.argsort(rows, kind="mergesort")
+    rows = rows[order]
+    starts = starts[order]
+    ends = ends[order]
+
+    unique_rows, row_from = np.unique(rows, return_index=True)
+    row_upto = np.append(row_from[1:], len(rows))
+
+    events = []
+    for row, i, j in zip(unique_rows, row_from, row_upto):
+        merged_starts, merged_ends = merge_intervals(starts[i:j], ends[i:j])
+        row_events = np.empty(len(merged_starts), dtype=EVENT_DTYPE)
+        row_events["row"] = row
+        row_events["onset"] = merged_starts // hop_length
+        row_events["offset"] = (merged_ends - 1) // hop_length
+        single = row_events["onset"] == row_events["offset"]
+        onset_end = np.minimum((row_events["onset"] + 1) * hop_length, merged_ends)
+        row_events["onset_samples"] = onset_end - merged_starts
+        row_events["offset_samples"] = np.where(single, 0, merged_ends - row_events["offset"] * hop_length)
+        events.append(row_events)
+
+    events = np.concatenate(events) if events else np.empty(0, dtype=EVENT_DTYPE)
+    events = events[np.argsort(events["onset"], kind="mergesort")]
+    return NoteEvents(events, num_rows, raw_length, hop_length, num_frames)
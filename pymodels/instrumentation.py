@@ -0,0 +1,182 @@
+"""
+Lightweight instrumentation: timed spans emitted as JSON lines.
+
+Each record carries the wall time, the CPU time of the process (all threads)
+and the peak resident memory. Records are only written if a trace file is
+configured, either with `configure` or through the `DEEPAUDIO_TRACE`
+environment variable; `configure` also exports the variable, so worker
+processes write to the same file. Lines are appended with a single write
+each, which keeps them intact when several processes share the file.
+"""
+
+from __future__ import division, print_function
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+
+
+TRACE_ENV = "DEEPAUDIO_TRACE"
+
+_trace_file = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(path):
+    """
+    Appends records to the JSON lines file `path`, or disables tracing if
+    `path` is None.
+    """
+    global _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+            _trace_file = None
+        if path is None:
+            os.environ.pop(TRACE_ENV, None)
+        else:
+            _trace_file = open(path, "a")
+            os.environ[TRACE_ENV] = path
+
+
+def enabled():
+    return _trace_file is not None
+
+
+def emit(event, name, **fields):
+    if _trace_file is None:
+        return
+    record = dict(fields, event=event, name=name, time=time.time(), pid=os.getpid())
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _lock:
+        _trace_file.write(line)
+        _trace_file.flush()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _reset_after_fork():
+    # A forked worker does not run inside the spans of its parent
+    _local.stack = []
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Span(object):
+    """
+    Times the enclosed block. Nested spans record their enclosing spans in
+    `path`. Additional fields can be attached with `set`.
+    """
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = _stack()
+        stack.append(self.name)
+        self.path = "/".join(stack)
+        self.peak_before = peak_rss_mb()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        _stack().pop()
+        peak = peak_rss_mb()
+        emit(
+            "span", self.name,
+            path=self.path,
+            wall_s=wall,
+            cpu_s=cpu,
+            peak_rss_mb=peak,
+            peak_rss_growth_mb=peak - self.peak_before,
+            ok=exc_type is None,
+            **self.fields
+        )
+        return False
+
+
+def span(name, **fields):
+    return Span(name, **fields)
+
+
+class Aggregate(object):
+    """
+    Accumulates the timings of many short blocks (e.g. training steps), which
+    would be too many to record one by one. `emit` writes the totals since
+    the last call and starts over.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def __enter__(self):
+        self.cpu_start = time.process_time()
+        self.wall_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall += time.time() - self.wall_start
+        self.cpu += time.process_time() - self.cpu_start
+        self.count += 1
+        return False
+
+    def emit(self, **fields):
+        if self.count > 0:
+            emit(
+                "aggregate", self.name,
+                count=self.count,
+                wall_s=self.wall,
+                cpu_s=self.cpu,
+                mean_wall_s=self.wall / self.count,
+                peak_rss_mb=peak_rss_mb(),
+                **fields
+            )
+        self.reset()
+
+
+@contextlib.contextmanager
+def profile(path):
+    """
+    Runs the enclosed block under cProfile and writes the stats to `path`
+    (readable with `pstats`). Does nothing if `path` is None.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+if os.environ.get(TRACE_ENV):
+    configure(os.environ[TRACE_ENV])
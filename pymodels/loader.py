@@ -0,0 +1,412 @@
+"""
+Streaming, prefetching frame loader.
+
+Frames are read in contiguous blocks from one or more sources by background
+threads, mixed in a bounded shuffle buffer, and emitted as contiguous
+frame-major `(batch, bins)` float32 batches. Peak memory is bounded by the
+shuffle buffer and the prefetch depth, independent of the dataset size.
+
+For models with temporal context, batches can also hold windows of
+`2 * context + 1` frames around each frame. Windows are strided views into
+the blocks (see `frame_windows`), and are only copied out for the frames of
+a batch, so the memory does not grow with the window length.
+"""
+
+from __future__ import division, print_function
+
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import os
+
+import numpy as np
+
+from features import FeatureCodec, load_features
+from groundtruth import NoteEvents
+import instrumentation
+
+
+class ArraySource(object):
+    """
+    Frames from a pair of (possibly memory-mapped) arrays. By default the
+    arrays are in the bin-major `(bins, frames)` layout of `_X.npy`/`_Y.npy`
+    files; blocks are transposed once when they are read. The labels `Y`
+    can also be sparse `NoteEvents`, which are densified block by block,
+    and encoded features are decoded block by block with `codec`.
+    """
+    def __init__(self, X, Y, frame_major=False, codec=None):
+        self.X = X
+        self.Y = Y
+        self.frame_major = frame_major
+        self.codec = codec if codec is not None else FeatureCodec()
+        if isinstance(Y, NoteEvents):
+            y_shape = Y.shape if frame_major else Y.shape[::-1]
+        else:
+            y_shape = Y.shape
+        if X.shape != y_shape:
+            raise ValueError("Shape mismatch between X {} and Y {}".format(X.shape, y_shape))
+
+    @classmethod
+    def from_files(cls, path_X, path_Y):
+        if path_Y.endswith(".npz"):
+            Y = NoteEvents.load(path_Y)
+        else:
+            Y = np.load(path_Y, mmap_mode="r")
+        X, codec = load_features(path_X)
+        return cls(X, Y, codec=codec)
+
+    @classmethod
+    def from_dataset(cls, base_path):
+        """
+        Source of a dataset written by `generate_dataset`, with either sparse
+        (`<base>_labels.npz`) or dense (`<base>_Y.npy`) labels.
+        """
+        path_labels = "{}_labels.npz".format(base_path)
+        if not os.path.exists(path_labels):
+            path_labels = "{}_Y.npy".format(base_path)
+        return cls.from_files("{}_X.npy".format(base_path), path_labels)
+
+    @property
+    def num_frames(self):
+        return self.X.shape[0] if self.frame_major else self.X.shape[1]
+
+    @property
+    def num_bins(self):
+        return self.X.shape[1] if self.frame_major else self.X.shape[0]
+
+    def read_block(self, start, stop):
+        if self.frame_major:
+            x = self.X[start:stop]
+        else:
+            x = self.X[:, start:stop].T
+        x = self.codec.decode(x)
+        if isinstance(self.Y, NoteEvents):
+            y = self.Y.densify(start, stop, np.float32)
+        elif self.frame_major:
+            y = self.Y[start:stop]
+        else:
+            y = self.Y[:, start:stop].T
+        return np.ascontiguousarray(x, dtype=np.float32), np.ascontiguousarray(y, dtype=np.float32)
+
+
+class SliceSource(object):
+    """
+    The frames `[start, stop)` of another source.
+    """
+    def __init__(self, source, start, stop):
+        self.source = source
+        self.start = start
+        self.stop = stop
+
+    @property
+    def num_frames(self):
+        return self.stop - self.start
+
+    @property
+    def num_bins(self):
+        return self.source.num_bins
+
+    def read_block(self, start, stop):
+        return self.source.read_block(self.start + start, self.start + stop)
+
+
+def shard_sources(sources, rank, world_size):
+    """
+    The part of `sources` for one of `world_size` data-parallel ranks: a
+    contiguous slice of each source. All shards get exactly the same number
+    of frames (the last `num_frames % world_size` frames of each source are
+    dropped), so every rank runs the same number of steps.
+    """
+    shards = []
+    for source in sources:
+        size = source.num_frames // world_size
+        if size > 0:
+            shards.append(SliceSource(source, rank * size, (rank + 1) * size))
+    return shards
+
+
+def corpus_sources(corpus):
+    """
+    One source per shard of a `corpus.Corpus`.
+    """
+    sources = []
+    for i in range(len(corpus.shards)):
+        X, Y = corpus.shard_arrays(i)
+        sources.append(ArraySource(X, Y, frame_major=True, codec=corpus.shard_codec(i)))
+    return sources
+
+
+def frame_windows(x, context):
+    """
+    Zero-copy view of the windows of `2 * context + 1` consecutive frames of
+    the frame-major `x` (frames, bins), of shape
+    `(frames - 2 * context, 2 * context + 1, bins)`. Window `i` is centered on
+    frame `i + context`.
+    """
+    return np.lib.stride_tricks.sliding_window_view(x, 2 * context + 1, axis=0).transpose(0, 2, 1)
+
+
+def read_padded_block(source, start, stop, context):
+    """
+    `source.read_block(start, stop)` with the features of `context` more
+    frames on each side, zeros beyond the ends of the source.
+    """
+    lo = max(start - context, 0)
+    hi = min(stop + context, source.num_frames)
+    x, y = source.read_block(lo, hi)
+    if lo > start - context or hi < stop + context:
+        x = np.pad(x, ((lo - (start - context), stop + context - hi), (0, 0)))
+    return x, y[start - lo:stop - lo]
+
+
+def read_feature_windows(X, codec, start, stop, context):
+    """
+    Decoded windows (see `frame_windows`) centered on the frames
+    `[start, stop)` of the bin-major encoded features `X`, zeros beyond its
+    ends.
+    """
+    lo = max(start - context, 0)
+    hi = min(stop + context, X.shape[1])
+    x = np.zeros((stop - start + 2 * context, X.shape[0]), dtype=np.float32)
+    x[lo - start + context:hi - start + context] = codec.decode(X[:, lo:hi]).T
+    return frame_windows(x, context)
+
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class FrameLoader(object):
+    """
+    Iterable over `(x, y)` batches of shape `(batch_size, bins)`. With
+    `context > 0`, `x` holds the windows of `2 * context + 1` frames centered
+    on the frames of `y`, of shape `(batch_size, 2 * context + 1, bins)`,
+    zero padded at the ends of the sources.
+
+    With `shuffle=True` the blocks of all sources are visited in random order,
+    which interleaves the sources, and frames are shuffled within a buffer of
+    `shuffle_buffer` frames. With `shuffle=False` frames are emitted in
+    source order. `transform(x, y)` is applied in place to every batch on
+    the background thread.
+    """
+    def __init__(self, sources, batch_size=32, shuffle=True, shuffle_buffer=16384, block_size=1024,
+                 num_threads=2, prefetch=8, drop_last=False, transform=None, seed=None, context=0):
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+        if len(set(source.num_bins for source in sources)) > 1:
+            raise ValueError("All sources must have the same number of bins")
+        self.sources = sources
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(shuffle_buffer, 2 * batch_size)
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.transform = transform
+        self.context = context
+        self.rng = np.random.RandomState(seed)
+
+    @property
+    def num_frames(self):
+        return sum(source.num_frames for source in self.sources)
+
+    @property
+    def num_bins(self):
+        return self.sources[0].num_bins
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_frames // self.batch_size
+        return (self.num_frames + self.batch_size - 1) // self.batch_size
+
+    def _blocks(self):
+        blocks = [
+            (source_id, start, min(start + self.block_size, source.num_frames))
+            for source_id, source in enumerate(self.sources)
+            for start in range(0, source.num_frames, self.block_size)
+        ]
+        if self.shuffle:
+            order = self.rng.permutation(len(blocks))
+            blocks = [blocks[i] for i in order]
+        return blocks
+
+    def _read_blocks(self, executor, stop):
+        """
+        Reads blocks on the thread pool, keeping up to `prefetch` reads in
+        flight, and yields them in order.
+        """
+        pending = []
+        for source_id, start, end in self._blocks():
+            if stop.is_set():
+                return
+            pending.append(executor.submit(self._read_block, source_id, start, end))
+            if len(pending) >= self.prefetch:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+    def _read_block(self, source_id, start, stop):
+        if self.context == 0:
+            return self.sources[source_id].read_block(start, stop)
+        x, y = read_padded_block(self.sources[source_id], start, stop, self.context)
+        return frame_windows(x, self.context), y
+
+    def _batches(self, executor, stop):
+        # The buffer holds the blocks as read (strided window views in
+        # windowed mode) and references (block, position) to the frames that
+        # were not emitted yet. Batches are gathered from the blocks, and a
+        # block is only kept while frames of it are left.
+        window = 2 * self.context + 1
+        blocks = {}
+        block_ids = itertools.count()
+        buffer_ids = []
+        buffer_positions = []
+        buffered = 0
+        shuffle_timer = instrumentation.Aggregate("loader.shuffle")
+
+        def add_block(x, y, size):
+            # `size` is the number of frames of features the block holds
+            block_id = next(block_ids)
+            blocks[block_id] = (x, y, size)
+            buffer_ids.append(np.full(len(y), block_id))
+            buffer_positions.append(np.arange(len(y)))
+
+        def by_block(indices, ids):
+            # `indices` reordered so that the frames of each block are adjacent
+            return indices[np.argsort(ids[indices], kind="stable")]
+
+        def gather(ids, positions):
+            # `ids` are grouped by block, each run is gathered at once
+            bounds = np.concatenate([[0], np.flatnonzero(np.diff(ids)) + 1, [len(ids)]])
+            if len(bounds) == 2:
+                block_x, block_y, _ = blocks[ids[0]]
+                return block_x[positions], block_y[positions]
+            x_first, y_first, _ = blocks[ids[0]]
+            x = np.empty((len(ids),) + x_first.shape[1:], dtype=np.float32)
+            y = np.empty((len(ids),) + y_first.shape[1:], dtype=np.float32)
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                block_x, block_y, _ = blocks[ids[start]]
+                x[start:end] = block_x[positions[start:end]]
+                y[start:end] = block_y[positions[start:end]]
+            return x, y
+
+        def compact(ids, positions):
+            # Copies the remaining frames (windows) of the blocks for which
+            # that takes less memory than keeping the block (always for
+            # frames) into a single new block
+            copy = np.zeros(len(ids), dtype=bool)
+            for block_id in np.unique(ids):
+                rows = np.flatnonzero(ids == block_id)
+                if len(rows) * window < blocks[block_id][2]:
+                    copy[rows] = True
+            if copy.any():
+                rows = by_block(np.flatnonzero(copy), ids)
+                x, y = gather(ids[rows], positions[rows])
+                new_id = next(block_ids)
+                blocks[new_id] = (x, y, len(y) * window)
+                ids[rows] = new_id
+                positions[rows] = np.arange(len(y))
+            kept = set(np.unique(ids).tolist())
+            for block_id in list(blocks):
+                if block_id not in kept:
+                    del blocks[block_id]
+
+        def drain(keep):
+            # Emits batches from the buffer until at most `keep` frames are left
+            with shuffle_timer:
+                ids = np.concatenate(buffer_ids)
+                positions = np.concatenate(buffer_positions)
+                if self.shuffle:
+                    order = self.rng.permutation(len(ids))
+                else:
+                    order = np.arange(len(ids))
+            i = 0
+            while len(ids) - i > keep:
+                if len(ids) - i < self.batch_size and (keep > 0 or self.drop_last):
+                    break
+                indices = order[i:i+self.batch_size]
+                with shuffle_timer:
+                    grouped = by_block(indices, ids)
+                    batch = gather(ids[grouped], positions[grouped])
+                i += len(indices)
+                yield batch
+            with shuffle_timer:
+                ids = ids[order[i:]]
+                positions = positions[order[i:]]
+                compact(ids, positions)
+                del buffer_ids[:], buffer_positions[:]
+                if len(ids) > 0:
+                    buffer_ids.append(ids)
+                    buffer_positions.append(positions)
+
+        for x, y in self._read_blocks(executor, stop):
+            add_block(x, y, len(y) + 2 * self.context)
+            buffered += len(y)
+            if self.shuffle and buffered >= self.shuffle_buffer:
+                # Keep half of the buffer to mix with the next blocks
+                for batch in drain(self.shuffle_buffer // 2):
+                    yield batch
+                buffered = sum(len(ids) for ids in buffer_ids)
+            elif not self.shuffle and buffered >= self.batch_size:
+                for batch in drain(self.batch_size - 1):
+                    yield batch
+                buffered = sum(len(ids) for ids in buffer_ids)
+
+        if buffered > 0:
+            for batch in drain(0):
+                yield batch
+
+        shuffle_timer.emit(num_frames=self.num_frames)
+
+    def _produce(self, out_queue, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            try:
+                for x, y in self._batches(executor, stop):
+                    if self.transform is not None:
+                        self.transform(x, y)
+                    if not put((x, y)):
+                        return
+            finally:
+                executor.shutdown(wait=True)
+            put(_END)
+        except Exception as e:
+            put(_Failure(e))
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out_queue, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exc
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,151 @@
+"""
+Build manifests of datasets.
+
+Every dataset `<base>` has a manifest `<base>_manifest.json` that records,
+for each stage of its build (midi, render, features, labels, plots):
+
+- a key, the hash of the stage parameters and of the hashes of its inputs
+- the artifacts the stage produced, with their content hashes
+- stage specific information (e.g. the sample rate and length of the audio)
+
+A stage is only redone if its key changed, or if one of its artifacts is
+missing or was modified. Stages are recorded as soon as they complete, so
+an interrupted build resumes after the last completed stage.
+
+Artifacts are hashed with SHA-1. Their size and modification time are
+recorded along with the hash, and a file is only hashed again if these
+changed.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(base_path):
+    return "{}_manifest.json".format(base_path)
+
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_array(a):
+    a = np.ascontiguousarray(a)
+    h = hashlib.sha1()
+    h.update(json.dumps({"dtype": a.dtype.str, "shape": a.shape}).encode("utf-8"))
+    h.update(memoryview(a.reshape(-1).view(np.uint8)))
+    return h.hexdigest()
+
+
+def hash_file(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _json_default(o):
+    # numpy scalars, e.g. sample rates or frequencies
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError("Not serializable: {!r}".format(o))
+
+
+def stage_key(params, **inputs):
+    """
+    Key of a stage with parameters `params` and input hashes `inputs`.
+    """
+    return hash_bytes(json.dumps(
+        {"params": params, "inputs": inputs}, sort_keys=True, default=_json_default).encode("utf-8"))
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class Manifest(object):
+    """
+    Manifest of the dataset `base_path`. With `reset`, a previous manifest
+    is ignored, i.e. every stage is redone.
+    """
+    def __init__(self, base_path, reset=False):
+        self.path = manifest_path(base_path)
+        self.root = os.path.dirname(os.path.abspath(self.path))
+        self._lock = threading.Lock()
+        self.data = None
+        if not reset and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+            except ValueError:
+                # e.g. truncated by a crash, rebuild
+                pass
+        if self.data is None:
+            self.data = {"version": MANIFEST_VERSION, "dataset": {}, "stages": {}}
+
+    def set_dataset_info(self, **info):
+        """
+        Records information on the whole dataset, e.g. its seed and
+        generator.
+        """
+        with self._lock:
+            if self.data["dataset"] != info:
+                self.data["dataset"] = info
+                self._save()
+
+    def stage(self, name):
+        return self.data["stages"].get(name)
+
+    def is_current(self, name, key):
+        stage = self.stage(name)
+        if stage is None or stage["key"] != key:
+            return False
+        return all(self._file_current(path, entry) for path, entry in stage["files"].items())
+
+    def _file_current(self, path, entry):
+        path = os.path.join(self.root, path)
+        if not os.path.exists(path):
+            return False
+        size, mtime_ns = _stamp(path)
+        if size == entry["size"] and mtime_ns == entry["mtime_ns"]:
+            return True
+        if size != entry["size"] or hash_file(path) != entry["sha1"]:
+            return False
+        entry["mtime_ns"] = mtime_ns
+        return True
+
+    def complete(self, name, key, files=(), **info):
+        """
+        Records the stage `name` as completed with key `key`, producing the
+        artifacts `files`.
+        """
+        entries = {}
+        for path in files:
+            size, mtime_ns = _stamp(path)
+            entries[os.path.relpath(os.path.abspath(path), self.root)] = {
+                "sha1": hash_file(path),
+                "size": size,
+                "mtime_ns": mtime_ns,
+            }
+        with self._lock:
+            self.data["stages"][name] = dict(info, key=key, files=entries)
+            self._save()
+
+    def _save(self):
+        path_tmp = "{}.tmp{}".format(self.path, os.getpid())
+        with open(path_tmp, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True, default=_json_default)
+        os.rename(path_tmp, self.path)
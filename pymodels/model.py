@@ -6,36 +6,42 @@ Pytorch model
 from __future__ import print_function
 
 import argparse
+import contextlib
 import os
 import sys
-import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import torch
-import torch.autograd
-import torch.optim as optim
-import torch.nn.functional as F
+import numpy as np
 
+from augment import Augmentation
+from corpus import Corpus
+from features import load_features
+import instrumentation
+from manifest import Manifest
+from loader import ArraySource, FrameLoader, corpus_sources, read_feature_windows, shard_sources
 
-use_cuda = torch.cuda.is_available()
 
-if use_cuda:
-    print('use gpu')
-    dtype = torch.cuda.FloatTensor
-    ltype = torch.cuda.LongTensor
-    device = torch.device('cuda')
-else:
-    dtype = torch.FloatTensor
-    ltype = torch.LongTensor
-    device = torch.device('cpu')
+_device = None
 
 
-def get_batch(X, Y, i, batch_size):
-    x = X[:, i:i+batch_size].transpose(0, 1)
-    y = Y[:, i:i+batch_size].transpose(0, 1)
-    return x, y
+def get_device():
+    """
+    The training device. CUDA is only probed on first use, not on import.
+    """
+    global _device
+    import torch
+    if _device is None:
+        if torch.cuda.is_available():
+            print('use gpu')
+            _device = torch.device('cuda')
+        else:
+            _device = torch.device('cpu')
+    return _device
 
 
 def init_model_single_layer(model_path, num_keys):
+    import torch
     model = torch.nn.Linear(in_features=num_keys, out_features=num_keys)
     if os.path.exists(model_path):
         model.load_state_dict(torch.load(model_path))
@@ -43,6 +49,7 @@ def init_model_single_layer(model_path, num_keys):
 
 
 def init_model_two_layers(model_path, num_keys, H=30):
+    import torch
     model = torch.nn.Sequential(
         #torch.nn.Linear(num_keys, H),
         #torch.nn.ReLU(),
@@ -50,113 +57,494 @@ def init_model_two_layers(model_path, num_keys, H=30):
         #torch.nn.Sigmoid(),
         torch.nn.Linear(num_keys, num_keys),
         torch.nn.Sigmoid(),
-    ).to(device)
+    ).to(get_device())
 
     if os.path.exists(model_path):
         model.load_state_dict(torch.load(model_path))
 
-    #if use_cuda:
+    #if torch.cuda.is_available():
     #    print("move model to gpu")
     #    #model.cuda()
 
     return model
 
 
+# The window models of networks.WINDOW_MODELS, listed here so that the
+# arguments are parsed without importing torch
+ARCHITECTURES = ["frame", "spectro_conv", "temporal_conv", "window_linear"]
+
+
+def init_model(model_path, num_keys, layers=2, arch="frame", context=0):
+    """
+    With `arch="frame"`, the single frame model with `layers` layers;
+    otherwise the model `WINDOW_MODELS[arch]` of windows of
+    `2 * context + 1` frames.
+    """
+    import torch
+    from networks import WINDOW_MODELS
+    if arch != "frame":
+        if arch not in WINDOW_MODELS:
+            raise ValueError("Unknown architecture: {} (available: {})".format(arch, ", ".join(ARCHITECTURES)))
+        model = WINDOW_MODELS[arch](num_keys, context).to(get_device())
+        if os.path.exists(model_path):
+            model.load_state_dict(torch.load(model_path))
+        return model
+    if context != 0:
+        raise ValueError("The frame model has no context")
+    if layers == 1:
+        return init_model_single_layer(model_path, num_keys)
+    elif layers == 2:
+        return init_model_two_layers(model_path, num_keys)
+    raise ValueError("Unsupported number of layers: {}".format(layers))
+
+
+def model_num_keys(state, arch="frame"):
+    """
+    Number of keys of a model, from its state dict.
+    """
+    from networks import WINDOW_MODELS
+    if arch == "frame":
+        return [value for key, value in sorted(state.items()) if key.endswith("weight")][0].shape[1]
+    return WINDOW_MODELS[arch].num_keys(state)
+
+
 def store_model(model_path, model):
+    import torch
     torch.save(model.state_dict(), model_path)
 
 
-def train(model_path, layers=2):
-
-    X = np.load("X.npy")
-    Y = np.load("Y.npy")
+def clamp_targets(X, Y):
     # limit target for cross entropy usage
+    if X.ndim == 3:
+        # windows, the targets are those of the center frames
+        X = X[:, X.shape[1] // 2]
     Y[X < 0] = 0
     Y[X > 1] = 1
 
-    X = torch.from_numpy(X)
-    Y = torch.from_numpy(Y)
 
-    N = X.size(1)
-    num_keys = X.size(0)
-
-    perm = torch.randperm(N)
-    X = X[:, perm]
-    Y = Y[:, perm]
-
-    # Define model
-    if layers == 1:
-        model = init_model_single_layer(model_path, num_keys)
-    elif layers == 2:
-        model = init_model_two_layers(model_path, num_keys)
+def load_sources(corpus_path=None, datasets=None):
+    """
+    Frame sources for training: the shards of a corpus, the datasets with
+    the given base paths, or `X.npy`/`Y.npy` by default. All of them are
+    memory-mapped.
+    """
+    if corpus_path is not None:
+        return corpus_sources(Corpus(corpus_path))
+    elif datasets:
+        return [ArraySource.from_dataset(base) for base in datasets]
+    else:
+        return [ArraySource.from_files("X.npy", "Y.npy")]
+
+
+def data_bins_per_note(corpus_path=None, datasets=None):
+    """
+    Bins per semitone of the features of a corpus (from its feature
+    parameters) or of datasets (from their manifests). None if unknown, e.g.
+    for `X.npy`.
+    """
+    if corpus_path is not None:
+        params = Corpus(corpus_path).params
+        if params is None:
+            return None
+        # CQT features, or one filter bank resonator per key
+        return params["bins_per_octave"] // 12 if "bins_per_octave" in params else 1
+    elif datasets:
+        stages = [Manifest(base).stage("features") for base in datasets]
+        values = set(stage.get("bins_per_note") if stage is not None else None for stage in stages)
+        if len(values) > 1:
+            raise ValueError("Datasets with different bins per semitone: {}".format(sorted(values, key=str)))
+        return values.pop()
+    return None
+
+
+def evaluate(model, loss_fn, sources, batch_size=4096, context=0):
+    import torch
+    device = get_device()
+    # Streaming pass, the dataset is never materialized as a whole
+    loader = FrameLoader(sources, batch_size=batch_size, shuffle=False, transform=clamp_targets, context=context)
+    total = 0.0
+    count = 0
+    with torch.no_grad():
+        for batch_x, batch_y in loader:
+            batch_x = torch.from_numpy(batch_x).to(device)
+            batch_y = torch.from_numpy(batch_y).to(device)
+            total += loss_fn(model(batch_x), batch_y).item() * len(batch_x)
+            count += len(batch_x)
+    return total / count
+
+
+def configure_threads(num_threads=None, interop_threads=None):
+    """
+    Sets the intra-op and inter-op thread pool sizes. The inter-op pool can
+    only be sized before the first parallel operation, so this should be
+    called early.
+    """
+    import torch
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def distributed_rank():
+    """
+    `(rank, world_size)` of this process, `(0, 1)` outside of distributed
+    training.
+    """
+    import torch.distributed as dist
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def global_sum(values):
+    """
+    Sums a list of numbers over all ranks (a no-op outside of distributed
+    training). This synchronizes the ranks.
+    """
+    import torch
+    import torch.distributed as dist
+    values = torch.stack([torch.as_tensor(v, dtype=torch.float64).cpu() for v in values])
+    if distributed_rank()[1] > 1:
+        dist.all_reduce(values)
+    return values.tolist()
+
+
+def train(model_path, layers=2, corpus_path=None, datasets=None, epochs=1, num_steps=None, batch_size=1024,
+          lr=1e-3, log_every=100, bf16=False, final_eval=False, seed=None, arch="frame", context=0,
+          augment=None):
+    """
+    Trains for `epochs` passes over the data (including the last partial
+    batch of each pass), or stops after `num_steps` batches if given.
+
+    The loss is accumulated on the device and only read back every
+    `log_every` steps, so the steps in between never wait for the result.
+    With `bf16` the forward pass runs under bfloat16 autocast, the loss is
+    computed in float32. `final_eval` adds a streaming pass over all data
+    for the final loss; otherwise the mean loss of the last epoch is
+    reported. Returns that loss.
+
+    In a distributed process group (see `launch_distributed`) every rank
+    trains on its own shard of the data with `batch_size` frames per step,
+    gradients are averaged between the ranks, and only rank 0 reports and
+    writes the checkpoint.
+
+    Window models (`arch`, see `init_model`) are trained on windows of
+    `2 * context + 1` frames, gathered per batch by the loader.
+
+    `augment` holds the options of an `augment.Augmentation` of the training
+    batches (the final evaluation is not augmented). Its `bins_per_note`
+    defaults to that of the data, see `data_bins_per_note`.
+    """
+    import torch
+    import torch.distributed as dist
+    import torch.optim as optim
+    from torch.nn.parallel import DistributedDataParallel
+    rank, world_size = distributed_rank()
+    device = get_device()
+    if seed is not None:
+        torch.manual_seed(seed)
+
+    with instrumentation.span("train.load", rank=rank) as s:
+        sources = load_sources(corpus_path, datasets)
+        if world_size > 1:
+            sources = shard_sources(sources, rank, world_size)
+
+        augment = dict(augment or {})
+        if augment.get("bins_per_note") is None:
+            augment["bins_per_note"] = data_bins_per_note(corpus_path, datasets)
+        augmentation = Augmentation(seed=None if seed is None else seed + rank, **augment)
+        if augmentation.enabled:
+            def transform(x, y):
+                clamp_targets(x, y)
+                augmentation(x, y)
+        else:
+            transform = clamp_targets
+
+        loader = FrameLoader(sources, batch_size=batch_size, transform=transform,
+                             seed=None if seed is None else seed + rank, context=context)
+        num_keys = loader.num_bins
+
+        model = init_model(model_path, num_keys, layers, arch, context)
+        s.set(num_frames=loader.num_frames, num_bins=num_keys, batch_size=batch_size, arch=arch, context=context,
+              augment=augment)
+
+    # The wrapper broadcasts the initial weights of rank 0 and all-reduces the
+    # gradients during the backward pass.
+    module = model
+    if world_size > 1:
+        model = DistributedDataParallel(model)
 
     #loss_fn = F.smooth_l1_loss
     #loss_fn = torch.nn.MSELoss(size_average=False)
     #loss_fn = torch.nn.BCEWithLogitsLoss() # combines sigmoid with binary cross entropy
     loss_fn = torch.nn.BCELoss()
 
-    i = 0
-    batch_size = 32
-    optimizer = optim.Adam(model.parameters())
-
-    for _ in range(10000):
-        # Get data
-        batch_x, batch_y = get_batch(X, Y, i, batch_size)
-        batch_x = batch_x.to(device)
-        batch_y = batch_y.to(device)
-
-        i += batch_size
-        if i > X.size(1):
-            i = 0
-
-        # Reset gradients
-        optimizer.zero_grad()
-
-        # Forward pass
-        output = loss_fn(model(batch_x), batch_y)
-        loss = output.item()
-        sys.stdout.write("loss = {}\r".format(loss))
-
-        # Backward pass
-        output.backward()
-
-        # Apply gradients
-        optimizer.step()
-
-        # Stop criterion
-        #if loss < 1e-3:
-        #    break
-
-    batch_x = X.transpose(0, 1)
-    batch_y = Y.transpose(0, 1)
-    batch_x = batch_x.to(device)
-    batch_y = batch_y.to(device)
-    pred = model(batch_x)
-    loss = loss_fn(pred, batch_y)
-    print("loss = {}".format(loss.item()))
-
-    pred = pred.transpose(0, 1)
-    np.save("P.npy", pred.cpu().detach().transpose(0, 1).numpy())
-
-    store_model(model_path, model)
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    model.train()
+
+    wait_timer = instrumentation.Aggregate("train.wait")
+    step_timer = instrumentation.Aggregate("train.step")
+
+    step = 0
+    epoch_loss = None
+    for epoch in range(epochs):
+        with instrumentation.span("train.epoch", epoch=epoch) as s:
+            # Running sums stay on the device until they are logged
+            loss_sum = torch.zeros((), device=device)
+            log_sum = torch.zeros((), device=device)
+            epoch_frames = 0
+            log_frames = 0
+            epoch_start = log_start = time.time()
+
+            batches = iter(loader)
+            while num_steps is None or step < num_steps:
+                with wait_timer:
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+
+                with step_timer:
+                    batch_x = torch.from_numpy(batch[0]).to(device)
+                    batch_y = torch.from_numpy(batch[1]).to(device)
+
+                    optimizer.zero_grad(set_to_none=True)
+
+                    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+                        pred = model(batch_x)
+                    output = loss_fn(pred.float(), batch_y)
+
+                    output.backward()
+                    optimizer.step()
+
+                    batch_loss = output.detach() * len(batch_x)
+                    loss_sum += batch_loss
+                    log_sum += batch_loss
+
+                step += 1
+                epoch_frames += len(batch_x)
+                log_frames += len(batch_x)
+
+                if step % log_every == 0:
+                    total_loss, total_frames = global_sum([log_sum, log_frames])
+                    loss = total_loss / total_frames
+                    frames_per_sec = total_frames / (time.time() - log_start)
+                    if rank == 0:
+                        sys.stdout.write("epoch {} step {} loss = {:.6f} [{:.0f} frames/s]\r".format(
+                            epoch, step, loss, frames_per_sec))
+                        sys.stdout.flush()
+                    wait_timer.emit(step=step)
+                    step_timer.emit(step=step, loss=loss, frames_per_sec=frames_per_sec)
+                    log_sum.zero_()
+                    log_frames = 0
+                    log_start = time.time()
+
+            total_loss, total_frames = global_sum([loss_sum, epoch_frames])
+            if total_frames > 0:
+                epoch_loss = total_loss / total_frames
+            s.set(steps=step, frames=total_frames, loss=epoch_loss,
+                  frames_per_sec=total_frames / (time.time() - epoch_start))
+        if rank == 0:
+            print("epoch {} loss = {} ({} frames)".format(epoch, epoch_loss, int(total_frames)))
+
+        if num_steps is not None and step >= num_steps:
+            break
+
+    wait_timer.emit(step=step)
+    step_timer.emit(step=step)
+
+    if final_eval:
+        with instrumentation.span("train.evaluate") as s:
+            module.eval()
+            # the shards are of equal size, so the mean over ranks is exact
+            epoch_loss = global_sum([evaluate(module, loss_fn, sources, context=context)])[0] / world_size
+            s.set(loss=epoch_loss)
+        if rank == 0:
+            print("loss = {}".format(epoch_loss))
+
+    if rank == 0:
+        with instrumentation.span("train.checkpoint"):
+            store_model(model_path, module)
+    if world_size > 1:
+        dist.barrier()
+
+    return epoch_loss
+
+
+def _distributed_worker(local_rank, num_procs, node_rank, num_nodes, master_addr, master_port, num_threads,
+                        train_kwargs):
+    import torch.distributed as dist
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    dist.init_process_group(
+        "gloo", rank=node_rank * num_procs + local_rank, world_size=num_nodes * num_procs)
+    try:
+        configure_threads(num_threads)
+        train(**train_kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_distributed(num_procs, node_rank=0, num_nodes=1, master_addr="127.0.0.1", master_port=29500,
+                       num_threads=None, **train_kwargs):
+    """
+    Data-parallel training on `num_procs` local processes, which talk to each
+    other (and to the processes on other nodes) over the gloo backend. For
+    several nodes, run this on each of them with the same `num_procs`,
+    `num_nodes` and the address of node 0 as `master_addr`, and `node_rank`
+    from 0 to `num_nodes - 1`. By default the cores of this node are split
+    evenly between the processes.
+    """
+    import torch.multiprocessing
+    if num_threads is None:
+        num_threads = max(1, torch.multiprocessing.cpu_count() // num_procs)
+    torch.multiprocessing.spawn(
+        _distributed_worker,
+        args=(num_procs, node_rank, num_nodes, master_addr, master_port, num_threads, train_kwargs),
+        nprocs=num_procs,
+    )
 
 
-def predict(model_path, layers=2):
-    X = np.load("X.npy")
-    X = torch.from_numpy(X)
-    num_keys = X.size(0)
+@contextlib.contextmanager
+def torch_profile(path):
+    """
+    Runs the enclosed block under `torch.profiler` and writes a Chrome trace
+    to `path`. Does nothing if `path` is None.
+    """
+    if path is None:
+        yield
+        return
+    import torch.profiler
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if get_device().type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+        yield
+    profiler.export_chrome_trace(path)
+
+
+def export_model(model_path, artifact_path, layers=2, quantize=True, arch="frame", context=0):
+    """
+    Writes a self-contained TorchScript artifact of a trained model for CPU
+    inference. With `quantize`, the weights of the Linear layers are stored
+    as int8 and activations are quantized dynamically.
+    """
+    import torch
+    state = torch.load(model_path, map_location="cpu")
+    model = init_model(model_path, model_num_keys(state, arch), layers, arch, context).cpu().eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    artifact = torch.jit.freeze(torch.jit.script(model))
+    torch.jit.save(artifact, artifact_path)
+
+
+def load_artifact(artifact_path):
+    import torch
+    return torch.jit.load(artifact_path, map_location="cpu")
+
+
+def check_features(path_X=None, corpus_path=None, datasets=None):
+    """
+    Bin-major features and their codec for `check_artifact`: `path_X` if
+    given, otherwise those of the first training dataset, of the first shard
+    of the corpus, or `X.npy` if it exists. None if there are none.
+    """
+    if path_X is not None:
+        return load_features(path_X)
+    elif datasets:
+        return load_features("{}_X.npy".format(datasets[0]))
+    elif corpus_path is not None:
+        corpus = Corpus(corpus_path)
+        if len(corpus.shards) == 0:
+            return None
+        X, _ = corpus.shard_arrays(0)
+        return X.T, corpus.shard_codec(0)
+    elif os.path.exists("X.npy"):
+        return load_features("X.npy")
+    return None
+
+
+def check_artifact(model_path, artifact_path, X, codec, layers=2, num_frames=8192, arch="frame", context=0):
+    """
+    Compares the predictions of an exported artifact with those of the fp32
+    model on up to `num_frames` frames spread over the bin-major features
+    `X` (see `check_features`).
+    """
+    import torch
+    num_keys, N = X.shape
+    indices = np.unique(np.linspace(0, N - 1, min(num_frames, N)).astype(int))
+    if arch == "frame":
+        x = torch.from_numpy(np.ascontiguousarray(codec.decode(X[:, indices]).T))
+    else:
+        x = torch.from_numpy(np.concatenate([read_feature_windows(X, codec, i, i + 1, context) for i in indices]))
+
+    model = init_model(model_path, num_keys, layers, arch, context).cpu().eval()
+    artifact = load_artifact(artifact_path)
+    with torch.no_grad():
+        expected = model(x)
+        actual = artifact(x)
+
+    error = (actual - expected).abs()
+    return {
+        "max_abs_error": error.max().item(),
+        "mean_abs_error": error.mean().item(),
+        # fraction of keys with the same on/off decision
+        "decision_agreement": ((actual > 0.5) == (expected > 0.5)).float().mean().item(),
+    }
+
+
+def predict(model_path, layers=2, path_X="X.npy", path_P="P.npy", batch_frames=8192, num_threads=None,
+            artifact_path=None, arch="frame", context=0):
+    """
+    Runs inference in chunks of `batch_frames` frames. The input is
+    memory-mapped and the predictions are written incrementally into a
+    pre-allocated memory-mapped `.npy`, so memory stays constant in the
+    length of the input. The next chunk is read while the current one is
+    being processed. Window models get the windows of the frames of a
+    chunk, which only reads `context` more frames on each side.
+
+    With `artifact_path`, only the exported artifact (see `export_model`) is
+    loaded and run on the CPU, and `model_path` is not used.
+    """
+    import torch
+    configure_threads(num_threads)
+
+    X, codec = load_features(path_X)
+    num_keys, N = X.shape
 
     # Define model
-    if layers == 1:
-        model = init_model_single_layer(model_path, num_keys)
-    elif layers == 2:
-        model = init_model_two_layers(model_path, num_keys)
-
-    batch_x = X.transpose(0, 1)
-    batch_x = batch_x.to(device)
-    pred = model(batch_x)
-
-    np.save("P.npy", pred.cpu().detach().transpose(0, 1).numpy())
+    if artifact_path is not None:
+        model = load_artifact(artifact_path)
+        device = torch.device("cpu")
+    else:
+        model = init_model(model_path, num_keys, layers, arch, context)
+        device = get_device()
+    model.eval()
+
+    P = np.lib.format.open_memmap(path_P, mode="w+", dtype=np.float32, shape=(num_keys, N))
+
+    def read_chunk(i):
+        if arch != "frame":
+            return np.ascontiguousarray(read_feature_windows(X, codec, i, min(i + batch_frames, N), context))
+        return np.ascontiguousarray(codec.decode(X[:, i:i+batch_frames]).T)
+
+    starts = range(0, N, batch_frames)
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        next_chunk = executor.submit(read_chunk, 0) if N > 0 else None
+        with torch.no_grad():
+            for i in starts:
+                batch_x = next_chunk.result()
+                if i + batch_frames < N:
+                    next_chunk = executor.submit(read_chunk, i + batch_frames)
+                pred = model(torch.from_numpy(batch_x).to(device))
+                P[:, i:i+len(batch_x)] = pred.cpu().numpy().T
+    finally:
+        executor.shutdown(wait=True)
+
+    P.flush()
+    del P
 
 
 def parse_args(args=sys.argv[1:]):
@@ -166,22 +554,240 @@ def parse_args(args=sys.argv[1:]):
         action='store_true',
         help="Run prediction only",
     )
+    parser.add_argument(
+        "--train-only",
+        action='store_true',
+        help="Run training (and export) only",
+    )
+    parser.add_argument(
+        "--corpus",
+        help="Train on this sharded corpus instead of X.npy/Y.npy",
+    )
+    parser.add_argument(
+        "--data",
+        nargs="+",
+        help="Train on these dataset base paths (<base>_X.npy with <base>_labels.npz or <base>_Y.npy), "
+             "interleaved",
+    )
     parser.add_argument(
         "--model",
         help="Model path",
-        required=True,
+    )
+    parser.add_argument(
+        "--arch",
+        choices=ARCHITECTURES,
+        default="frame",
+        help="Model architecture: the single frame model, or a model of windows of frames",
+    )
+    parser.add_argument(
+        "--context",
+        type=int,
+        default=0,
+        help="Number of frames on each side of the center frame in the windows of the window models",
+    )
+    parser.add_argument(
+        "--augment-shift",
+        type=int,
+        default=0,
+        help="Transpose the training batches by up to this many semitones",
+    )
+    parser.add_argument(
+        "--augment-gain-db",
+        type=float,
+        default=0.0,
+        help="Apply random gains of up to this many dB to the training batches",
+    )
+    parser.add_argument(
+        "--augment-noise",
+        type=float,
+        default=0.0,
+        help="Add noise of this standard deviation, relative to the mean magnitude, to the training batches",
+    )
+    parser.add_argument(
+        "--augment-mask",
+        type=float,
+        default=0.0,
+        help="Zero the frames of training windows but the center frame with this probability",
+    )
+    parser.add_argument(
+        "--bins-per-note",
+        type=int,
+        default=None,
+        help="Bins per semitone of the features for --augment-shift (default: from the corpus or dataset manifests)",
+    )
+    parser.add_argument(
+        "--export",
+        help="Export the trained model to this TorchScript artifact, and predict with it",
+    )
+    parser.add_argument(
+        "--no-quantize",
+        action="store_true",
+        help="Keep the exported artifact in fp32 instead of dynamic int8 quantization",
+    )
+    parser.add_argument(
+        "--artifact",
+        help="Predict with this exported artifact only",
+    )
+    parser.add_argument(
+        "--input",
+        default=None,
+        help="Features to predict on (default: X.npy), also used for the accuracy check of --export "
+             "(default: the first training dataset or corpus shard)",
+    )
+    parser.add_argument(
+        "--output",
+        default="P.npy",
+        help="Where to write the predictions",
+    )
+    parser.add_argument(
+        "--batch-frames",
+        type=int,
+        default=8192,
+        help="Number of frames per inference chunk",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=1,
+        help="Number of passes over the training data",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1024,
+        help="Number of frames per training batch",
+    )
+    parser.add_argument(
+        "--lr",
+        type=float,
+        default=1e-3,
+        help="Learning rate",
+    )
+    parser.add_argument(
+        "--log-every",
+        type=int,
+        default=100,
+        help="Read back and report the loss every this many steps",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Run the forward pass under bfloat16 autocast",
+    )
+    parser.add_argument(
+        "--final-eval",
+        action="store_true",
+        help="Compute the final loss with a separate pass over all data",
+    )
+    parser.add_argument(
+        "--procs",
+        type=int,
+        default=1,
+        help="Number of data-parallel training processes on this node",
+    )
+    parser.add_argument(
+        "--nodes",
+        type=int,
+        default=1,
+        help="Number of nodes in data-parallel training",
+    )
+    parser.add_argument(
+        "--node-rank",
+        type=int,
+        default=0,
+        help="Index of this node in data-parallel training",
+    )
+    parser.add_argument(
+        "--master-addr",
+        default="127.0.0.1",
+        help="Address of node 0 in data-parallel training",
+    )
+    parser.add_argument(
+        "--master-port",
+        type=int,
+        default=29500,
+        help="Port of the rendezvous on node 0 in data-parallel training",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of threads for intra-op parallelism",
+    )
+    parser.add_argument(
+        "--interop-threads",
+        type=int,
+        default=None,
+        help="Number of threads for inter-op parallelism",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Append per-stage timing and memory records to this JSON lines file",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Write cProfile stats of this run to this file",
+    )
+    parser.add_argument(
+        "--torch-profile",
+        default=None,
+        help="Write a torch.profiler Chrome trace of this run to this file",
     )
     args = parser.parse_args(args)
+    if args.model is None and (args.artifact is None or args.export is not None or not args.predict_only):
+        parser.error("--model is required unless predicting with --artifact only")
+    if args.augment_mask > 0 and args.context == 0:
+        parser.error("--augment-mask needs windows of frames (--context > 0)")
     return args
 
 
-def main():
-    args = parse_args()
-
-    if not args.predict_only:
-        train(args.model)
-
-    predict(args.model)
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+
+    if args.trace is not None:
+        instrumentation.configure(args.trace)
+
+    configure_threads(args.threads, args.interop_threads)
+
+    with instrumentation.profile(args.profile), torch_profile(args.torch_profile):
+        if not args.predict_only:
+            train_kwargs = dict(
+                model_path=args.model, corpus_path=args.corpus, datasets=args.data, epochs=args.epochs,
+                batch_size=args.batch_size, lr=args.lr, log_every=args.log_every, bf16=args.bf16,
+                final_eval=args.final_eval, arch=args.arch, context=args.context,
+                augment=dict(bins_per_note=args.bins_per_note, max_shift=args.augment_shift,
+                             gain_db=args.augment_gain_db, noise=args.augment_noise, mask_prob=args.augment_mask))
+            if args.procs > 1 or args.nodes > 1:
+                launch_distributed(args.procs, args.node_rank, args.nodes, args.master_addr, args.master_port,
+                                   args.threads, **train_kwargs)
+            else:
+                train(**train_kwargs)
+
+        if args.node_rank != 0:
+            return
+
+        artifact_path = args.artifact
+        if args.export is not None:
+            with instrumentation.span("export", quantize=not args.no_quantize):
+                export_model(args.model, args.export, quantize=not args.no_quantize, arch=args.arch,
+                             context=args.context)
+            features = check_features(args.input, args.corpus, args.data)
+            if features is None:
+                print("Skipping the artifact check: no features to check on (see --input)")
+            else:
+                report = check_artifact(args.model, args.export, *features, arch=args.arch, context=args.context)
+                print("artifact vs fp32: max error = {max_abs_error:.6f}, mean error = {mean_abs_error:.6f}, "
+                      "decision agreement = {decision_agreement:.4%}".format(**report))
+            artifact_path = args.export
+
+        if args.train_only:
+            return
+
+        with instrumentation.span("predict", artifact=artifact_path is not None):
+            predict(args.model, path_X=args.input if args.input is not None else "X.npy", path_P=args.output,
+                    batch_frames=args.batch_frames, artifact_path=artifact_path, arch=args.arch, context=args.context)
 
 
 if __name__ == "__main__":
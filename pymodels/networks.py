@@ -0,0 +1,79 @@
+"""
+Pytorch models of windows of frames, see model.py.
+"""
+
+from __future__ import print_function
+
+import torch
+import torch.nn.functional as F
+
+
+class WindowLinear(torch.nn.Module):
+    """
+    The frame model over a whole window: one linear layer on all of its
+    frames.
+    """
+    def __init__(self, num_keys, context):
+        super(WindowLinear, self).__init__()
+        self.linear = torch.nn.Linear((2 * context + 1) * num_keys, num_keys)
+
+    @staticmethod
+    def num_keys(state):
+        return state["linear.bias"].shape[0]
+
+    def forward(self, x):
+        # (batch, frames, bins)
+        return torch.sigmoid(self.linear(x.flatten(1)))
+
+
+class TemporalConv(torch.nn.Module):
+    """
+    Convolutions along time with the bins as channels: a kernel of 3 frames,
+    then one over the rest of the window.
+    """
+    def __init__(self, num_keys, context, channels=64):
+        super(TemporalConv, self).__init__()
+        if context < 1:
+            raise ValueError("TemporalConv needs a context of at least 1 frame")
+        self.conv1 = torch.nn.Conv1d(num_keys, channels, kernel_size=3)
+        self.conv2 = torch.nn.Conv1d(channels, num_keys, kernel_size=2 * context - 1)
+
+    @staticmethod
+    def num_keys(state):
+        return state["conv2.bias"].shape[0]
+
+    def forward(self, x):
+        h = F.relu(self.conv1(x.transpose(1, 2)))
+        return torch.sigmoid(self.conv2(h)).squeeze(2)
+
+
+class SpectroConv(torch.nn.Module):
+    """
+    2-D convolutions over (frames, bins). The kernels are shared between the
+    bins, so in the log-frequency layout the same pattern is detected at
+    every pitch; a bias per key sets the detection thresholds.
+    """
+    def __init__(self, num_keys, context, channels=16, bin_kernel=9):
+        super(SpectroConv, self).__init__()
+        if context < 1:
+            raise ValueError("SpectroConv needs a context of at least 1 frame")
+        self.conv1 = torch.nn.Conv2d(1, channels, (3, bin_kernel), padding=(0, bin_kernel // 2))
+        self.conv2 = torch.nn.Conv2d(channels, 1, (2 * context - 1, bin_kernel), padding=(0, bin_kernel // 2),
+                                     bias=False)
+        self.bias = torch.nn.Parameter(torch.zeros(num_keys))
+
+    @staticmethod
+    def num_keys(state):
+        return state["bias"].shape[0]
+
+    def forward(self, x):
+        h = F.relu(self.conv1(x.unsqueeze(1)))
+        return torch.sigmoid(self.conv2(h).flatten(1) + self.bias)
+
+
+# Models of windows of 2 * context + 1 frames, see loader.frame_windows
+WINDOW_MODELS = {
+    "window_linear": WindowLinear,
+    "temporal_conv": TemporalConv,
+    "spectro_conv": SpectroConv,
+}
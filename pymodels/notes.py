@@ -0,0 +1,103 @@
+"""
+Columnar note table.
+
+Notes are stored as a struct of arrays, one NumPy array per attribute,
+instead of one object per note. Generators produce whole note schedules
+with array operations, and MIDI writing, rendering and ground truth
+extraction read the columns directly.
+
+Times and durations are in beats.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+
+COLUMNS = [
+    ("t", np.float64),
+    ("duration", np.float64),
+    ("pitch", np.int64),
+    ("volume", np.int64),
+    ("track", np.int64),
+    ("channel", np.int64),
+    ("program", np.int64),
+]
+
+
+class NoteTable(object):
+    __slots__ = [name for name, _ in COLUMNS]
+
+    def __init__(self, **columns):
+        unknown = set(columns) - set(self.__slots__)
+        if unknown:
+            raise ValueError("Unknown note columns: {}".format(", ".join(sorted(unknown))))
+        lengths = set(len(np.atleast_1d(values)) for values in columns.values())
+        if len(lengths) > 1:
+            raise ValueError("Note columns differ in length: {}".format(sorted(lengths)))
+        length = lengths.pop() if lengths else 0
+        for name, dtype in COLUMNS:
+            if name in columns:
+                values = np.array(columns[name], dtype=dtype, ndmin=1)
+            else:
+                values = np.zeros(length, dtype=dtype)
+            setattr(self, name, values)
+
+    @classmethod
+    def for_instruments(cls, instruments, instrument_ids, t, duration, pitch, volume=100):
+        """
+        Notes played by `instruments[instrument_ids]` (`datagen.Instrument`).
+        All arguments but `t` may be scalars.
+        """
+        t = np.asarray(t, dtype=np.float64)
+        instrument_ids = np.broadcast_to(instrument_ids, t.shape)
+
+        def attribute(name):
+            return np.array([getattr(instrument, name) for instrument in instruments], dtype=np.int64)[instrument_ids]
+
+        return cls(
+            t=t,
+            duration=np.broadcast_to(duration, t.shape),
+            pitch=np.broadcast_to(pitch, t.shape),
+            volume=np.broadcast_to(volume, t.shape),
+            track=attribute("track"),
+            channel=attribute("channel"),
+            program=attribute("instrument_code"),
+        )
+
+    @classmethod
+    def concatenate(cls, tables):
+        return cls(**{name: np.concatenate([getattr(table, name) for table in tables]) for name, _ in COLUMNS})
+
+    def __len__(self):
+        return len(self.t)
+
+    def columns(self):
+        return {name: getattr(self, name) for name, _ in COLUMNS}
+
+    def take(self, indices):
+        return NoteTable(**{name: values[indices] for name, values in self.columns().items()})
+
+    def sorted(self):
+        """
+        Notes ordered by onset (stable for equal onsets).
+        """
+        return self.take(np.argsort(self.t, kind="stable"))
+
+    def shifted(self, dt):
+        return NoteTable(**dict(self.columns(), t=self.t + dt))
+
+    def intervals(self, tempo, sample_rate):
+        """
+        Start and end sample indices of the notes.
+        """
+        def compute_index(beat):
+            t = beat * 60 / tempo
+            return (t * sample_rate).astype(np.int64)
+
+        return compute_index(self.t), compute_index(self.t + self.duration)
+
+    def add_to_midi(self, midi_file):
+        columns = [self.track, self.channel, self.pitch, self.t, self.duration, self.volume]
+        for track, channel, pitch, t, duration, volume in zip(*[values.tolist() for values in columns]):
+            midi_file.addNote(track, channel, pitch, t, duration, volume)
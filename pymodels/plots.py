@@ -0,0 +1,232 @@
+"""
+Dataset diagnostics plots
+"""
+
+from __future__ import division, print_function
+
+import multiprocessing.util
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import instrumentation
+
+# matplotlib, librosa.display and rainbow are only imported for actual
+# plotting, they take seconds to load.
+
+
+def use_agg_backend():
+    """
+    Switches to the non-interactive backend. If pyplot has not been
+    imported yet, this does not import it.
+    """
+    if "matplotlib.pyplot" in sys.modules:
+        sys.modules["matplotlib.pyplot"].switch_backend("Agg")
+    else:
+        os.environ["MPLBACKEND"] = "Agg"
+
+
+def decimate_frames(data, max_frames):
+    """
+    Reduces the time axis to at most `max_frames` frames by taking the
+    maximum over groups of frames, which keeps short notes visible.
+    Returns the data and the decimation factor.
+    """
+    num_frames = data.shape[1]
+    if max_frames is None or num_frames <= max_frames:
+        return data, 1
+    factor = int(np.ceil(num_frames / max_frames))
+    num_groups = int(np.ceil(num_frames / factor))
+    padded = np.full((data.shape[0], num_groups * factor), -np.inf, dtype=data.dtype)
+    padded[:, :num_frames] = data
+    return padded.reshape(data.shape[0], num_groups, factor).max(axis=2), factor
+
+
+def value_histogram(data, bins=200, max_samples=None):
+    """
+    Histogram of all values, or of a fixed random subsample of
+    `max_samples` values.
+    """
+    data = data.ravel()
+    if max_samples is not None and len(data) > max_samples:
+        data = data[np.random.RandomState(0).randint(0, len(data), max_samples)]
+    return np.histogram(data, bins=bins)
+
+
+def plot_files(base_path, with_phase=True):
+    """
+    Files written by `plot_dataset`.
+    """
+    names = ["0_gt", "1_db", "delta_t", "delta_b", "value_distribution"] + (["rainbow"] if with_phase else [])
+    return ["{}_{}.png".format(base_path, name) for name in names]
+
+
+def plot_dataset(C, groundtruth, base_path, sr, lowest_note_hz, hop_length, bins_per_octave, interactive_plots,
+                 max_preview_frames=None, hist_samples=None):
+    """
+    Writes the diagnostic plots of a dataset. `C` is the complex CQT, or just
+    its magnitudes, in which case the rainbow plot is skipped. With
+    `max_preview_frames`, the raw images of long recordings are decimated
+    in time; with `hist_samples`, the value distributions are estimated
+    from a subsample.
+    """
+    import librosa
+    import librosa.display
+    import matplotlib.pyplot as plt
+    import rainbow
+
+    mag = np.abs(C)
+    db = librosa.amplitude_to_db(mag, ref=np.max)
+
+    def raw_plot(data, filename, cmap=None):
+        dpi = 72
+        height, width = np.array(data.shape, dtype=float) / dpi
+
+        fig = plt.figure(figsize=(width, height), dpi=dpi)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.axis('off')
+
+        if cmap is None:
+            cmap = librosa.display.cmap(data)
+
+        ax.imshow(data[::-1, :], interpolation='none', cmap=cmap)
+        fig.savefig(filename, dpi=dpi)
+        plt.close(fig)
+
+    def plot_with_axis_annotations(data, ax=None, with_color_bar=True):
+        librosa.display.specshow(
+            data,
+            sr=sr,
+            fmin=lowest_note_hz,
+            hop_length=hop_length,
+            bins_per_octave=bins_per_octave,
+            x_axis='time',
+            y_axis='cqt_note',
+            ax=ax,
+        )
+
+    groundtruth_preview, _ = decimate_frames(groundtruth, max_preview_frames)
+    db_preview, factor = decimate_frames(db, max_preview_frames)
+
+    raw_plot(
+        groundtruth_preview,
+        "{}_0_gt.png".format(base_path))
+
+    raw_plot(
+        db_preview,
+        "{}_1_db.png".format(base_path))
+
+    raw_plot(
+        db_preview[:, 1:] - db_preview[:, :-1],
+        "{}_delta_t.png".format(base_path), cmap="magma")
+
+    raw_plot(
+        db_preview[1:, :] - db_preview[:-1, :],
+        "{}_delta_b.png".format(base_path), cmap="magma")
+
+    # Value distribution, each histogram is computed once and drawn from
+    # its counts
+    fig, axes = plt.subplots(2, 2, figsize=(16, 10))
+
+    for col, data in enumerate([mag, db]):
+        values, base = value_histogram(data, bins=200, max_samples=hist_samples)
+        axes[0, col].hist(base[:-1], bins=base, weights=values)
+        cumulative = np.cumsum(values)
+        axes[1, col].plot(base[:-1], cumulative / cumulative[-1], c='blue')
+
+    fig.suptitle(
+        "min(mag) = {}    "
+        "max(mag) = {}    "
+        "min(db) = {}    "
+        "max(db) = {}    ".format(mag.min(), mag.max(), db.min(), db.max()))
+    fig.tight_layout()
+    plt.savefig("{}_value_distribution.png".format(base_path))
+    plt.close(fig)
+
+    # Rainbow (requires phase)
+    if np.iscomplexobj(C):
+        fig, ax = plt.subplots(1, 1, figsize=(16, 10))
+        rainbow.plot_rainbow(ax, C[:, ::factor])
+        fig.tight_layout()
+        plt.savefig("{}_rainbow.png".format(base_path))
+        if not interactive_plots:
+            plt.close(fig)
+
+    if interactive_plots:
+        fig, axes = plt.subplots(2, 1, figsize=(16, 10), sharex=True, sharey=True)
+        plot_with_axis_annotations(db, axes[0])
+        plot_with_axis_annotations(groundtruth, axes[1])
+
+        # We need to fetch the QuadMesh instance to pass to colorbar
+        plt.colorbar(axes[0].get_children()[0], ax=axes[0], format='%+2.0f dB')
+        plt.colorbar(axes[1].get_children()[0], ax=axes[1])
+        fig.tight_layout()
+
+    if interactive_plots:
+        plt.show()
+
+
+class SyncPlotter(object):
+    """
+    Plots in the calling process. `on_done` is called once the plots are
+    written.
+    """
+    def __init__(self, max_preview_frames=None, hist_samples=None):
+        self.max_preview_frames = max_preview_frames
+        self.hist_samples = hist_samples
+
+    def plot(self, *args, **kwargs):
+        on_done = kwargs.pop("on_done", None)
+        plot_dataset(*args, max_preview_frames=self.max_preview_frames, hist_samples=self.hist_samples)
+        if on_done is not None:
+            on_done()
+
+    def close(self):
+        pass
+
+
+def _init_plot_worker():
+    use_agg_backend()
+
+
+def _plot_dataset_traced(C, groundtruth, base_path, *args, **kwargs):
+    with instrumentation.span("plot_dataset", dataset=os.path.basename(base_path)):
+        plot_dataset(C, groundtruth, base_path, *args, **kwargs)
+
+
+class PlotPool(object):
+    """
+    Plots asynchronously on a pool of worker processes, so that plotting
+    does not hold up dataset generation. `close` waits for all pending
+    plots; it is also called when the owning process exits. `on_done` is
+    called in the owning process once the plots of a dataset are written.
+    """
+    def __init__(self, num_workers=1, max_preview_frames=4096, hist_samples=1000000):
+        self.max_preview_frames = max_preview_frames
+        self.hist_samples = hist_samples
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_plot_worker)
+        self.futures = []
+        multiprocessing.util.Finalize(self, self.executor.shutdown, kwargs={"wait": True}, exitpriority=20)
+
+    def plot(self, C, groundtruth, base_path, sr, lowest_note_hz, hop_length, bins_per_octave, interactive_plots,
+             on_done=None):
+        if interactive_plots:
+            raise ValueError("Interactive plots require synchronous plotting")
+        self.futures = [future for future in self.futures if not future.done() or future.exception()]
+        future = self.executor.submit(
+            _plot_dataset_traced, C, groundtruth, base_path, sr, lowest_note_hz, hop_length, bins_per_octave, False,
+            max_preview_frames=self.max_preview_frames, hist_samples=self.hist_samples,
+        )
+        if on_done is not None:
+            future.add_done_callback(lambda future: future.exception() is None and on_done())
+        self.futures.append(future)
+
+    def close(self):
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait=True)
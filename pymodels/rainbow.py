@@ -15,6 +15,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy.io.wavfile import read as readwav
 
+from feature_cache import cached_cqt
+
 
 # Plotting functions
 cdict = {'red': ((0.0, 0.0, 0.0),
@@ -51,7 +53,7 @@ def plot_rainbow(ax, C):
     ax.matshow(mag[::-1, :], cmap=my_mask, aspect="auto")
 
 
-def note_specgram(path, ax, use_cqt=True):
+def note_specgram(path, ax, use_cqt=True, cache=None):
 
     # Add several samples together
     if isinstance(path, list):
@@ -71,11 +73,11 @@ def note_specgram(path, ax, use_cqt=True):
         res_factor = 1.0    # 0.8
         octaves = 6
         notes_per_octave = 12
-        C = librosa.cqt(audio, sr=sr, hop_length=hop_length,
-                        bins_per_octave=int(notes_per_octave * over_sample),
-                        n_bins=int(octaves * notes_per_octave * over_sample),
-                        filter_scale=res_factor,
-                        fmin=librosa.note_to_hz('C3'))
+        C = cached_cqt(audio, cache, with_phase=True, sr=sr, hop_length=hop_length,
+                       bins_per_octave=int(notes_per_octave * over_sample),
+                       n_bins=int(octaves * notes_per_octave * over_sample),
+                       filter_scale=res_factor,
+                       fmin=librosa.note_to_hz('C3'))
     else:
         n_fft = 512
         C = librosa.stft(audio, n_fft=n_fft, win_length=n_fft, hop_length=hop_length, center=True)
@@ -84,7 +86,7 @@ def note_specgram(path, ax, use_cqt=True):
 
 
 def plot_notes(list_of_paths, rows=2, cols=4, col_labels=[], row_labels=[],
-               use_cqt=True, peak=70.0):
+               use_cqt=True, peak=70.0, cache=None):
     """Build a CQT rowsXcols.
     """
 
@@ -110,7 +112,7 @@ def plot_notes(list_of_paths, rows=2, cols=4, col_labels=[], row_labels=[],
         else:
             ax = axes[row, col]
 
-        note_specgram(path, ax, use_cqt)
+        note_specgram(path, ax, use_cqt, cache)
 
         """
         ax.set_xticks([]);
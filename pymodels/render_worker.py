@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Persistent render worker.
+
+A worker is a long-lived process that renders MIDI files to mono float32
+audio. It loads the soundfont once at startup, so that rendering a dataset
+only costs the synthesis itself, instead of a new fluidsynth process (and
+soundfont load) plus a sox downmix per dataset.
+
+Requests and responses are exchanged over the stdin/stdout pipes of the
+worker:
+
+    request:   <u8 length> <MIDI file bytes>
+    response:  <i4 status> <u8 length> <payload>
+
+where the payload is the float32 samples if the status is 0, or an UTF-8
+error message otherwise. The worker exits when its stdin is closed.
+
+Backends:
+- "fluidsynth": libfluidsynth through ctypes, rendering as fast as possible
+  like `fluidsynth -F`, downmixed to mono in NumPy (like `sox channels 1`)
+- "standin": parses the MIDI file and renders it with the wavetable
+  synthesizer of synth.py, for tests without fluidsynth
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import struct
+import subprocess
+import sys
+
+import numpy as np
+
+
+REQUEST_HEADER = struct.Struct("<Q")
+RESPONSE_HEADER = struct.Struct("<iQ")
+
+BACKENDS = ["fluidsynth", "standin"]
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError("Render worker pipe closed")
+    return data
+
+
+class RenderWorker(object):
+    """
+    Client side of a render worker process.
+    """
+    def __init__(self, backend="fluidsynth", soundfont=None, sample_rate=44100):
+        self.backend = backend
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        args = [sys.executable, os.path.abspath(__file__), "--backend", backend, "--sample-rate", str(sample_rate)]
+        if soundfont is not None:
+            args += ["--soundfont", soundfont]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def render(self, midi_bytes):
+        """
+        Renders the MIDI file `midi_bytes` to mono float32 samples.
+        """
+        try:
+            self.process.stdin.write(REQUEST_HEADER.pack(len(midi_bytes)))
+            self.process.stdin.write(midi_bytes)
+            self.process.stdin.flush()
+            status, length = RESPONSE_HEADER.unpack(_read_exact(self.process.stdout, RESPONSE_HEADER.size))
+            payload = _read_exact(self.process.stdout, length)
+        except (EOFError, IOError, OSError):
+            # the worker closed its pipes, i.e. it is exiting
+            raise RuntimeError("Render worker ({}) exited with code {}".format(self.backend, self.process.wait()))
+        if status != 0:
+            raise RuntimeError("Render worker ({}) failed: {}".format(self.backend, payload.decode("utf-8")))
+        return np.frombuffer(payload, dtype=np.float32)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class FluidsynthBackend(object):
+    # enum fluid_player_status
+    FLUID_PLAYER_PLAYING = 1
+
+    def __init__(self, soundfont, sample_rate, period_size=64, block_samples=1 << 20):
+        import ctypes
+        import ctypes.util
+
+        path = ctypes.util.find_library("fluidsynth")
+        if path is None:
+            raise RuntimeError("libfluidsynth not found")
+        lib = ctypes.CDLL(path)
+        for name, restype, argtypes in [
+            ("new_fluid_settings", ctypes.c_void_p, []),
+            ("fluid_settings_setnum", ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_double]),
+            ("fluid_settings_setstr", ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]),
+            ("new_fluid_synth", ctypes.c_void_p, [ctypes.c_void_p]),
+            ("fluid_synth_sfload", ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]),
+            ("fluid_synth_system_reset", ctypes.c_int, [ctypes.c_void_p]),
+            ("fluid_synth_write_float", ctypes.c_int, [ctypes.c_void_p, ctypes.c_int,
+                                                       ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+                                                       ctypes.c_void_p, ctypes.c_int, ctypes.c_int]),
+            ("new_fluid_player", ctypes.c_void_p, [ctypes.c_void_p]),
+            ("delete_fluid_player", None, [ctypes.c_void_p]),
+            ("fluid_player_add_mem", ctypes.c_int, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]),
+            ("fluid_player_play", ctypes.c_int, [ctypes.c_void_p]),
+            ("fluid_player_get_status", ctypes.c_int, [ctypes.c_void_p]),
+        ]:
+            getattr(lib, name).restype = restype
+            getattr(lib, name).argtypes = argtypes
+        self.lib = lib
+        self.period_size = period_size
+        self.block_samples = block_samples
+
+        settings = lib.new_fluid_settings()
+        lib.fluid_settings_setnum(settings, b"synth.sample-rate", sample_rate)
+        # as `fluidsynth -F`: the player is driven by the rendered samples
+        lib.fluid_settings_setstr(settings, b"player.timing-source", b"sample")
+        self.synth = lib.new_fluid_synth(settings)
+        if lib.fluid_synth_sfload(self.synth, soundfont.encode("utf-8"), 1) < 0:
+            raise RuntimeError("Failed to load soundfont {}".format(soundfont))
+
+    def render(self, midi_bytes):
+        lib = self.lib
+        lib.fluid_synth_system_reset(self.synth)
+        player = lib.new_fluid_player(self.synth)
+        try:
+            if lib.fluid_player_add_mem(player, midi_bytes, len(midi_bytes)) != 0:
+                raise ValueError("Invalid MIDI file")
+            lib.fluid_player_play(player)
+
+            # Both channels are rendered into one interleaved block, one
+            # period at a time (the player status is updated per period)
+            blocks = []
+            block = np.empty((self.block_samples, 2), dtype=np.float32)
+            pos = 0
+            while lib.fluid_player_get_status(player) == self.FLUID_PLAYER_PLAYING:
+                if pos == self.block_samples:
+                    blocks.append(block)
+                    block = np.empty((self.block_samples, 2), dtype=np.float32)
+                    pos = 0
+                address = block.ctypes.data
+                lib.fluid_synth_write_float(self.synth, self.period_size, address, 2 * pos, 2, address, 2 * pos + 1, 2)
+                pos += self.period_size
+            blocks.append(block[:pos])
+        finally:
+            lib.delete_fluid_player(player)
+
+        stereo = np.concatenate(blocks)
+        return stereo.mean(axis=1, dtype=np.float32)
+
+
+def parse_midi(midi_bytes):
+    """
+    Notes and tempo (of the first tempo event) of a standard MIDI file, as
+    a `notes.NoteTable` in beats.
+    """
+    from notes import NoteTable
+
+    if midi_bytes[:4] != b"MThd":
+        raise ValueError("Invalid MIDI file")
+    header_length, _, num_tracks, division = struct.unpack(">IHHH", midi_bytes[4:14])
+    if division & 0x8000:
+        raise ValueError("SMPTE time division is not supported")
+    pos = 8 + header_length
+
+    tempo = None
+    columns = {"t": [], "duration": [], "pitch": [], "volume": [], "channel": [], "program": []}
+    for track in range(num_tracks):
+        chunk_type, length = struct.unpack(">4sI", midi_bytes[pos:pos + 8])
+        data = midi_bytes[pos + 8:pos + 8 + length]
+        pos += 8 + length
+        if chunk_type != b"MTrk":
+            continue
+
+        programs = {}
+        playing = {}
+        tick = 0
+        i = 0
+        status = None
+        while i < len(data):
+            delta = 0
+            while True:
+                delta = (delta << 7) | (data[i] & 0x7F)
+                i += 1
+                if data[i - 1] < 0x80:
+                    break
+            tick += delta
+
+            if data[i] >= 0x80:
+                status = data[i]
+                i += 1
+            if status == 0xFF:
+                meta_type, length = data[i], data[i + 1]
+                if meta_type == 0x51 and tempo is None:
+                    tempo = 60e6 / int.from_bytes(data[i + 2:i + 5], "big")
+                i += 2 + length
+                status = None
+            elif status in (0xF0, 0xF7):
+                length = 0
+                while True:
+                    length = (length << 7) | (data[i] & 0x7F)
+                    i += 1
+                    if data[i - 1] < 0x80:
+                        break
+                i += length
+                status = None
+            else:
+                kind, channel = status & 0xF0, status & 0x0F
+                num_data = 1 if kind in (0xC0, 0xD0) else 2
+                args = data[i:i + num_data]
+                i += num_data
+                if kind == 0xC0:
+                    programs[channel] = args[0]
+                elif kind == 0x90 and args[1] > 0:
+                    playing.setdefault((channel, args[0]), []).append((tick, args[1]))
+                elif kind in (0x80, 0x90) and playing.get((channel, args[0])):
+                    start, volume = playing[(channel, args[0])].pop(0)
+                    columns["t"].append(start / division)
+                    columns["duration"].append((tick - start) / division)
+                    columns["pitch"].append(args[0])
+                    columns["volume"].append(volume)
+                    columns["channel"].append(channel)
+                    columns["program"].append(programs.get(channel, 0))
+
+    notes = NoteTable(track=np.zeros(len(columns["t"]), dtype=np.int64), **columns)
+    return notes.sorted(), tempo if tempo is not None else 120.0
+
+
+class StandinBackend(object):
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+
+    def render(self, midi_bytes):
+        import synth
+        notes, tempo = parse_midi(midi_bytes)
+        return synth.render_notes(notes, tempo, self.sample_rate)
+
+
+def make_backend(backend, soundfont, sample_rate):
+    if backend == "fluidsynth":
+        return FluidsynthBackend(soundfont, sample_rate)
+    elif backend == "standin":
+        return StandinBackend(sample_rate)
+    raise ValueError("Unknown render backend: {} (available: {})".format(backend, ", ".join(BACKENDS)))
+
+
+def serve(backend, f_in, f_out):
+    while True:
+        try:
+            length, = REQUEST_HEADER.unpack(_read_exact(f_in, REQUEST_HEADER.size))
+            midi_bytes = _read_exact(f_in, length)
+        except EOFError:
+            return
+        try:
+            payload = np.ascontiguousarray(backend.render(midi_bytes), dtype=np.float32).tobytes()
+            status = 0
+        except Exception as e:
+            payload = "{}: {}".format(type(e).__name__, e).encode("utf-8")
+            status = 1
+        f_out.write(RESPONSE_HEADER.pack(status, len(payload)))
+        f_out.write(payload)
+        f_out.flush()
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Render worker, see render_worker.py")
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="fluidsynth",
+        help="Render backend",
+    )
+    parser.add_argument(
+        "--soundfont",
+        default=None,
+        help="Soundfont of the fluidsynth backend",
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=44100,
+        help="Sample rate",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+
+    # The protocol owns stdout; anything the backends print goes to stderr
+    f_out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    backend = make_backend(args.backend, args.soundfont, args.sample_rate)
+    serve(backend, sys.stdin.buffer, f_out)
+
+
+if __name__ == "__main__":
+    main()
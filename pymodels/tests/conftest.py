@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# The modules of pymodels import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class HopMultipleRenderer(object):
+    """
+    Synthesizer renders cut to a multiple of the hop length, where the
+    centered CQT has one frame more than the hops covering the samples.
+    """
+    writes_wave = False
+
+    def params(self):
+        return {"renderer": "hop_multiple"}
+
+    def render(self, mfw, base_path):
+        import datagen
+        sr, wave_data = datagen.SynthRenderer().render(mfw, base_path)
+        return sr, wave_data[:len(wave_data) // datagen.HOP_LENGTH * datagen.HOP_LENGTH]
+
+
+@pytest.fixture
+def hop_multiple_renderer():
+    return HopMultipleRenderer()
+
+
+@pytest.fixture
+def short_midi():
+    import datagen
+    datagen.seed_rngs(0)
+    return datagen.generate_midi_random_single_notes(duration=3.0)
@@ -0,0 +1,40 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import datagen
+from augment import Augmentation
+from corpus import CorpusWriter
+
+
+def test_mask_keeps_center_frame():
+    augmentation = Augmentation(mask_prob=0.9, seed=0)
+    x = np.ones((256, 5, 8), dtype=np.float32)
+    y = np.ones((256, 8), dtype=np.float32)
+    augmentation(x, y)
+    assert (x[:, 2] == 1).all()
+    assert (x[:, [0, 1, 3, 4]] == 0).any()
+    assert (y == 1).all()
+
+    frames = np.ones((256, 8), dtype=np.float32)
+    augmentation(frames, y)
+    assert (frames == 1).all()
+
+
+def test_shift_needs_bins_per_note():
+    with pytest.raises(ValueError):
+        Augmentation(max_shift=2)
+
+
+@pytest.mark.parametrize("features, expected", [("cqt", datagen.BINS_PER_NOTE), ("filterbank", 1)])
+def test_data_bins_per_note(tmp_path, short_midi, features, expected):
+    model = pytest.importorskip("model")
+    base_path = str(tmp_path / "datasets" / "dataset_001")
+    corpus = CorpusWriter(str(tmp_path / "corpus"))
+    for destination in [None, corpus]:
+        datagen.generate_dataset(short_midi, base_path, features=features, renderer=datagen.SynthRenderer(),
+                                 corpus=destination, plotter=None)
+    assert model.data_bins_per_note(datasets=[base_path]) == expected
+    assert model.data_bins_per_note(corpus_path=corpus.root) == expected
+    assert model.data_bins_per_note() is None
@@ -0,0 +1,66 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import cqt
+import datagen
+
+librosa = pytest.importorskip("librosa")
+
+# relative to the largest magnitude, the float32 results agree to about 1e-7
+RTOL = 1e-5
+
+
+@pytest.fixture(scope="module")
+def signal():
+    datagen.seed_rngs(0)
+    sample_rate, wave_data = datagen.SynthRenderer().render(datagen.generate_midi_random_single_notes(3.0), None)
+    params = {
+        "sr": sample_rate,
+        "fmin": librosa.note_to_hz(datagen.LOWEST_NOTE_NAME),
+        "n_bins": datagen.N_OCTAVES * 12 * datagen.BINS_PER_NOTE,
+        "bins_per_octave": 12 * datagen.BINS_PER_NOTE,
+        "hop_length": datagen.HOP_LENGTH,
+        "filter_scale": 1.0,
+        "tuning": 0.0,
+    }
+    return wave_data, params
+
+
+def assert_close(actual, expected):
+    assert actual.shape == expected.shape
+    assert np.abs(actual - expected).max() <= RTOL * np.abs(expected).max()
+
+
+def test_engine_matches_librosa(signal):
+    y, params = signal
+    engine = cqt.get_engine(**params)
+    expected = librosa.cqt(y, **params)
+    C = engine.transform(y)
+    assert C.dtype == expected.dtype
+    assert_close(C, expected)
+
+    # a batch gives the same as the signals one by one
+    ys = [y[:44100], y[44100:88200]]
+    batch = engine.transform_batch(ys)
+    for C, y_i in zip(batch, ys):
+        assert_close(C, engine.transform(y_i))
+
+
+@pytest.mark.parametrize("num_samples", [None, 200 * datagen.HOP_LENGTH])
+@pytest.mark.parametrize("block_frames", [64, 100])
+def test_stream_matches_one_shot(signal, num_samples, block_frames):
+    y, params = signal
+    y = y[:num_samples]
+    expected = cqt.get_engine(**params).transform(y)
+    assert expected.shape[1] == cqt.frame_count(len(y), params["hop_length"])
+
+    offsets = []
+    blocks = []
+    for frame_from, C in cqt.stream_cqt(y, block_frames=block_frames, **params):
+        offsets.append(frame_from)
+        blocks.append(C)
+    assert len(blocks) > 1
+    assert offsets == [sum(C.shape[1] for C in blocks[:i]) for i in range(len(blocks))]
+    assert_close(np.concatenate(blocks, axis=1), expected)
@@ -0,0 +1,55 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import datagen
+from corpus import Corpus, CorpusWriter
+from notes import NoteTable
+
+
+@pytest.mark.parametrize("features", datagen.FEATURES)
+@pytest.mark.parametrize("labels", ["events", "dense"])
+def test_corpus_shard_with_hop_multiple_length(tmp_path, short_midi, hop_multiple_renderer, features, labels):
+    corpus = CorpusWriter(str(tmp_path / "corpus"))
+    base_path = str(tmp_path / "datasets" / "dataset_001")
+    datagen.generate_dataset(short_midi, base_path, features=features, renderer=hop_multiple_renderer,
+                             corpus=corpus, plotter=None, labels=labels)
+
+    raw_length = datagen.Manifest(base_path).stage("render")["raw_length"]
+    assert raw_length % datagen.HOP_LENGTH == 0
+    X, Y = Corpus(corpus.root).shard_arrays(0)
+    assert X.shape == Y.shape
+
+
+def test_corpus_shards_are_only_replaced_by_their_dataset(tmp_path, short_midi):
+    corpus = CorpusWriter(str(tmp_path / "corpus"))
+    base_path = str(tmp_path / "run_1" / "dataset_001")
+    options = dict(renderer=datagen.SynthRenderer(), corpus=corpus, plotter=None)
+    datagen.generate_dataset(short_midi, base_path, **options)
+
+    # rebuilding the same dataset replaces its shard
+    assert "features" in datagen.generate_dataset(short_midi, base_path, x_encoding="float16", **options)
+    assert datagen.generate_dataset(short_midi, base_path, force=True, **options)
+    assert len(Corpus(corpus.root).shards) == 1
+
+    # a dataset of the same name from another output directory does not
+    with pytest.raises(ValueError, match="already contains a shard"):
+        datagen.generate_dataset(short_midi, str(tmp_path / "run_2" / "dataset_001"), **options)
+    assert len(Corpus(corpus.root).shards) == 1
+
+
+def test_add_note_matches_add_notes():
+    instrument = datagen.Instrument(instrument_code=0, track=0, channel=0)
+    single, batch = datagen.MidiFileWrapper(), datagen.MidiFileWrapper()
+    t = [0.0, 0.5, 1.25]
+    for i, onset in enumerate(t):
+        single.add_note(instrument, 60 + i, onset, 0.5)
+    batch.add_notes(NoteTable.for_instruments([instrument], 0, t, 0.5, [60, 61, 62]))
+
+    for name, values in batch.notes.columns().items():
+        np.testing.assert_array_equal(single.notes.columns()[name], values)
+    assert datagen.midi_bytes(single.midi_file) == datagen.midi_bytes(batch.midi_file)
+    # notes added after a read are still collected
+    single.add_note(instrument, 70, 2.0, 0.5)
+    assert list(single.notes.pitch) == [60, 61, 62, 70]
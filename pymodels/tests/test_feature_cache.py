@@ -0,0 +1,21 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+from feature_cache import FeatureCache, cached_cqt
+
+
+PARAMS = {"sr": 22050, "hop_length": 512, "fmin": 55.0, "n_bins": 24, "bins_per_octave": 12, "tuning": 0.0}
+
+
+@pytest.mark.parametrize("with_phase", [False, True])
+def test_hit_matches_miss(tmp_path, with_phase):
+    y = np.random.RandomState(0).randn(22050).astype(np.float32)
+    cache = FeatureCache(str(tmp_path))
+    miss = cached_cqt(y, cache, with_phase=with_phase, **PARAMS)
+    hit = cached_cqt(y, cache, with_phase=with_phase, **PARAMS)
+    uncached = cached_cqt(y, None, with_phase=with_phase, **PARAMS)
+    assert miss.dtype == hit.dtype == uncached.dtype
+    assert miss.dtype == (np.complex64 if with_phase else np.float32)
+    np.testing.assert_allclose(hit, miss, rtol=1e-5, atol=1e-6)
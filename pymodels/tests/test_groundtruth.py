@@ -0,0 +1,90 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import datagen
+import groundtruth
+from notes import NoteTable
+
+
+SAMPLE_RATE = 44100
+HOP_LENGTH = 512
+LOWEST_NOTE = 48
+HIGHEST_NOTE = 72
+
+
+def baseline_coverage(rows, starts, ends, num_rows, raw_length, hop_length):
+    """
+    Coverage as it was computed before `groundtruth.interval_coverage`: the
+    intervals rasterized at sample rate, averaged per hop.
+    """
+    raw_data = np.zeros((num_rows, raw_length), dtype=np.int8)
+    for row, start, end in zip(rows, starts, ends):
+        raw_data[row, start:end] = 1
+    return np.stack([raw_data[:, i:i + hop_length].mean(axis=1) for i in range(raw_length)[::hop_length]], axis=1)
+
+
+def baseline_groundtruth(mfw, raw_length, bins_per_note):
+    def compute_index(beat):
+        t = beat * 60 / mfw.tempo
+        return int(t * SAMPLE_RATE)
+
+    notes = mfw.notes
+    rows = [(pitch - LOWEST_NOTE) * bins_per_note for pitch in notes.pitch.tolist()]
+    starts = [compute_index(t) for t in notes.t.tolist()]
+    ends = [compute_index(t + duration) for t, duration in zip(notes.t.tolist(), notes.duration.tolist())]
+    return baseline_coverage(rows, starts, ends, (HIGHEST_NOTE - LOWEST_NOTE) * bins_per_note, raw_length,
+                             HOP_LENGTH)
+
+
+def random_schedule(seed, num_notes=200):
+    """
+    Random notes over 10 beats, with notes that start at the first sample
+    and end after the last one (the audio is cut at 10 beats).
+    """
+    rng = np.random.default_rng(seed)
+    t = np.concatenate([[0.0, 9.5, 9.999], rng.uniform(0, 10, num_notes)])
+    duration = np.concatenate([[0.3, 0.5, 1.0], rng.uniform(0.001, 2, num_notes)])
+    pitch = rng.integers(LOWEST_NOTE, HIGHEST_NOTE, len(t))
+    mfw = datagen.MidiFileWrapper(tempo=120)
+    mfw.add_notes(NoteTable(t=t, duration=duration, pitch=pitch).sorted())
+    return mfw
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("raw_length", [5 * SAMPLE_RATE, 430 * HOP_LENGTH])
+@pytest.mark.parametrize("bins_per_note", [1, 4])
+def test_note_events_match_baseline(seed, raw_length, bins_per_note):
+    mfw = random_schedule(seed)
+    expected = baseline_groundtruth(mfw, raw_length, bins_per_note)
+    assert expected[:, 0].any() and expected[:, -1].any()
+
+    events = mfw.extract_note_events(raw_length, SAMPLE_RATE, HOP_LENGTH, LOWEST_NOTE, HIGHEST_NOTE, bins_per_note)
+    np.testing.assert_array_equal(events.to_dense(), expected)
+
+    # with the frame count of the CQT, a length that is a multiple of the hop gets an empty last frame
+    num_frames = 1 + raw_length // HOP_LENGTH
+    events = mfw.extract_note_events(raw_length, SAMPLE_RATE, HOP_LENGTH, LOWEST_NOTE, HIGHEST_NOTE, bins_per_note,
+                                     num_frames=num_frames)
+    dense = events.to_dense()
+    assert dense.shape[1] == num_frames
+    np.testing.assert_array_equal(dense[:, :expected.shape[1]], expected)
+    assert (dense[:, expected.shape[1]:] == 0).all()
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("raw_length", [10000, 20 * HOP_LENGTH])
+def test_interval_coverage_matches_baseline(seed, raw_length):
+    rng = np.random.default_rng(seed)
+    num_rows = 8
+    # overlapping, adjacent, empty and out of range intervals
+    starts = rng.integers(-100, raw_length, 100)
+    ends = starts + rng.integers(-10, 3 * HOP_LENGTH, 100)
+    rows = rng.integers(0, num_rows, 100)
+    starts[:3], ends[:3], rows[:3] = [0, 700, 700], [300, 700, raw_length + 50], 0
+
+    expected = baseline_coverage(rows, np.maximum(starts, 0), ends, num_rows, raw_length, HOP_LENGTH)
+    coverage = groundtruth.interval_coverage(rows, starts, ends, num_rows, raw_length, HOP_LENGTH)
+    assert coverage.dtype == expected.dtype
+    np.testing.assert_array_equal(coverage, expected)
@@ -0,0 +1,36 @@
+"""
+The CLI defers heavy imports to the subcommands that need them, see cli.py.
+"""
+
+from __future__ import division, print_function
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+PYMODELS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["scipy.signal", "matplotlib", "torch", "librosa"]
+
+
+def loaded_modules(module):
+    output = subprocess.check_output(
+        [sys.executable, "-c", "import sys, {}; print('\\n'.join(sys.modules))".format(module)],
+        cwd=PYMODELS_DIR)
+    return set(output.decode("utf-8").split())
+
+
+@pytest.mark.parametrize("module", ["datagen", "cli", "model"])
+def test_no_heavy_imports(module):
+    modules = loaded_modules(module)
+    assert [name for name in HEAVY_MODULES if name in modules] == []
+
+
+def test_architectures():
+    pytest.importorskip("torch")
+    import model
+    import networks
+    assert model.ARCHITECTURES == ["frame"] + sorted(networks.WINDOW_MODELS)
@@ -0,0 +1,27 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import datagen
+from features import load_features
+from loader import ArraySource, FrameLoader
+
+
+@pytest.mark.parametrize("labels", ["events", "dense"])
+def test_dataset_with_hop_multiple_length(tmp_path, short_midi, hop_multiple_renderer, labels):
+    base_path = str(tmp_path / "dataset_001")
+    datagen.generate_dataset(short_midi, base_path, renderer=hop_multiple_renderer, plotter=None, labels=labels)
+    assert datagen.Manifest(base_path).stage("render")["raw_length"] % datagen.HOP_LENGTH == 0
+
+    source = ArraySource.from_dataset(base_path)
+    X, codec = load_features("{}_X.npy".format(base_path))
+    assert source.num_frames == X.shape[1]
+
+    batches = list(FrameLoader([source], batch_size=64, shuffle=False))
+    x = np.concatenate([batch_x for batch_x, _ in batches])
+    y = np.concatenate([batch_y for _, batch_y in batches])
+    assert len(x) == len(y) == X.shape[1]
+    np.testing.assert_array_equal(x, codec.decode(X).T)
+    # the frame past the end of the audio has no notes
+    assert not y[-1].any()
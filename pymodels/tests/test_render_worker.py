@@ -0,0 +1,36 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import datagen
+import render_worker
+import synth
+
+
+@pytest.fixture
+def standin_renderer():
+    yield datagen.make_renderer("standin")
+    datagen.close_render_workers()
+
+
+def test_worker_renderer(tmp_path, short_midi, standin_renderer):
+    base_path = str(tmp_path / "dataset_001")
+    sample_rate, wave_data = standin_renderer.render(short_midi, base_path)
+
+    # the stand-in renders the notes of the stored MIDI file, quantized to 16 bit like the WAVE file
+    notes, tempo = render_worker.parse_midi(datagen.midi_bytes(short_midi.midi_file))
+    assert list(notes.pitch) == list(short_midi.notes.pitch)
+    expected = datagen.pcm16_to_wave(datagen.wave_to_pcm16(synth.render_notes(notes, tempo, sample_rate)))
+    assert sample_rate == standin_renderer.sample_rate
+    assert wave_data.dtype == np.float32
+    np.testing.assert_array_equal(wave_data, expected)
+    np.testing.assert_array_equal(datagen.read_wave("{}.wav".format(base_path))[1], wave_data)
+
+
+def test_worker_renderer_reports_errors(standin_renderer):
+    worker = datagen.get_render_worker(standin_renderer.backend)
+    with pytest.raises(RuntimeError, match="Invalid MIDI file"):
+        worker.render(b"not a MIDI file")
+    # the worker keeps serving requests after a failed one
+    assert len(worker.render(datagen.midi_bytes(datagen.generate_midi_random_single_notes(1.0).midi_file))) > 0
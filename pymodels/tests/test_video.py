@@ -0,0 +1,48 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import video
+
+
+WIDTH = 160
+HEIGHT = 120
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    path_X = str(tmp_path / "dataset_X.npy")
+    path_P = str(tmp_path / "P.npy")
+    np.save(path_X, rng.uniform(0, 1, (48, 200)).astype(np.float32))
+    np.save(path_P, rng.uniform(0, 1, (48, 200)).astype(np.float32))
+    return path_X, path_P
+
+
+@pytest.mark.parametrize("num_threads", [1, 3])
+def test_standin_frames(tmp_path, inputs, num_threads):
+    path_X, path_P = inputs
+    output_path = str(tmp_path / "video.npy")
+    num_frames = video.render_video(output_path, path_X, path_P, encoder="standin", fps=30, width=WIDTH,
+                                    height=HEIGHT, block_height=2, num_threads=num_threads)
+
+    # 200 frames at 44100 / 512 frames per second, i.e. 2.32 s at 30 fps
+    starts = video.frame_starts(200, video.SAMPLE_RATE / video.HOP_LENGTH, 30)
+    assert num_frames == len(starts) == 70
+    frames = np.load(output_path)
+    assert frames.shape == (num_frames, HEIGHT, WIDTH, 3)
+    assert frames.dtype == np.uint8
+
+    # the bottom row of the predictions panel is the first input frame shown
+    P = np.load(path_P)
+    panel = video.layout_panels([np.zeros((200, 48), dtype=np.uint8)] * 2, WIDTH, HEIGHT, block_height=2)[1]
+    bottom = panel.y + panel.visible_frames * panel.block_height - 1
+    for i in [0, num_frames - 1]:
+        expected = panel.lut[video.prediction_levels(P)[starts[i], panel.columns]]
+        np.testing.assert_array_equal(frames[i, bottom, panel.x:panel.x + panel.width], expected)
+
+
+def test_standin_without_output(inputs):
+    path_X, _ = inputs
+    assert video.render_video(None, path_X, encoder="standin", width=WIDTH, height=HEIGHT) == 70
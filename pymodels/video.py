@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+Scrolling piano-roll videos of features and predictions.
+
+The view of `visualizeRoll` (src/visualization.nim): one panel per input,
+the magnitudes of a features file in dB and/or the predictions `P.npy`,
+with the bins along x and time scrolling down to the bottom, where the
+current frame is. The colors are those of `setColor`.
+
+Instead of drawing every frame to a PNG and encoding the PNGs afterwards
+(render_video.sh), the frames are composed as NumPy arrays and piped as
+raw RGB into an ffmpeg process. The inputs are mapped to color levels
+once; a frame then only gathers the visible rows of levels and writes
+them into a preallocated frame buffer. Frames are rendered on a thread
+pool into a ring of buffers and written in order.
+
+Video frame `i` shows the feature frames from time `i / fps` on, so the
+video stays in sync with the audio at any hop length and frame rate.
+
+Encoders:
+- "ffmpeg": H.264 with the settings of render_video.sh, optionally with
+  the WAVE file as AAC sound track
+- "standin": writes the raw frames into a `.npy` of shape
+  (frames, height, width, 3), for tests without ffmpeg
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import collections
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from features import load_features
+import instrumentation
+
+
+ENCODERS = ["ffmpeg", "standin"]
+
+SAMPLE_RATE = 44100
+HOP_LENGTH = 512
+
+# Color of the margins and of the frames past the end of the input
+BACKGROUND = (0x28, 0x2C, 0x34)
+
+
+def colormap_lut(num_levels=256):
+    """
+    Colors (num_levels, 3) uint8 of the levels 0 to 1 in the colormap of
+    `setColor`: blue over cyan, green and yellow to red.
+    """
+    f = np.linspace(0, 1, num_levels)
+    a = (1 - f) * 4
+    x = np.floor(a).astype(int)
+    y = a - x
+    r = np.choose(x, [1, 1 - y, 0, 0, 0])
+    g = np.choose(x, [y, 1, 1, 1 - y, 0])
+    b = np.choose(x, [0, 0, y, 1, 1])
+    return np.round(np.stack([r, g, b], axis=1) * 255).astype(np.uint8)
+
+
+def to_levels(values):
+    return np.round(np.clip(values, 0, 1) * 255).astype(np.uint8)
+
+
+def magnitude_levels(X, codec, dynamic_range_db=80.0, block_frames=8192):
+    """
+    Frame-major levels (frames, bins) of the magnitudes `X` (bins, frames),
+    in dB over `dynamic_range_db` below their maximum. `X` is read in blocks,
+    it may be memory-mapped.
+    """
+    num_bins, N = X.shape
+    peak = max([float(np.max(codec.decode(X[:, i:i+block_frames]))) for i in range(0, N, block_frames)] + [1e-10])
+    levels = np.empty((N, num_bins), dtype=np.uint8)
+    for i in range(0, N, block_frames):
+        db = 20 * np.log10(np.maximum(codec.decode(X[:, i:i+block_frames]), 1e-10) / peak)
+        levels[i:i+block_frames] = to_levels(db.T / dynamic_range_db + 1)
+    return levels
+
+
+def prediction_levels(P, block_frames=8192):
+    """
+    Frame-major levels (frames, keys) of the probabilities `P` (keys, frames).
+    """
+    num_keys, N = P.shape
+    levels = np.empty((N, num_keys), dtype=np.uint8)
+    for i in range(0, N, block_frames):
+        levels[i:i+block_frames] = to_levels(P[:, i:i+block_frames].T)
+    return levels
+
+
+class Panel(object):
+    """
+    Scrolling roll of `levels` (frames, bins) in the rectangle of the frames
+    at (x, y) of size (width, visible_frames * block_height). Each frame of
+    the input is a block of `block_height` pixel rows, the bins are
+    resampled to `width` columns.
+    """
+    def __init__(self, levels, x, y, width, visible_frames, block_height, lut):
+        self.levels = levels
+        self.x = x
+        self.y = y
+        self.width = width
+        self.visible_frames = visible_frames
+        self.block_height = block_height
+        self.lut = lut
+        self.columns = np.arange(width) * levels.shape[1] // width
+
+    def draw(self, frame, start):
+        """
+        Draws the input frames from `start` on into `frame` (height, width, 3).
+        """
+        height = self.visible_frames * self.block_height
+        # blocks from the bottom up
+        blocks = frame[self.y:self.y + height, self.x:self.x + self.width].reshape(
+            self.visible_frames, self.block_height, self.width, 3)[::-1]
+        valid = max(0, min(self.visible_frames, len(self.levels) - start))
+        blocks[:valid] = self.lut[self.levels[start:start + valid][:, self.columns]][:, None]
+        blocks[valid:] = BACKGROUND
+
+
+def layout_panels(levels, width, height, block_height=4, margin=20):
+    """
+    Panels of the level arrays `levels`, side by side.
+    """
+    lut = colormap_lut()
+    panel_width = (width - (len(levels) + 1) * margin) // len(levels)
+    visible_frames = (height - 2 * margin) // block_height
+    if panel_width <= 0 or visible_frames <= 0:
+        raise ValueError("Frame size {}x{} too small for {} panels".format(width, height, len(levels)))
+    y = (height - visible_frames * block_height) // 2
+    return [
+        Panel(l, margin + i * (panel_width + margin), y, panel_width, visible_frames, block_height, lut)
+        for i, l in enumerate(levels)
+    ]
+
+
+def frame_starts(num_input_frames, frame_rate, fps):
+    """
+    First input frame of every video frame, for inputs of `frame_rate`
+    frames per second.
+    """
+    num_frames = int(np.ceil(num_input_frames / frame_rate * fps))
+    return np.floor(np.arange(num_frames) * (frame_rate / fps)).astype(np.int64)
+
+
+def render_frames(panels, starts, width, height, write, num_threads=1):
+    """
+    Renders the video frames starting at the input frames `starts` and
+    passes them to `write` in order. Frames are rendered on `num_threads`
+    threads into a ring of `2 * num_threads` preallocated buffers; a buffer
+    is reused once `write` has returned.
+    """
+    buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(2 * num_threads)]
+    for frame in buffers:
+        frame[...] = BACKGROUND
+
+    def render(i):
+        frame = buffers[i % len(buffers)]
+        for panel in panels:
+            panel.draw(frame, starts[i])
+        return frame
+
+    if num_threads == 1:
+        for i in range(len(starts)):
+            write(render(i))
+        return
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = collections.deque(executor.submit(render, i) for i in range(min(len(buffers), len(starts))))
+        for i in range(len(starts)):
+            write(pending.popleft().result())
+            if i + len(buffers) < len(starts):
+                pending.append(executor.submit(render, i + len(buffers)))
+
+
+class FFmpegEncoder(object):
+    """
+    Pipes raw RGB frames into an ffmpeg process.
+    """
+    def __init__(self, path, width, height, fps, audio_path=None, crf=23):
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg not found (the standin encoder works without it)")
+        if width % 2 or height % 2:
+            raise ValueError("yuv420p requires an even frame size, got {}x{}".format(width, height))
+        args = [
+            "ffmpeg", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(width, height), "-r", str(fps), "-i", "-",
+        ]
+        if audio_path is not None:
+            args += ["-i", audio_path, "-c:a", "aac", "-shortest"]
+        args += ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", str(crf), path]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(frame)
+        except (IOError, OSError):
+            raise RuntimeError("ffmpeg exited with code {}".format(self.process.wait()))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        code = self.process.wait()
+        if code != 0:
+            raise RuntimeError("ffmpeg exited with code {}".format(code))
+
+
+class StandinEncoder(object):
+    """
+    Writes the frames into a memory-mapped `.npy` at `path`, or discards
+    them if `path` is None.
+    """
+    def __init__(self, path, width, height, num_frames):
+        self.frames = None
+        if path is not None:
+            self.frames = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.uint8, shape=(num_frames, height, width, 3))
+        self.num_written = 0
+
+    def write(self, frame):
+        if self.frames is not None:
+            self.frames[self.num_written] = frame
+        self.num_written += 1
+
+    def close(self):
+        if self.frames is not None:
+            self.frames.flush()
+
+
+def make_encoder(encoder, path, width, height, fps, num_frames, audio_path=None):
+    if encoder == "ffmpeg":
+        return FFmpegEncoder(path, width, height, fps, audio_path)
+    elif encoder == "standin":
+        return StandinEncoder(path, width, height, num_frames)
+    raise ValueError("Unknown video encoder: {} (available: {})".format(encoder, ", ".join(ENCODERS)))
+
+
+def render_video(output_path, path_X=None, path_P=None, audio_path=None, encoder="ffmpeg", sample_rate=SAMPLE_RATE,
+                 hop_length=HOP_LENGTH, fps=30, width=1280, height=720, block_height=4, num_threads=1):
+    """
+    Renders the rolls of the features `path_X` and/or the predictions
+    `path_P` to `output_path`, with the WAVE file `audio_path` as sound
+    track. Returns the number of video frames.
+    """
+    with instrumentation.span("render_video", encoder=encoder, threads=num_threads) as s:
+        levels = []
+        if path_X is not None:
+            X, codec = load_features(path_X)
+            levels.append(magnitude_levels(X, codec))
+        if path_P is not None:
+            levels.append(prediction_levels(np.load(path_P, mmap_mode="r")))
+        if not levels:
+            raise ValueError("Nothing to render, pass features and/or predictions")
+        if len(set(len(l) for l in levels)) > 1:
+            raise ValueError("Features and predictions differ in length: {}".format([len(l) for l in levels]))
+
+        panels = layout_panels(levels, width, height, block_height)
+        starts = frame_starts(len(levels[0]), sample_rate / hop_length, fps)
+        s.set(num_frames=len(starts))
+
+        video = make_encoder(encoder, output_path, width, height, fps, len(starts), audio_path)
+        try:
+            render_frames(panels, starts, width, height, video.write, num_threads)
+        finally:
+            video.close()
+    return len(starts)
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "output",
+        help="Video file, or .npy of the raw frames with --encoder standin",
+    )
+    parser.add_argument(
+        "--features",
+        default=None,
+        help="Features file (<base>_X.npy) to show as spectrogram",
+    )
+    parser.add_argument(
+        "--predictions",
+        default=None,
+        help="Predictions file (P.npy) to show as piano roll",
+    )
+    parser.add_argument(
+        "--audio",
+        default=None,
+        help="WAVE file of the sound track",
+    )
+    parser.add_argument(
+        "--encoder",
+        choices=ENCODERS,
+        default="ffmpeg",
+        help="Video encoder",
+    )
+    parser.add_argument(
+        "--sr",
+        type=int,
+        default=SAMPLE_RATE,
+        help="Sample rate of the inputs",
+    )
+    parser.add_argument(
+        "--hop-length",
+        type=int,
+        default=HOP_LENGTH,
+        help="Hop length of the inputs in samples",
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=30,
+        help="Video frame rate",
+    )
+    parser.add_argument(
+        "--size",
+        default="1280x720",
+        help="Frame size WIDTHxHEIGHT",
+    )
+    parser.add_argument(
+        "--block-height",
+        type=int,
+        default=4,
+        help="Height in pixels of one input frame",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of render threads",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Append timing and memory records to this JSON lines file",
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+
+    if args.trace is not None:
+        instrumentation.configure(args.trace)
+
+    width, height = [int(v) for v in args.size.split("x")]
+    num_frames = render_video(args.output, path_X=args.features, path_P=args.predictions, audio_path=args.audio,
+                              encoder=args.encoder, sample_rate=args.sr, hop_length=args.hop_length, fps=args.fps,
+                              width=width, height=height, block_height=args.block_height, num_threads=args.threads)
+    print("Wrote {} frames to {}".format(num_frames, args.output))
+
+
+if __name__ == "__main__":
+    main()